@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+#====================================================================================
+# End-to-end load test of the bridge server.
+# Starts a stub engine (echo tcp server) and the bridge in headless or async mode,
+# then drives N concurrent websocket clients with messages of a given size and rate.
+# With --engines E, E stub engines are started and the bridge spreads the clients
+# over them (engines command); --work-ms gives every engine a compute time per
+# message (one message at a time, as a single draughts engine process).
+#
+# Reported: messages per second, bytes per second, round-trip latency
+# (p50/p99/p999) and peak memory (RSS) of the bridge process.
+#
+# Usage: python test/bench_bridge.py [options]   (python test/bench_bridge.py -h)
+# Requires Python 3.7 or newer; peak RSS is read from /proc (Linux).
+#
+
+import argparse
+import asyncio
+import base64
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from web2tcp_websocketserver import unmask_payload
+
+TERMINATOR = b"\0"
+
+# ---------------------------------- stub engine ----------------------------------
+
+def runEngine(port, workMs=0):
+   # Echo tcp server: every null-terminated message is sent back at once,
+   # or after workMs of (serialized) work per message
+   work = threading.Lock()   # one message at a time over all connections
+   sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+   sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+   sock.bind(('127.0.0.1', port))
+   sock.listen(100)
+
+   def serve(conn):
+      pending = b""
+      while True:
+         data = conn.recv(65536)
+         if not data: break
+         pending += data
+         messages = pending.split(TERMINATOR)
+         pending = messages.pop()
+         if workMs:
+            for message in messages:
+               with work:
+                  time.sleep(workMs / 1000.0)
+               conn.sendall(message + TERMINATOR)
+         elif messages:
+            conn.sendall(TERMINATOR.join(messages) + TERMINATOR)
+      conn.close()
+
+   while True:
+      conn, addr = sock.accept()
+      thread = threading.Thread(target=serve, args=(conn,))
+      thread.daemon = True
+      thread.start()
+
+# ------------------------------- websocket client --------------------------------
+
+def clientFrame(payload, opcode=0x1):
+   # Masked frame from client to server
+   header = bytearray([0x80 | opcode])
+   length = len(payload)
+   if length <= 125:
+      header.append(0x80 | length)
+   elif length <= 65535:
+      header.append(0x80 | 126)
+      header.extend(struct.pack(">H", length))
+   else:
+      header.append(0x80 | 127)
+      header.extend(struct.pack(">Q", length))
+   masks = os.urandom(4)
+   return bytes(header) + masks + unmask_payload(masks, payload)
+
+async def readFrame(reader):
+   b1, b2 = await reader.readexactly(2)
+   length = b2 & 0x7f
+   if length == 126:
+      length = struct.unpack(">H", await reader.readexactly(2))[0]
+   elif length == 127:
+      length = struct.unpack(">Q", await reader.readexactly(8))[0]
+   return b1 & 0x0f, await reader.readexactly(length)
+
+class Client:
+   # Websocket client sending tagged messages; latency measured on own replies
+
+   def __init__(self, clientId, stats, size, rate):
+      self.clientId = clientId
+      self.stats = stats
+      self.size = size
+      self.rate = rate        # messages per second; 0: send next after reply
+      self.seq = 0
+      self.sent = {}          # seq => send time
+      self.replied = None     # asyncio.Event for closed loop
+
+   async def connect(self, host, port):
+      self.reader, self.writer = await asyncio.open_connection(host, port)
+      key = base64.b64encode(os.urandom(16)).decode()
+      self.writer.write(("GET / HTTP/1.1\r\nHost: %s:%d\r\nUpgrade: websocket\r\n"
+                         "Connection: Upgrade\r\nSec-WebSocket-Key: %s\r\n"
+                         "Sec-WebSocket-Version: 13\r\n\r\n" % (host, port, key)).encode())
+      await self.reader.readuntil(b"\r\n\r\n")
+      self.replied = asyncio.Event()
+
+   def message(self):
+      self.seq += 1
+      tag = "%d:%d:" % (self.clientId, self.seq)
+      return self.seq, (tag + "x" * max(0, self.size - len(tag))).encode()
+
+   async def send(self, until):
+      while time.monotonic() < until:
+         seq, payload = self.message()
+         self.sent[seq] = time.perf_counter()
+         self.replied.clear()
+         self.writer.write(clientFrame(payload))
+         self.stats.sentMessages += 1
+         self.stats.sentBytes += len(payload)
+         if self.rate > 0:
+            await asyncio.sleep(random.expovariate(self.rate))
+         else:
+            try:
+               await asyncio.wait_for(self.replied.wait(), max(0.001, until - time.monotonic()))
+            except asyncio.TimeoutError:
+               pass
+
+   async def receive(self):
+      while True:
+         try:
+            opcode, payload = await readFrame(self.reader)
+         except (asyncio.IncompleteReadError, ConnectionError):
+            break
+         self.stats.recvdMessages += 1
+         self.stats.recvdBytes += len(payload)
+         words = payload.split(b":", 3)   # echo of "<client>:<seq>:..."
+         if len(words) < 3 or words[0] != str(self.clientId).encode():
+            continue   # reply to another client (broadcast)
+         sendTime = self.sent.pop(int(words[1]), None)
+         if sendTime is not None:
+            self.stats.latencies.append(time.perf_counter() - sendTime)
+            self.replied.set()
+
+class Stats:
+   def __init__(self):
+      self.sentMessages = self.sentBytes = 0
+      self.recvdMessages = self.recvdBytes = 0
+      self.latencies = []
+
+def percentile(values, p):
+   if not values: return float('nan')
+   values = sorted(values)
+   return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+def peakRss(pid):
+   # Peak resident set size (kB) of process pid, None if unknown
+   try:
+      with open("/proc/%d/status" % pid) as status:
+         for line in status:
+            if line.startswith("VmHWM:"):
+               return int(line.split()[1])
+   except (IOError, OSError):
+      return None
+   return None
+
+async def drive(args, stats):
+   clients = [Client(i + 1, stats, args.size, args.rate) for i in range(args.clients)]
+   for client in clients:
+      await client.connect('127.0.0.1', args.ws_port)
+   receivers = [asyncio.ensure_future(client.receive()) for client in clients]
+   await asyncio.sleep(0.2)
+   t0 = time.monotonic()
+   until = t0 + args.duration
+   await asyncio.gather(*[client.send(until) for client in clients])
+   elapsed = time.monotonic() - t0
+   await asyncio.sleep(0.5)   # last replies
+   for client in clients:
+      client.writer.close()
+   for receiver in receivers:
+      receiver.cancel()
+   return elapsed
+
+def main():
+   parser = argparse.ArgumentParser(description="End-to-end load test of the bridge server")
+   parser.add_argument("--mode", choices=["headless", "async"], default="headless")
+   parser.add_argument("--clients", type=int, default=10, help="concurrent websocket clients")
+   parser.add_argument("--size", type=int, default=100, help="message size (bytes)")
+   parser.add_argument("--rate", type=float, default=0,
+                       help="messages per second per client (0: next message after reply)")
+   parser.add_argument("--duration", type=float, default=10, help="seconds")
+   parser.add_argument("--ws-port", type=int, default=37532)
+   parser.add_argument("--tcp-port", type=int, default=37531, help="port of (first) engine")
+   parser.add_argument("--engines", type=int, default=0,
+                       help="engines to spread the clients over (0: one shared engine connection)")
+   parser.add_argument("--policy", default="round_robin", help="balancing policy with --engines")
+   parser.add_argument("--work-ms", type=float, default=0, help="engine compute time per message (ms)")
+   parser.add_argument("--engine", action="store_true", help=argparse.SUPPRESS)
+   args = parser.parse_args()
+
+   if args.engine:
+      runEngine(args.tcp_port, args.work_ms)
+      return
+   if args.engines and args.mode != "headless":
+      parser.error("--engines needs mode headless")
+
+   workdir = tempfile.mkdtemp(prefix="web2tcp_bench_")   # bridge logfiles are written here
+   ports = [port for port in range(args.tcp_port, args.tcp_port + args.engines + 2)
+            if port != args.ws_port][:max(1, args.engines)]
+   engines = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "--engine",
+                                "--tcp-port", str(port), "--work-ms", str(args.work_ms)])
+              for port in ports]
+   time.sleep(0.5)
+   bridge = subprocess.Popen([sys.executable, os.path.join(ROOT, "web2tcp_bridge.py"), args.mode,
+                              str(args.ws_port), str(args.tcp_port)],
+                             cwd=workdir, stdin=subprocess.PIPE,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+   time.sleep(1.0)
+   if args.engines:
+      command = "engines %s %s %d\n" % (",".join("127.0.0.1:%d" % port for port in ports),
+                                        args.policy, args.clients)
+      bridge.stdin.write(command.encode())
+      bridge.stdin.flush()
+      time.sleep(1.0)
+   try:
+      stats = Stats()
+      elapsed = asyncio.run(drive(args, stats))
+      rss = peakRss(bridge.pid)
+   finally:
+      bridge.kill()
+      for engine in engines:
+         engine.kill()
+
+   print("mode %s, %d clients, %d bytes per message, rate %s, %.1f s" %
+         (args.mode, args.clients, args.size, args.rate or "closed loop", elapsed))
+   if args.engines:
+      print("engines: %d (%s), work per message %.1f ms" % (args.engines, args.policy, args.work_ms))
+   print("sent:      %10.0f msg/s %12.0f bytes/s" % (stats.sentMessages / elapsed, stats.sentBytes / elapsed))
+   print("received:  %10.0f msg/s %12.0f bytes/s" % (stats.recvdMessages / elapsed, stats.recvdBytes / elapsed))
+   print("round trip (ms): p50 %.3f  p99 %.3f  p999 %.3f  (%d replies)" %
+         (percentile(stats.latencies, 50) * 1e3, percentile(stats.latencies, 99) * 1e3,
+          percentile(stats.latencies, 99.9) * 1e3, len(stats.latencies)))
+   print("bridge peak RSS: %s kB" % (rss if rss is not None else "unknown"))
+
+if __name__ == "__main__":
+   main()
+
+#==============================================================================
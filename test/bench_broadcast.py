@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#====================================================================================
+# Benchmark of broadcasting a message to all websocket clients.
+# Compares encoding the frame for every client (send_text per client) with
+# the encode-once broadcast of WebsocketServer._multicast_.
+# Client sockets are dummies that discard the data, so only CPU cost is measured.
+#
+# Usage: python test/bench_broadcast.py [message_size]
+#
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from web2tcp_websocketserver import WebsocketServer, DummyWebsocketHandler, Client, ClientRegistry
+
+class DummySocket:
+   def send(self, data):
+      return len(data)
+
+class DummyServer(WebsocketServer):
+   # WebsocketServer without listening socket
+   def __init__(self, nClients):
+      self.clients = ClientRegistry()
+      for i in range(nClients):
+         handler = DummyWebsocketHandler()
+         handler.request = DummySocket()
+         handler.out_queue = None   # send directly, no writer thread
+         handler.deflate = None
+         self.clients.add(Client(i + 1, handler, None))
+
+def broadcastPerClient(server, msg):
+   # Old behaviour: frame encoded again for every client
+   for client in server.clients:
+      client.handler.send_text(msg)
+
+def measure(fn, server, msg, minTime=0.5):
+   # Returns microseconds per broadcast
+   count = 0
+   t0 = time.process_time()
+   while True:
+      fn(server, msg)
+      count += 1
+      elapsed = time.process_time() - t0
+      if elapsed >= minTime: break
+   return elapsed / count * 1e6
+
+if __name__ == "__main__":
+   size = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+   msg = "x" * size
+
+   print("message size %d characters; CPU time per broadcast" % size)
+   print("%10s %18s %18s" % ("clients", "per-client us", "encode-once us"))
+   for nClients in [1, 10, 100, 1000]:
+      server = DummyServer(nClients)
+      slow = measure(broadcastPerClient, server, msg)
+      fast = measure(WebsocketServer._multicast_, server, msg)
+      print("%10d %18.1f %18.1f" % (nClients, slow, fast))
+
+#==============================================================================
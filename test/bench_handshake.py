@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#====================================================================================
+# Benchmark of websocket handshakes per second, as in a reconnect storm of
+# browser clients after a restart of the engine.
+# Starts the websocket server (threaded, as in the bridge) or the asyncio bridge
+# in a separate process; C concurrent clients connect, send the http upgrade
+# request (optionally split in tcp segments), wait for the answer and close.
+# Optional idle connections never send a request; they hold a thread (threaded
+# server) until the handshake deadline.
+#
+# Usage: python test/bench_handshake.py [options]   (python test/bench_handshake.py -h)
+# Requires Python 3.7 or newer.
+#
+
+import argparse
+import asyncio
+import base64
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+def runServer(mode, port, timeout):
+   if mode == "async":
+      from web2tcp_asyncbridge import AsyncBridge
+      engine = socket.socket()   # tcp server that accepts and stays silent
+      engine.bind(('127.0.0.1', 0))
+      engine.listen(1)
+      bridge = AsyncBridge('127.0.0.1', port, '127.0.0.1', engine.getsockname()[1],
+                           handshake_timeout=timeout)
+      asyncio.run(bridge.serve_forever())
+   else:
+      from web2tcp_websocketserver import WebsocketServer
+      server = WebsocketServer(port, '127.0.0.1')
+      server.handshake_timeout = timeout
+      server.serve_forever()
+
+def request(port, key):
+   return ("GET / HTTP/1.1\r\nHost: 127.0.0.1:%d\r\nUpgrade: websocket\r\n"
+           "Connection: Upgrade\r\nSec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\n"
+           "User-Agent: bench_handshake\r\nAccept-Language: en-US,en;q=0.9\r\n\r\n" % (port, key)).encode()
+
+async def handshake(port, segments):
+   reader, writer = await asyncio.open_connection('127.0.0.1', port)
+   data = request(port, base64.b64encode(os.urandom(16)).decode())
+   step = -(-len(data) // segments)
+   for i in range(0, len(data), step):
+      writer.write(data[i:i + step])
+      await writer.drain()
+      if segments > 1:
+         await asyncio.sleep(0.001)
+   answer = await reader.readuntil(b"\r\n\r\n")
+   writer.close()
+   return answer.startswith(b"HTTP/1.1 101")
+
+async def client(port, segments, until, latencies, errors):
+   while time.monotonic() < until:
+      t0 = time.perf_counter()
+      try:
+         ok = await handshake(port, segments)
+      except (OSError, asyncio.IncompleteReadError):
+         ok = False
+      if ok:
+         latencies.append(time.perf_counter() - t0)
+      else:
+         errors.append(1)
+
+async def drive(args):
+   idle = []
+   for i in range(args.idle):
+      idle.append(await asyncio.open_connection('127.0.0.1', args.port))
+   latencies, errors = [], []
+   t0 = time.monotonic()
+   until = t0 + args.duration
+   await asyncio.gather(*[client(args.port, args.segments, until, latencies, errors)
+                          for i in range(args.concurrency)])
+   elapsed = time.monotonic() - t0
+   for reader, writer in idle:
+      writer.close()
+   return elapsed, latencies, len(errors)
+
+def percentile(values, p):
+   if not values: return float('nan')
+   values = sorted(values)
+   return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+def main():
+   parser = argparse.ArgumentParser(description="Websocket handshakes per second")
+   parser.add_argument("--mode", choices=["threaded", "async"], default="threaded")
+   parser.add_argument("--concurrency", type=int, default=20, help="concurrent connecting clients")
+   parser.add_argument("--segments", type=int, default=1, help="tcp segments per upgrade request")
+   parser.add_argument("--idle", type=int, default=0, help="connections that never send a request")
+   parser.add_argument("--timeout", type=float, default=10.0, help="handshake deadline of server (s)")
+   parser.add_argument("--duration", type=float, default=5, help="seconds")
+   parser.add_argument("--port", type=int, default=37533)
+   parser.add_argument("--server", action="store_true", help=argparse.SUPPRESS)
+   args = parser.parse_args()
+
+   if args.server:
+      runServer(args.mode, args.port, args.timeout)
+      return
+
+   server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--server", "--mode", args.mode,
+                              "--port", str(args.port), "--timeout", str(args.timeout)],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+   time.sleep(1.0)
+   try:
+      elapsed, latencies, errors = asyncio.run(drive(args))
+   finally:
+      server.kill()
+
+   print("mode %s, %d concurrent clients, %d segments per request, %d idle connections, %.1f s" %
+         (args.mode, args.concurrency, args.segments, args.idle, elapsed))
+   print("handshakes: %10.0f per second  (%d ok, %d failed)" % (len(latencies) / elapsed, len(latencies), errors))
+   print("handshake time (ms): p50 %.3f  p99 %.3f  max %.3f" %
+         (percentile(latencies, 50) * 1e3, percentile(latencies, 99) * 1e3,
+          max(latencies or [float('nan')]) * 1e3))
+
+if __name__ == "__main__":
+   main()
+
+#==============================================================================
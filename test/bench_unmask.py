@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+#====================================================================================
+# Benchmark of unmasking websocket payloads sent by browser clients.
+# Compares the old per-byte XOR loop with the bulk unmask_payload function.
+# Throughput is reported in MB/s.
+#
+# Usage: python test/bench_unmask.py [size_in_bytes ...]
+#
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from web2tcp_websocketserver import unmask_payload
+
+def unmask_per_byte(masks, payload):
+   # The original loop of WebSocketHandler.read_next_message
+   decoded = ""
+   for char in bytearray(payload):
+      char ^= bytearray(masks)[len(decoded) % 4]
+      decoded += chr(char)
+   return decoded
+
+def measure(fn, masks, payload, minTime=0.5):
+   # Run fn repeatedly for at least minTime seconds; returns MB/s
+   count = 0
+   t0 = time.time()
+   while True:
+      fn(masks, payload)
+      count += 1
+      elapsed = time.time() - t0
+      if elapsed >= minTime: break
+   return (count * len(payload)) / elapsed / 1e6
+
+if __name__ == "__main__":
+   sizes = [int(arg) for arg in sys.argv[1:]] or [125, 1024, 16384, 65536]
+   masks = os.urandom(4)
+
+   print("%10s %16s %16s" % ("size", "per-byte MB/s", "bulk MB/s"))
+   for size in sizes:
+      payload = os.urandom(size)
+      assert unmask_payload(masks, payload).decode('latin-1') == unmask_per_byte(masks, payload)
+      slow = measure(unmask_per_byte, masks, payload)
+      fast = measure(unmask_payload, masks, payload)
+      print("%10d %16.2f %16.2f" % (size, slow, fast))
+
+#==============================================================================
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+#====================================================================================
+# Replay of a traffic recording (record command or RECORD_FILE of the bridge).
+# Starts the bridge in headless or async mode with a stub engine that knows the
+# recorded tcp server messages, then opens a websocket per recorded browser client
+# and sends the recorded client messages.
+#
+# Client messages, connects and disconnects are replayed in recorded order at the
+# recorded pace (--speed 1), faster or slower (--speed 2, 0.5) or as fast as
+# possible (--speed 0). The stub engine sends a recorded server message when it
+# has received all client messages recorded before it, at the recorded delay
+# after the last of them (as fast as possible with --speed 0). Client messages
+# answered from the response cache (FLAG_CACHED) never reached the engine; give
+# the same cache command (--command 'cache on ..') to replay them the same way.
+# A client disconnects after the server messages recorded before its disconnect
+# are sent and forwarded.
+# Streamed messages (STREAM_THRESHOLD, recorded in parts) are replayed whole; the
+# bridge streams them again if it has the same STREAM_THRESHOLD.
+# The recording is read through mmap; payloads are not copied into memory,
+# except the joined parts of streamed messages.
+#
+# Reported: messages and bytes replayed, duration against the recorded duration,
+# messages per second and peak memory (RSS) of the bridge process.
+#
+# Usage: python test/replay_traffic.py <file> [options]   (-h for options)
+# Requires Python 3.7 or newer; the bridge must use the null codec (default).
+#
+
+import argparse
+import asyncio
+import base64
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from web2tcp_recorder import RecordReader, FROM_CLIENT, FROM_SERVER, CLIENT_CLOSE, FLAG_BINARY, FLAG_CACHED
+from bench_bridge import clientFrame, readFrame, peakRss
+
+TERMINATOR = b"\0"
+
+# ---------------------------------- stub engine ----------------------------------
+
+class ReplayEngine(threading.Thread):
+   # Tcp server sending the recorded server messages to the bridge.
+   # A message waits for the client messages recorded before it (at most
+   # timeout seconds), except those answered from the cache (FLAG_CACHED).
+
+   def __init__(self, port, reader, speed, timeout=5.0):
+      threading.Thread.__init__(self)
+      self.daemon = True
+      self.speed = speed
+      self.timeout = timeout
+      self.messages = []     # (client messages before, ns after the last of them, payload)
+      clientMessages = 0
+      anchor = None          # time of last client message (or of first record)
+      for rec in reader:
+         if anchor is None:
+            anchor = rec.time
+         if rec.direction == FROM_CLIENT and not rec.flags & FLAG_CACHED:
+            clientMessages += 1
+            anchor = rec.time
+         elif rec.direction == FROM_SERVER:
+            self.messages.append((clientMessages, rec.time - anchor, rec.payload))
+      self.cond = threading.Condition()
+      self.received = 0      # client messages received from the bridge
+      self.arrivals = [None] # arrival time of every received client message
+      self.sent = self.sentBytes = 0
+      self.late = 0          # messages sent after timeout without their requests
+      self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      self.sock.bind(('127.0.0.1', port))
+      self.sock.listen(5)
+
+   def run(self):
+      conn, addr = self.sock.accept()
+      self.arrivals[0] = time.perf_counter()
+      receiver = threading.Thread(target=self.receive, args=(conn,))
+      receiver.daemon = True
+      receiver.start()
+      for needed, gap, payload in self.messages:
+         with self.cond:
+            deadline = time.perf_counter() + self.timeout
+            while self.received < needed and time.perf_counter() < deadline:
+               self.cond.wait(deadline - time.perf_counter())
+            if self.received < needed:
+               self.late += 1
+               anchor = time.perf_counter()
+            else:
+               anchor = self.arrivals[needed]
+         if self.speed:
+            delay = anchor + gap / 1e9 / self.speed - time.perf_counter()
+            if delay > 0:
+               time.sleep(delay)
+         try:
+            conn.sendall(bytes(payload) + TERMINATOR)
+         except socket.error:
+            break
+         self.sent += 1
+         self.sentBytes += len(payload)
+
+   def receive(self, conn):
+      pending = b""
+      while True:
+         try:
+            data = conn.recv(65536)
+         except socket.error:
+            break
+         if not data: break
+         pending += data
+         messages = pending.split(TERMINATOR)
+         pending = messages.pop()
+         if messages:
+            now = time.perf_counter()
+            with self.cond:
+               self.received += len(messages)
+               self.arrivals.extend([now] * len(messages))
+               self.cond.notify()
+
+# ------------------------------- websocket clients -------------------------------
+
+class ReplayClient:
+   # Websocket client of a recorded client id
+
+   def __init__(self, stats):
+      self.stats = stats
+
+   async def connect(self, host, port):
+      self.reader, self.writer = await asyncio.open_connection(host, port)
+      key = base64.b64encode(os.urandom(16)).decode()
+      self.writer.write(("GET / HTTP/1.1\r\nHost: %s:%d\r\nUpgrade: websocket\r\n"
+                         "Connection: Upgrade\r\nSec-WebSocket-Key: %s\r\n"
+                         "Sec-WebSocket-Version: 13\r\n\r\n" % (host, port, key)).encode())
+      await self.reader.readuntil(b"\r\n\r\n")
+      self.receiver = asyncio.ensure_future(self.receive())
+      return self
+
+   async def send(self, payload, opcode):
+      self.writer.write(clientFrame(payload, opcode))
+      await self.writer.drain()
+      self.stats.sentMessages += 1
+      self.stats.sentBytes += len(payload)
+
+   async def receive(self):
+      while True:
+         try:
+            opcode, payload = await readFrame(self.reader)
+         except (asyncio.IncompleteReadError, ConnectionError):
+            break
+         self.stats.recvdMessages += 1
+         self.stats.recvdBytes += len(payload)
+         self.stats.lastReceived = time.perf_counter()
+
+   def close(self):
+      self.writer.close()
+
+class Stats:
+   def __init__(self):
+      self.sentMessages = self.sentBytes = 0
+      self.recvdMessages = self.recvdBytes = 0
+      self.lastReceived = 0
+      self.recordedSeconds = 0
+
+async def forwarded(engine, count, client, timeout=5.0):
+   # Wait until engine sent count messages and nothing arrived for 20 ms
+   deadline = time.perf_counter() + timeout
+   while engine.sent < count and time.perf_counter() < deadline:
+      await asyncio.sleep(0.001)
+   client.stats.lastReceived = time.perf_counter()
+   while time.perf_counter() - client.stats.lastReceived < 0.02:
+      await asyncio.sleep(0.005)
+
+async def replay(reader, engine, args, stats):
+   # Recorded client events in order, at the recorded pace (speed 0: no waiting)
+   clients = {}   # recorded client id => ReplayClient
+   serverMessages = 0   # recorded before the current record
+   t0 = time.perf_counter()
+   first = last = None
+   for rec in reader:
+      if rec.direction == FROM_SERVER:
+         serverMessages += 1
+         continue
+      if first is None:
+         first = rec.time
+      last = rec.time
+      if args.speed:
+         delay = t0 + (rec.time - first) / 1e9 / args.speed - time.perf_counter()
+         if delay > 0:
+            await asyncio.sleep(delay)
+      client = clients.get(rec.clientId)
+      if rec.direction == CLIENT_CLOSE:
+         if client is not None:
+            del clients[rec.clientId]
+            await forwarded(engine, serverMessages, client)
+            client.close()
+         continue
+      if client is None:
+         # also for messages of clients connected before the recording started
+         client = clients[rec.clientId] = await ReplayClient(stats).connect('127.0.0.1', args.ws_port)
+      if rec.direction == FROM_CLIENT:
+         await client.send(rec.payload, 0x2 if rec.flags & FLAG_BINARY else 0x1)
+   elapsed = time.perf_counter() - t0
+   stats.recordedSeconds = (last - first) / 1e9 if first is not None else 0
+   # last replies: until nothing arrived for a second
+   stats.lastReceived = time.perf_counter()
+   while time.perf_counter() - stats.lastReceived < 1.0:
+      await asyncio.sleep(0.1)
+   for client in clients.values():
+      client.close()
+   return elapsed
+
+def main():
+   parser = argparse.ArgumentParser(description="Replay of a traffic recording of the bridge")
+   parser.add_argument("file", help="recording (record command or RECORD_FILE)")
+   parser.add_argument("--mode", choices=["headless", "async"], default="headless")
+   parser.add_argument("--speed", type=float, default=1.0,
+                       help="pace relative to the recording (0: as fast as possible)")
+   parser.add_argument("--command", action="append", default=[],
+                       help="console command for the bridge before the replay, e.g. 'route fifo'")
+   parser.add_argument("--ws-port", type=int, default=37542)
+   parser.add_argument("--tcp-port", type=int, default=37541)
+   args = parser.parse_args()
+
+   reader = RecordReader(args.file)
+   engine = ReplayEngine(args.tcp_port, reader, args.speed)
+   engine.start()
+   workdir = tempfile.mkdtemp(prefix="web2tcp_replay_")   # bridge logfiles are written here
+   bridge = subprocess.Popen([sys.executable, os.path.join(ROOT, "web2tcp_bridge.py"), args.mode,
+                              str(args.ws_port), str(args.tcp_port)],
+                             cwd=workdir, stdin=subprocess.PIPE,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+   time.sleep(1.0)
+   for command in args.command:
+      bridge.stdin.write((command + "\n").encode())
+      bridge.stdin.flush()
+   if args.command:
+      time.sleep(0.5)
+   try:
+      stats = Stats()
+      elapsed = asyncio.run(replay(reader, engine, args, stats))
+      rss = peakRss(bridge.pid)
+   finally:
+      bridge.kill()
+
+   print("replay of %s, mode %s, speed %s" % (args.file, args.mode, args.speed or "as fast as possible"))
+   print("duration:  %.3f s (recorded %.3f s)" % (elapsed, stats.recordedSeconds))
+   print("clients:   %8d messages %12d bytes sent, %d messages received" %
+         (stats.sentMessages, stats.sentBytes, stats.recvdMessages))
+   print("engine:    %8d messages %12d bytes sent of %d recorded, %d client messages received" %
+         (engine.sent, engine.sentBytes, len(engine.messages), engine.received))
+   if engine.late:
+      print("           %d messages sent without their requests (timeout)" % engine.late)
+   if elapsed:
+      print("rate:      %10.0f client msg/s" % (stats.sentMessages / elapsed))
+   print("bridge peak RSS: %s kB" % (rss if rss is not None else "unknown"))
+
+if __name__ == "__main__":
+   main()
+
+#==============================================================================
@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+
+"""
+|===================================================================================
+| Web2Tcp: asyncio serving mode                                                     |
+|===================================================================================
+| Alternative engine for the bridge server. The websocket server, the tcp client
+| and the forwarding between them all run in one asyncio event loop.
+| There is no thread per browser client, so one process can hold thousands of
+| idle browser connections.
+|
+| Connection schema:   client(s) <====> bridge <====> server
+|
+| Start from a terminal: python web2tcp_bridge.py async
+| Requires Python 3.7 or newer.
+====================================================================================
+"""
+
+import sys
+import random
+import asyncio
+import logging
+import struct
+
+from web2tcp_websocketserver import FIN, OPCODE, MASKED, PAYLOAD_LEN, CLOSE_CONN, OPCODE_PING, OPCODE_PONG
+from web2tcp_websocketserver import OPCODE_TEXT, CLOSE_PROTOCOL_ERROR, CLOSE_UNSUPPORTED_DATA
+from web2tcp_websocketserver import CLOSE_INVALID_DATA, CLOSE_TOO_BIG
+from web2tcp_websocketserver import make_handshake_response, HandshakeRequest, HandshakeError
+from web2tcp_metrics import clock
+from web2tcp_codecs import makeCodec
+from web2tcp_websocketserver import encode_frame, unmask_payload
+from web2tcp_recorder import FROM_CLIENT, FROM_SERVER, CLIENT_OPEN, CLIENT_CLOSE, FLAG_CACHED
+
+class AsyncBridge:
+   # Websocket server, tcp client and message forwarding in one event loop.
+   # Messages from the browser clients are forwarded to the tcp server.
+   # Messages from the tcp server are forwarded to all browser clients.
+
+   def __init__(self, ws_host, ws_port, tcp_host, tcp_port, terminator="\0", max_msg_len=200, codec=None,
+                metrics=None, reuse_port=False, reconnect=(0.5, 30.0), buffer_max=1048576,
+                handshake_timeout=10.0, handshake_max_size=8192, handshake_max_headers=64,
+                ping_interval=0, idle_timeout=0, router=None, max_frame_size=0, recv_max=1048576,
+                cache=None, recorder=None, ssl_context=None, out_buffer_max=1048576,
+                slow_client_policy='drop_oldest'):
+      self.ws_host = ws_host
+      self.ws_port = ws_port
+      self.tcp_host = tcp_host
+      self.tcp_port = tcp_port
+      self.codec = makeCodec(codec or 'null', terminator)   # message framing, see web2tcp_codecs
+      self.max_msg_len = max_msg_len
+      self.clients = {}      # id => asyncio.StreamWriter
+      self.id_counter = 0
+      self.server = None
+      self.engine = None     # asyncio.StreamWriter of tcp connection
+      self.engine_lock = None   # asyncio.Lock: one drain of the engine writer at a time
+      self.reconnect_delay = reconnect   # (min, max) seconds; None: no reconnect
+      self.buffer_max = buffer_max       # max bytes of client messages buffered while reconnecting
+      self.pending = []      # messages (bytes) to send after reconnect
+      self.pending_bytes = 0
+      self.reconnecting = False
+      self.handshake_timeout = handshake_timeout   # seconds for the http upgrade request; 0: no deadline
+      self.handshake_max_size = handshake_max_size
+      self.handshake_max_headers = handshake_max_headers
+      self.ping_interval = ping_interval   # seconds; ping to a client that sent nothing (0: off)
+      self.idle_timeout = idle_timeout     # seconds; silent client disconnected (0: off)
+      self.last_seen = {}    # id => time of last frame from client
+      self.router = router   # web2tcp_routing.RequestRouter: replies to requesting client only
+      self.cache = cache     # web2tcp_cache.ResponseCache (needs router)
+      self.recorder = recorder   # web2tcp_recorder.Recorder: traffic recorded for replay
+      self.ssl_context = ssl_context   # TLS (wss://), see make_ssl_context; None: plain ws://
+      self.max_frame_size = max_frame_size   # larger client frames refused before reading (0: no limit)
+      self.recv_max = recv_max   # max bytes of a tcp server message; larger messages are skipped
+      self.out_buffer_max = out_buffer_max   # max bytes waiting to be sent to one browser client
+      self.slow_client_policy = slow_client_policy   # buffer full: 'disconnect' or frame dropped
+      self.dropped = 0       # frames not sent to slow clients
+      self.evicted = 0
+      self.reuse_port = reuse_port   # True: more processes listen on ws_port (SO_REUSEPORT)
+      self.metrics = metrics   # web2tcp_metrics.Metrics, see newMetrics() of web2tcp_bridge
+      if metrics is not None and 'clients_connected' in metrics.gauges:
+         metrics.gauges['clients_connected'] = lambda: len(self.clients)
+      if metrics is not None and 'server_connected' in metrics.gauges:
+         metrics.gauges['server_connected'] = lambda: 0 if self.engine is None else 1
+         metrics.gauges['reconnect_buffer_bytes'] = lambda: self.pending_bytes
+      if metrics is not None and 'clients_evicted' in metrics.gauges:
+         metrics.gauges['clients_evicted'] = lambda: self.evicted
+      if metrics is not None and 'requests_outstanding' in metrics.gauges:
+         metrics.gauges['requests_outstanding'] = lambda: self.router.outstanding if self.router else 0
+      if metrics is not None and 'cache_bytes' in metrics.gauges:
+         metrics.gauges['cache_bytes'] = lambda: self.cache.bytes if self.cache else 0
+      self.msglog = logging.getLogger('MSG.traffic')   # per message: sampled (MSGLOG_SAMPLE)
+      self.syslog = logging.getLogger('SYS')
+   # def __init__()
+
+   def truncate(self, message):
+      if len(message) > self.max_msg_len:
+         message = message[:self.max_msg_len] + '...'
+         self.count('truncated_total')
+      return message
+   # def truncate()
+
+   def count(self, name, value=1):
+      if self.metrics is not None:
+         self.metrics.inc(name, value)
+   # def count()
+
+   def countReceived(self, source, message):
+      if self.metrics is not None:
+         self.metrics.inc('messages_from_%s_total' % source)
+         self.metrics.inc('bytes_from_%s_total' % source, len(message))
+         self.metrics.observe('message_size_bytes', len(message))
+   # def countReceived()
+
+   def record(self, direction, client_id, payload=b"", flags=0):
+      if self.recorder is not None:
+         self.recorder.record(direction, client_id, payload, flags)
+   # def record()
+
+   def observe(self, name, value):
+      if self.metrics is not None:
+         self.metrics.observe(name, value)
+   # def observe()
+
+   async def start(self):
+      # Connect to the tcp server and start listening for browser clients
+      reader, self.engine = await asyncio.open_connection(self.tcp_host, self.tcp_port, limit=self.recv_max)
+      self.engine_lock = asyncio.Lock()   # created in the event loop (Python < 3.10)
+      self.syslog.info("Bridge connected to tcp-server at %s on port %s" % (self.tcp_host, self.tcp_port))
+      print("Listening at %s on port %s for messages from server ..." % (self.tcp_host, self.tcp_port))
+      asyncio.ensure_future(self.receive_engine(reader))
+
+      tls = {}
+      if self.ssl_context is not None:
+         tls = {'ssl': self.ssl_context, 'ssl_handshake_timeout': self.handshake_timeout or None}
+      self.server = await asyncio.start_server(self.handle_client, self.ws_host, self.ws_port,
+                                               reuse_port=self.reuse_port or None,
+                                               limit=max(self.handshake_max_size + 1, 1024), **tls)
+      self.syslog.info("Websocket server started at %s on port %s" % (self.ws_host, self.ws_port))
+      if self.ping_interval or self.idle_timeout:
+         asyncio.ensure_future(self.heartbeat())
+      print("Listening at %s on port %s for messages from browser clients ..." % (self.ws_host, self.ws_port))
+      return self
+   # def start()
+
+   async def serve_forever(self):
+      await self.start()
+      async with self.server:
+         await self.server.serve_forever()
+   # def serve_forever()
+
+   async def receive_engine(self, reader):
+      # Receive messages from tcp server and forward them to all browser clients
+      while True:
+         try:
+            data = await self.read_engine_message(reader)
+         except (asyncio.IncompleteReadError, ConnectionError):
+            if self.reconnect_delay is None: break
+            reader = await self.reconnect()
+            continue
+         if data is None:
+            continue   # too large, skipped
+         t0 = clock()
+         self.countReceived('server', data)
+         message = self.truncate(data.decode('utf-8', 'replace').strip())
+         self.msglog.info("%-22s %s", "server ==> bridge:", message)
+         client_id, key = self.router.replyWithKey(data) if self.router is not None else (None, None)
+         self.record(FROM_SERVER, client_id or 0, data)
+         if key is not None and self.cache is not None:
+            self.cache.put(key, data)
+         if client_id is None:
+            self.send_to_all(message)
+         elif client_id in self.clients:
+            self.send_frame(client_id, self.clients[client_id], encode_frame(message.encode('utf-8')))
+            self.count('replies_routed_total')
+            self.msglog.info("%-22s %s", "bridge ==> client(%d):" % client_id, message)
+         else:
+            self.count('replies_dropped_total')
+         self.observe('latency_to_clients_seconds', clock() - t0)
+      # end while listening
+
+      self.engine = None
+      self.syslog.error("Listening to tcp-server stopped; tcp connection broken")
+      print("Tcp connection broken; receiving messages from server stopped. ")
+      return None
+   # def receive_engine()
+
+   async def read_engine_message(self, reader):
+      # Next message of the tcp server (bytes, without framing);
+      # None if the message is larger than recv_max (skipped, not kept in memory)
+      codec = self.codec
+      if codec.headerSize:
+         header = await reader.readexactly(codec.headerSize)   # exact reads, no scanning
+         length = codec.bodyLength(header)
+         if codec.headerSize + length > self.recv_max:
+            # body skipped in parts of at most recv_max bytes
+            while length > 0:
+               length -= len(await reader.readexactly(min(length, self.recv_max)))
+            self.skipped_engine_message()
+            return None
+         body = await reader.readexactly(length)
+         return codec.message(header, body)
+      try:
+         data = await reader.readuntil(codec.delimiter)
+      except asyncio.LimitOverrunError as err:
+         # no delimiter within recv_max bytes: skipped up to the delimiter
+         while True:
+            await reader.readexactly(err.consumed)
+            try:
+               await reader.readuntil(codec.delimiter)
+               break
+            except asyncio.LimitOverrunError as more:
+               err = more
+         self.skipped_engine_message()
+         return None
+      return data[:-len(codec.delimiter)]
+   # def read_engine_message()
+
+   def skipped_engine_message(self):
+      self.count('truncated_total')
+      self.syslog.error("Message of tcp-server larger than %d bytes skipped" % self.recv_max)
+   # def skipped_engine_message()
+
+   async def reconnect(self):
+      # Reconnect to the tcp server with exponential backoff and jitter.
+      # Client messages are buffered meanwhile and sent after reconnect.
+      # Returns the reader of the new connection.
+      self.engine = None
+      self.reconnecting = True
+      self.syslog.error("Tcp connection broken; reconnecting to %s on port %s" % (self.tcp_host, self.tcp_port))
+      print("Tcp connection broken; reconnecting to tcp-server ...")
+      t0 = clock()
+      delay, max_delay = self.reconnect_delay
+      while True:
+         await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+         try:
+            reader, engine = await asyncio.open_connection(self.tcp_host, self.tcp_port, limit=self.recv_max)
+            break
+         except OSError:
+            delay = min(delay * 2, max_delay)
+      while self.pending:
+         # clients may buffer more messages while the engine drains
+         self.syslog.info("Sending %d messages buffered while reconnecting" % len(self.pending))
+         engine.write(b''.join(self.pending))
+         self.pending = []
+         self.pending_bytes = 0
+         try:
+            await engine.drain()
+         except ConnectionError:
+            break   # broken again: noticed by receive_engine
+      self.reconnecting = False
+      self.engine = engine
+      outage = clock() - t0
+      self.count('server_reconnects_total')
+      self.observe('reconnect_seconds', outage)
+      self.syslog.info("Bridge reconnected to tcp-server after %.1f s" % outage)
+      print("Reconnected to tcp-server after %.1f s" % outage)
+      return reader
+   # def reconnect()
+
+   def send_to_all(self, message):
+      # Send message to all connected browser clients
+      frame = encode_frame(message.encode('utf-8'))
+      for client_id, writer in list(self.clients.items()):
+         self.send_frame(client_id, writer, frame)
+      self.msglog.info("%-22s %s", "bridge ==> clients:", message)
+      return None
+   # def send_to_all()
+
+   def send_frame(self, client_id, writer, frame):
+      # Frame to a browser client. At most out_buffer_max bytes wait in the
+      # transport for a client that does not read; then the frame is dropped,
+      # or the client disconnected (slow_client_policy 'disconnect').
+      # Frames already in the transport cannot be taken back: drop_oldest
+      # drops the new frame as well.
+      if writer.transport.get_write_buffer_size() + len(frame) <= self.out_buffer_max:
+         writer.write(frame)
+         return True
+      if self.slow_client_policy == 'disconnect':
+         self.syslog.error("Client(%d) too slow, %d bytes waiting: disconnecting" %
+                           (client_id, writer.transport.get_write_buffer_size()))
+         self.clients.pop(client_id, None)
+         writer.transport.abort()   # buffered frames would never be read
+      else:
+         self.dropped += 1
+      return False
+   # def send_frame()
+
+   async def send_to_engine(self, message):
+      # Message to the tcp server. Waits while the tcp server does not read:
+      # at most the high-water mark of the transport (64 KiB) is buffered,
+      # plus one message per waiting client.
+      data = self.codec.encode(message.encode('utf-8'))
+      if self.engine is not None:
+         engine = self.engine
+         engine.write(data)   # written before waiting: in order of the router
+         async with self.engine_lock:   # one drain at a time (Python < 3.10)
+            await engine.drain()
+      elif self.reconnecting:
+         if self.pending_bytes + len(data) > self.buffer_max:
+            self.count('buffer_dropped_total')
+            raise Exception("send exception: reconnecting, buffer full")
+         self.pending.append(data)
+         self.pending_bytes += len(data)
+      else:
+         raise Exception("send exception: no tcp connection")
+      return None
+   # def send_to_engine()
+
+   async def read_handshake(self, reader):
+      # Http upgrade request, line by line (see HandshakeRequest)
+      request = HandshakeRequest(self.handshake_max_size, self.handshake_max_headers)
+      while not request.complete:
+         line = await reader.readline()
+         if not line:
+            return None
+         request.feed(line)
+      return request
+   # def read_handshake()
+
+   async def handshake(self, reader, writer):
+      # Returns True if the http upgrade to the websocket protocol succeeded
+      try:
+         request = await asyncio.wait_for(self.read_handshake(reader), self.handshake_timeout or None)
+      except HandshakeError as err:
+         writer.write(('HTTP/1.1 %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n' % err.status).encode())
+         return False
+      except (asyncio.TimeoutError, ValueError, ConnectionError):
+         return False   # deadline missed, line longer than stream limit or connection broken
+      if request is None:
+         return False
+      if not request.is_upgrade():
+         self.answer_http(request.path, writer)
+         return False
+      key = request.key()
+      if key is None:
+         return False
+      writer.write(make_handshake_response(key).encode())
+      return True
+   # def handshake()
+
+   def answer_http(self, path, writer):
+      # Plain http request on the websocket port: GET /metrics
+      if path is not None and path.split('?')[0] == '/metrics' and self.metrics is not None:
+         status, body = '200 OK', self.metrics.text()
+      else:
+         status, body = '404 Not Found', 'Not found\n'
+      body = body.encode('utf-8')
+      writer.write(('HTTP/1.1 %s\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                    'Content-Length: %d\r\nConnection: close\r\n\r\n' % (status, len(body))).encode() + body)
+      return None
+   # def answer_http()
+
+   async def heartbeat(self):
+      # One task for all clients: ping silent clients, disconnect idle clients
+      # (see Heartbeat of web2tcp_websocketserver)
+      intervals = [t for t in (self.ping_interval, self.idle_timeout) if t]
+      tick = max(0.1, min(intervals) / 2.0)
+      ping_frame = encode_frame(b'', OPCODE_PING)
+      pinged = {}            # id => time of last ping
+      while True:
+         await asyncio.sleep(tick)
+         now = clock()
+         for client_id, writer in list(self.clients.items()):
+            silent = now - self.last_seen.get(client_id, now)
+            if self.idle_timeout and silent >= self.idle_timeout:
+               self.syslog.info("Client(%d) silent for %d seconds: disconnecting" % (client_id, silent))
+               self.evicted += 1
+               del self.clients[client_id]
+               writer.close()
+            elif self.ping_interval and silent >= self.ping_interval and \
+                 pinged.get(client_id, 0) < self.last_seen.get(client_id, now):
+               pinged[client_id] = now
+               writer.write(ping_frame)
+         for client_id in list(pinged):
+            if client_id not in self.clients: del pinged[client_id]
+   # def heartbeat()
+
+   async def read_message(self, reader, writer, client_id):
+      # Returns the next text message of a browser client, None if connection closed.
+      # Pings are answered; pongs only count as sign of life.
+      while True:
+         b1, b2 = await reader.readexactly(2)
+         fin = b1 & FIN
+         opcode = b1 & OPCODE
+         masked = b2 & MASKED
+         payload_length = b2 & PAYLOAD_LEN
+
+         if opcode == CLOSE_CONN or not masked:
+            return None
+         if payload_length == 126:
+            payload_length = struct.unpack(">H", await reader.readexactly(2))[0]
+         elif payload_length == 127:
+            payload_length = struct.unpack(">Q", await reader.readexactly(8))[0]
+
+         # size checked before anything is allocated
+         status = None
+         if opcode & 0x8 and payload_length > 125:
+            status = CLOSE_PROTOCOL_ERROR   # control frame too large
+         elif self.max_frame_size and payload_length > self.max_frame_size:
+            status = CLOSE_TOO_BIG
+         if status is not None:
+            self.syslog.error("Client(%d): frame of %d bytes refused; disconnecting" % (client_id, payload_length))
+            writer.write(encode_frame(struct.pack(">H", status), CLOSE_CONN))
+            return None
+         if not opcode & 0x8 and (opcode != OPCODE_TEXT or not fin):
+            # binary frames and fragmented messages: threaded modes only
+            self.syslog.error("Client(%d): binary or fragmented message not supported; disconnecting" % client_id)
+            writer.write(encode_frame(struct.pack(">H", CLOSE_UNSUPPORTED_DATA), CLOSE_CONN))
+            return None
+
+         masks = await reader.readexactly(4)
+         payload = unmask_payload(masks, await reader.readexactly(payload_length))
+         self.last_seen[client_id] = clock()
+         if opcode == OPCODE_PING:
+            writer.write(encode_frame(payload, OPCODE_PONG))
+         elif opcode == OPCODE_TEXT:
+            try:
+               return payload.decode('utf-8')
+            except UnicodeDecodeError:
+               self.syslog.error("Client(%d): text message is not valid UTF-8; disconnecting" % client_id)
+               writer.write(encode_frame(struct.pack(">H", CLOSE_INVALID_DATA), CLOSE_CONN))
+               return None
+   # def read_message()
+
+   async def handle_client(self, reader, writer):
+      # Runs for every browser client connecting to the bridge (after the TLS handshake)
+      ssl_object = writer.get_extra_info('ssl_object')
+      if ssl_object is not None:
+         self.count('tls_handshakes_total')
+         if ssl_object.session_reused:
+            self.count('tls_resumed_total')
+      if not await self.handshake(reader, writer):
+         try:
+            await writer.drain()   # http answer
+         except ConnectionError:
+            pass
+         writer.close()
+         return None
+      self.id_counter += 1
+      client_id = self.id_counter
+      self.clients[client_id] = writer
+      self.last_seen[client_id] = clock()
+      self.syslog.info("New client connected and was given id %d" % client_id)
+      self.record(CLIENT_OPEN, client_id)
+
+      while True:
+         try:
+            message = await self.read_message(reader, writer, client_id)
+         except (asyncio.IncompleteReadError, ConnectionError):
+            message = None
+         if message is None: break
+
+         t0 = clock()
+         self.countReceived('clients', message)
+         received = message
+         message = self.truncate(message)
+         key = response = None
+         if self.cache is not None and self.router is not None:
+            key = self.cache.key(message)
+            if key is not None:
+               response = self.cache.get(key)
+               self.count('cache_hits_total' if response is not None else 'cache_misses_total')
+         self.record(FROM_CLIENT, client_id, received.encode('utf-8'), FLAG_CACHED if response is not None else 0)
+         self.msglog.info("%-22s %s", "client(%d) ==> bridge:" % client_id, message)
+         if response is not None:
+            # answered from the response cache, not forwarded
+            reply = self.truncate(response.decode('utf-8', 'replace').strip())
+            self.send_frame(client_id, writer, encode_frame(reply.encode('utf-8')))
+            self.msglog.info("%-22s %s", "bridge(cache) ==> client(%d):" % client_id, reply)
+            continue
+         entry = self.router.request(client_id, message, key) if self.router is not None else None
+         try:
+            await self.send_to_engine(message)
+            self.observe('latency_to_server_seconds', clock() - t0)
+            self.msglog.info("%-22s %s", "bridge ==> server:", message)
+         except:
+            if entry is not None: self.router.cancel(entry)
+            self.count('forward_errors_total')
+            err = sys.exc_info()[1]
+            self.syslog.error("Error forwarding message to tcp-server: %s" % err)
+      # end while receiving
+
+      self.clients.pop(client_id, None)   # evicted: already removed
+      self.last_seen.pop(client_id, None)
+      self.syslog.info("Client(%d) disconnected from bridge (ws-server)" % client_id)
+      self.record(CLIENT_CLOSE, client_id)
+      writer.close()
+      return None
+   # def handle_client()
+
+# CLASS AsyncBridge
+
+def runAsyncBridge(ws_host, ws_port, tcp_host, tcp_port, **options):
+   # Run the bridge in asyncio mode until interrupted (Ctrl-C)
+   bridge = AsyncBridge(ws_host, ws_port, tcp_host, tcp_port, **options)
+   try:
+      asyncio.run(bridge.serve_forever())
+   except KeyboardInterrupt:
+      print("Server terminated.")
+   except OSError as err:
+      print("Error trying to start bridge in async mode: %s" % err)
+   return None
+# def runAsyncBridge()
+
+#=====================================================================================
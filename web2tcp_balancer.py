@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""
+|===================================================================================
+| Web2Tcp: load balancing over equivalent engines                                   |
+|===================================================================================
+| A set of equivalent tcp servers (engines); every browser client gets its own
+| engine session on one of them, chosen by the policy:
+|   round_robin         engines in turn
+|   least_outstanding   engine with the fewest requests waiting for a reply
+|   sticky              same engine for the same client address (rendezvous
+|                       hashing: only clients of an engine that leaves the
+|                       rotation move to another engine)
+| A health checker probes every engine periodically. Engines that refuse the
+| connection or answer slower than the timeout leave the rotation until a
+| probe succeeds again.
+|
+| A backend is an engine pool with: host, port, healthy, failures, probeTime,
+| outstanding, busy (sessions), acquire(client) and release(session);
+| sessions know their backend (session.pool). acquire raises PoolExhausted if
+| the pool is full and socket.error if the engine cannot be reached; only the
+| latter takes the backend out of the rotation.
+====================================================================================
+"""
+
+import socket
+import threading
+import time
+import zlib
+
+POLICIES = ('round_robin', 'least_outstanding', 'sticky')
+
+class PoolExhausted(Exception):
+   # All sessions of a backend in use; the engine itself may be healthy
+   pass
+
+def parseEndpoints(spec, defaultHost='127.0.0.1'):
+   # "host:port,host:port" or "port,port" => [(host, port)]
+   endpoints = []
+   for word in spec.replace(';', ',').split(','):
+      word = word.strip()
+      if not word: continue
+      host, sep, port = word.rpartition(':')
+      try:
+         endpoints.append((host or defaultHost, int(port)))
+      except ValueError:
+         raise ValueError("bad engine address %s (host:port)" % word)
+   if not endpoints:
+      raise ValueError("no engine addresses")
+   return endpoints
+#  parseEndpoints()
+
+def probe(host, port, timeout, data=None):
+   # Health probe: connect and, with data, send it and wait for the first bytes
+   # of the answer. Returns seconds taken, None if failed or slower than timeout.
+   t0 = time.time()
+   try:
+      sock = socket.create_connection((host, port), timeout)
+   except socket.error:
+      return None
+   try:
+      if data:
+         sock.settimeout(max(0.001, timeout - (time.time() - t0)))
+         sock.sendall(data)
+         if not sock.recv(1):
+            return None
+   except socket.error:
+      return None
+   finally:
+      sock.close()
+   elapsed = time.time() - t0
+   return elapsed if elapsed <= timeout else None
+#  probe()
+
+class Balancer:
+   # Engine sessions for browser clients spread over backends (see above)
+
+   def __init__(self, backends, policy='round_robin', clientKey=None):
+      if policy not in POLICIES:
+         raise ValueError("unknown balancing policy %s (%s)" % (policy, ", ".join(POLICIES)))
+      self.backends = list(backends)
+      self.policy = policy
+      self.clientKey = clientKey or (lambda client: client['id'])   # sticky: key of client
+      self.lock = threading.Lock()
+      self.turn = 0          # round_robin: index of next backend
+      self.failovers = 0     # sessions that went to another backend after a failure
+      self.checker = None    # HealthChecker
+
+   def healthyBackends(self):
+      return [backend for backend in self.backends if backend.healthy]
+
+   def candidates(self, client):
+      # Backends in order of preference for client; unhealthy backends last
+      # (tried only if no healthy backend accepts the session)
+      healthy = self.healthyBackends()
+      others = [backend for backend in self.backends if not backend.healthy]
+      if self.policy == 'round_robin':
+         with self.lock:
+            self.turn += 1
+            turn = self.turn
+         if healthy:
+            shift = turn % len(healthy)
+            healthy = healthy[shift:] + healthy[:shift]
+      elif self.policy == 'least_outstanding':
+         healthy.sort(key=lambda backend: (backend.outstanding, len(backend.busy)))
+      else:
+         key = str(self.clientKey(client))
+         score = lambda backend: zlib.crc32(("%s|%s:%d" % (key, backend.host, backend.port)).encode())
+         healthy.sort(key=score, reverse=True)
+         others.sort(key=score, reverse=True)
+      return healthy + others
+
+   def acquire(self, client):
+      # Engine session for client; a backend that cannot be reached leaves the
+      # rotation and the next backend is tried, as for a backend that is full.
+      # Raises exception if none accepts.
+      err = None
+      for backend in self.candidates(client):
+         try:
+            session = backend.acquire(client)
+         except PoolExhausted as exc:
+            err = exc
+            continue
+         except socket.error as exc:
+            err = exc
+            self.markDown(backend)
+            with self.lock:
+               self.failovers += 1
+            continue
+         return session
+      raise Exception("no engine available: %s" % err)
+
+   def release(self, session):
+      session.pool.release(session)
+
+   def markDown(self, backend):
+      # Out of rotation until the health checker sees it working again
+      if backend.healthy:
+         backend.healthy = False
+         backend.failures = max(backend.failures, 1)
+
+   def status(self):
+      return "%s, %d of %d engines healthy, %d failovers" % \
+             (self.policy, len(self.healthyBackends()), len(self.backends), self.failovers)
+# END class Balancer
+
+class HealthChecker(threading.Thread):
+   # Probes all backends of a Balancer every interval seconds.
+   # fails: failed probes in a row before a backend leaves the rotation.
+   # onChange(backend) is called when a backend leaves or rejoins the rotation.
+
+   def __init__(self, balancer, interval=5.0, timeout=2.0, fails=2, data=None, onChange=None):
+      threading.Thread.__init__(self)
+      self.daemon = True
+      self.balancer = balancer
+      self.interval = interval
+      self.timeout = timeout
+      self.fails = fails
+      self.data = data          # probe message (encoded), None: connect only
+      self.onChange = onChange
+      self.stopped = threading.Event()
+      self.probes = 0
+      balancer.checker = self
+
+   def run(self):
+      while not self.stopped.wait(self.interval):
+         for backend in self.balancer.backends:
+            self.check(backend)
+
+   def check(self, backend):
+      elapsed = probe(backend.host, backend.port, self.timeout, self.data)
+      self.probes += 1
+      backend.probeTime = elapsed
+      if elapsed is not None:
+         backend.failures = 0
+         if not backend.healthy:
+            backend.healthy = True
+            if self.onChange: self.onChange(backend)
+      else:
+         backend.failures += 1
+         if backend.healthy and backend.failures >= self.fails:
+            backend.healthy = False
+            if self.onChange: self.onChange(backend)
+
+   def stop(self):
+      self.stopped.set()
+# END class HealthChecker
+
+#=====================================================================================
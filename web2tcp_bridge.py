@@ -21,16 +21,35 @@
 | More than one client can open a connection with the bridge server.
 |
 | Start the application from a terminal: python web2tcp_bridge.py
+| Start in asyncio serving mode (no console): python web2tcp_bridge.py async
+| Start without console output per message: python web2tcp_bridge.py headless
+| Start worker processes sharing the websocket port: python web2tcp_bridge.py workers
+| Other ports for auto, headless, async and workers: python web2tcp_bridge.py auto <ws_port> <tcp_port>
 | 
 | (c) Arthur Kalverboer 2018
 ====================================================================================
 """
 
-import re, sys, os, time
+import re, sys, os, time, random
 import threading
 import logging
+import logging.handlers
 import socket
-from web2tcp_websocketserver import WebsocketServer
+from collections import deque
+try:
+   from queue import Queue, Full
+except ImportError:
+   from Queue import Queue, Full
+from web2tcp_websocketserver import WebsocketServer, sendall_buffers, set_socket_options, \
+                                    make_ssl_context, OPCODE_TEXT, OPCODE_BINARY
+from web2tcp_codecs import makeCodec, StreamChunk
+from web2tcp_routing import RequestRouter
+from web2tcp_balancer import Balancer, HealthChecker, PoolExhausted, parseEndpoints
+from web2tcp_cache import ResponseCache
+from web2tcp_recorder import Recorder, FROM_CLIENT, FROM_SERVER, CLIENT_OPEN, CLIENT_CLOSE, FLAG_BINARY, FLAG_CACHED
+from web2tcp_recorder import FLAG_PART, FLAG_FIRST, FLAG_LAST
+from web2tcp_metrics import Metrics, LATENCY_BUCKETS, SIZE_BUCKETS, OUTAGE_BUCKETS, STAGE_BUCKETS, clock
+from web2tcp_profiler import newProfiler
 
 # === CONSTANTS ===
 VERSION = "2018.04.29"  # initial release: version 2018.05.01
@@ -48,21 +67,343 @@ TCP_PORT = 27531       # default port connection tcp_client and tcp_server
 TERMINATOR = "\0"      # message terminator for tcp-connections (null character)
                        # websockets is message based protocol (no terminator needed)
                        # tcp-sockets is stream based protocol, terminator needed 
+TCP_CODEC = 'null'     # message framing of tcp-connections: 'null' (TERMINATOR), 'newline',
+                       # 'length2', 'length4' (big-endian length prefix, binary safe) or
+                       # 'header:<size>:<offset>:<length size>' (see web2tcp_codecs)
 MAX_MSG_LEN = 200      # Max length of received messages (char); msg will be truncated
+                       # (streaming: only the console output is truncated)
+STREAM_THRESHOLD = 0   # bytes; larger messages are forwarded in parts as they arrive,
+                       # nothing is truncated (0: no streaming)
+STREAM_CHUNK_SIZE = 65536   # bytes of a part of a streamed message from a browser client
+STREAM_READ_TIMEOUT = 30.0  # seconds for a streamed message of a browser client; other messages
+                            # to the tcp-server wait meanwhile (0: no limit)
+MAX_FRAME_SIZE = 16777216   # bytes; larger websocket frames refused before reading (0: no limit)
+MAX_MESSAGE_SIZE = 16777216 # bytes; limit of all frames of a fragmented message (0: no limit)
+TCP_WRITE_MAX = 262144 # bytes of streamed parts waiting for the tcp-server; the client waits
+
+RECV_BUF_MAX = 1048576 # Max bytes buffered for one incomplete message from tcp-server
+RECV_READ_MIN = 1024   # Smallest and largest read size of the receive buffer;
+RECV_READ_MAX = 65536  # the read size adapts to the traffic between these limits
+
+OUT_QUEUE_SIZE = 100   # Max messages waiting to be sent to one browser client
+SLOW_CLIENT_POLICY = 'drop_oldest'  # if queue full: 'drop_oldest', 'drop_newest' or 'disconnect'
+OUT_BUFFER_MAX = 1048576  # async and workers mode: max bytes waiting for one browser client
+
+TCP_NODELAY = True     # Nagle algorithm off for tcp-server and browser client sockets
+TCP_QUICKACK = False   # Linux: acknowledge tcp-server data at once (no delayed ack)
+SO_SNDBUF_SIZE = 0     # socket send buffer size (bytes); 0: system default
+SO_RCVBUF_SIZE = 0     # socket receive buffer size (bytes); 0: system default
+
+HANDSHAKE_TIMEOUT = 10.0     # seconds for the http upgrade request of a browser client
+HANDSHAKE_MAX_SIZE = 8192    # max bytes of the http upgrade request
+HANDSHAKE_MAX_HEADERS = 64   # max header lines of the http upgrade request
+
+PING_INTERVAL = 0      # seconds; ping to a browser client that sent nothing (0: no pings), e.g. 20
+IDLE_TIMEOUT = 0       # seconds; browser client without any frame (or pong) disconnected (0: never), e.g. 60
+
+RECONNECT = True       # reconnect to tcp-server if the connection is broken
+RECONNECT_DELAY_MIN = 0.5    # first delay between reconnect attempts (seconds);
+RECONNECT_DELAY_MAX = 30.0   # doubled after every failed attempt up to this max
+RECONNECT_BUFFER_MAX = 1048576  # max bytes of client messages buffered while reconnecting
+
+TLS_CERT_FILE = ''     # certificate chain (PEM) for TLS, wss://<ws_host>:<ws_port> ('': plain ws://)
+TLS_KEY_FILE = ''      # private key (PEM); '': key in TLS_CERT_FILE
+TLS_TICKETS = 2        # session tickets per handshake: reconnecting browsers resume the session
+                       # (no full handshake); 0: no tickets (TLS 1.2 sessions closed cleanly
+                       # still resume by session id, see make_ssl_context)
+
+DEFLATE = False        # True: permessage-deflate compression if offered by browser client
+DEFLATE_CONTEXT_TAKEOVER = True  # False: compress every message on its own (less memory)
+DEFLATE_WINDOW_BITS = 15         # compression window 9..15 (2**bits bytes)
+DEFLATE_MIN_SIZE = 64  # messages smaller than this (bytes) are not compressed
+
+BINARY_MODE = False    # True: tcp-server messages forwarded as binary websocket frames (no decoding)
+
+ROUTING = 'broadcast'  # tcp-server messages to: 'broadcast' all clients; 'fifo' or 'id': the client
+                       # that sent the request (see web2tcp_routing); others still to all clients
+ROUTING_ID_PATTERN = r'"id"\s*:\s*"?([\w.-]+)'  # routing id: regular expression with one group
+ROUTING_TIMEOUT = 30.0 # seconds; request without reply forgotten
+CACHE_PREFIXES = []    # requests starting with one of these prefixes are answered from the response
+                       # cache if repeated ([]: no cache); needs ROUTING fifo/id or engine sessions
+CACHE_TTL = 60.0       # seconds a cached response is used (0: until evicted)
+CACHE_MAX_BYTES = 16777216   # memory bound of the response cache
+CACHE_MAX_ENTRIES = 10000    # max cached responses; least recently used evicted first
+RECORD_FILE = ''       # traffic of both directions recorded to this binary file ('': off);
+                       # replay: python test/replay_traffic.py <file>
+RECORD_BUFFER_MAX = 33554432  # max bytes of records waiting for the disk; more records are dropped
+HEADLESS = False       # True: no console output per message (start argument headless)
+STAGE_TIMING = False   # True: time of every stage of a message in histograms (stage_*_seconds)
+PROFILE_INTERVAL = 0.005      # seconds between stack samples of profile on sample
+PROFILE_FILE = 'web2tcp_profile'  # dump of profile off: + .txt (sample) or .pstats (cprofile)
+MSGLOG_MAX_BYTES = 10485760  # message logfile rotated at this size (0: no rotation)
+MSGLOG_BACKUPS = 3     # number of rotated message logfiles kept
+MSGLOG_SAMPLE = 1      # log 1 of every MSGLOG_SAMPLE messages (1: log all messages)
+MSGLOG_QUEUE_MAX = 10000   # max log records waiting for the message logfile; more are dropped
+
+WORKERS = 0            # worker processes of mode workers (0: one per cpu)
+
+POOL_SIZE = 4          # engine connections opened in advance by the pool command
+POOL_MAX = 16          # max engine connections of the pool (one per browser client)
+
+ENGINES = ''           # equivalent engines for the engines command: 'host:port,host:port'
+BALANCE_POLICY = 'round_robin'  # engine per client: 'round_robin', 'least_outstanding' or 'sticky'
+HEALTH_INTERVAL = 5.0  # seconds between health probes of the engines
+HEALTH_TIMEOUT = 2.0   # seconds; engine answering slower is out of rotation
+HEALTH_FAILS = 2       # failed probes in a row before an engine is out of rotation
+HEALTH_PROBE = ''      # message sent as probe (any answer counts); '': connect only
 #===================================================================================
 
+msglogListener = None  # background writer of message logfile (see initLogging)
+msglogQueue = None     # DropQueueHandler of message logfile (dropped records)
+
 def prompt() :
+    if HEADLESS: return
     sys.stdout.write('>>> ')
     sys.stdout.flush()
 
+def showMessage(direction, message, newline=False):
+   # Console output and logging of a forwarded message.
+   # Formatting is lazy: nothing is formatted for disabled output.
+   if STREAM_THRESHOLD and len(message) > MAX_MSG_LEN:
+      message = message[:MAX_MSG_LEN]+'...'   # forwarded whole, shown truncated
+   if not HEADLESS:
+      print("%sMessage from %-22s %s" % ("\n" if newline else "", direction, message))
+   trafficlog.info("%-22s %s", direction, message)
+   return None
+#  showMessage()
+
+def newMetrics():
+   # Counters and histograms of the bridge; see info and http://<ws_host>:<ws_port>/metrics
+   metrics = Metrics()
+   metrics.counter('messages_from_clients_total', "Messages received from browser clients")
+   metrics.counter('bytes_from_clients_total', "Bytes (chars) received from browser clients")
+   metrics.counter('messages_from_server_total', "Messages received from tcp server")
+   metrics.counter('bytes_from_server_total', "Bytes received from tcp server")
+   metrics.counter('truncated_total', "Messages truncated at MAX_MSG_LEN")
+   metrics.counter('streamed_total', "Messages forwarded in parts (STREAM_THRESHOLD)")
+   metrics.counter('replies_routed_total', "Server messages sent to the requesting client only")
+   metrics.counter('replies_dropped_total', "Server replies to clients that disconnected")
+   metrics.gauge('requests_outstanding', "Client requests waiting for a routed reply",
+                 lambda: router.outstanding if router != None else 0)
+   metrics.counter('forward_errors_total', "Messages that could not be forwarded")
+   metrics.counter('cache_hits_total', "Client requests answered from the response cache")
+   metrics.counter('cache_misses_total', "Cacheable client requests forwarded to tcp server")
+   metrics.gauge('cache_bytes', "Memory of the response cache",
+                 lambda: cache.bytes if cache != None else 0)
+   metrics.counter('engine_failovers_total', "Client sessions moved to a new engine session after a failure")
+   metrics.gauge('engines_healthy', "Engines in rotation (engines command)",
+                 lambda: len(enginePool.healthyBackends()) if isinstance(enginePool, Balancer) else 0)
+   metrics.counter('tls_handshakes_total', "TLS handshakes of browser clients completed")
+   metrics.counter('tls_resumed_total', "TLS handshakes resuming a session (session cache or ticket)")
+   metrics.gauge('tls_handshake_failures', "TLS handshakes failed or timed out",
+                 lambda: tWebsocketHandler.server.tls_stats.failures)
+   metrics.histogram('tls_handshake_seconds', "Time of TLS handshakes", LATENCY_BUCKETS)
+   metrics.counter('server_reconnects_total', "Reconnects to tcp server after a broken connection")
+   metrics.counter('buffer_dropped_total', "Client messages dropped: reconnect buffer full")
+   metrics.gauge('clients_evicted', "Browser clients disconnected after IDLE_TIMEOUT",
+                 lambda: tWebsocketHandler.server.heartbeat.evicted)
+   metrics.gauge('server_connected', "1 if connected to tcp server",
+                 lambda: 1 if mySock.sock != None else 0)
+   metrics.gauge('reconnect_buffer_bytes', "Bytes of client messages waiting for reconnect",
+                 lambda: mySock.pendingBytes)
+   metrics.gauge('clients_connected', "Connected browser clients",
+                 lambda: len(tWebsocketHandler.server.clients) if tWebsocketHandler.server else 0)
+   metrics.histogram('latency_to_server_seconds', "Forwarding time client to server", LATENCY_BUCKETS)
+   metrics.histogram('latency_to_clients_seconds', "Forwarding time server to clients", LATENCY_BUCKETS)
+   metrics.histogram('message_size_bytes', "Size of received messages", SIZE_BUCKETS)
+   metrics.histogram('reconnect_seconds', "Time without tcp server connection", OUTAGE_BUCKETS)
+   # time per stage of a message (STAGE_TIMING), client to server and server to client
+   for stage, help in (('ws_read', "Websocket frame header to complete client message"),
+                       ('on_receive', "Client message handling before forwarding"),
+                       ('tcp_send', "Forwarding to tcp server: routing, cache, encoding, queueing"),
+                       ('tcp_queue', "Client messages waiting for the tcp writer"),
+                       ('tcp_write', "Socket write to tcp server"),
+                       ('tcp_read', "Tcp server data received to messages decoded"),
+                       ('dispatch', "Server message handling before sending to clients"),
+                       ('ws_send', "Websocket frame encoding and queueing for clients"),
+                       ('ws_queue', "Frames waiting in the outbound queue of a client"),
+                       ('ws_write', "Socket write to a browser client")):
+      metrics.histogram('stage_%s_seconds' % stage, help, STAGE_BUCKETS)
+   return metrics
+#  newMetrics()
+
+metrics = newMetrics()   # global
+
+def countReceived(source, message):
+   # Metrics of a message received from 'clients' or 'server'
+   metrics.inc('messages_from_%s_total' % source)
+   metrics.inc('bytes_from_%s_total' % source, len(message))
+   metrics.observe('message_size_bytes', len(message))
+   return None
+#  countReceived()
+
+def stage(name, t0):
+   # Time since t0 in the histogram of stage name (STAGE_TIMING); returns current time
+   # (t0 if STAGE_TIMING is off: no clock call)
+   if not STAGE_TIMING:
+      return t0
+   now = clock()
+   metrics.observe(name, now - t0)
+   return now
+#  stage()
+
+def observeStage(name, seconds):
+   # Stage timing of the websocket server (ws_read, ws_queue, ws_write)
+   metrics.observe('stage_%s_seconds' % name, seconds)
+   return None
+#  observeStage()
+
+def observeTls(seconds, resumed):
+   # TLS handshake of a browser client completed
+   metrics.inc('tls_handshakes_total')
+   if resumed:
+      metrics.inc('tls_resumed_total')
+   metrics.observe('tls_handshake_seconds', seconds)
+   return None
+#  observeTls()
+
+def newTlsContext():
+   # TLS context of the websocket listener, None without TLS_CERT_FILE
+   if not TLS_CERT_FILE:
+      return None
+   return make_ssl_context(TLS_CERT_FILE, TLS_KEY_FILE or None, TLS_TICKETS)
+#  newTlsContext()
+
+def tlsOptions():
+   # TLS files for workers mode (every worker makes its own context)
+   return {'tls_cert_file': TLS_CERT_FILE, 'tls_key_file': TLS_KEY_FILE, 'tls_tickets': TLS_TICKETS}
+#  tlsOptions()
+
+def countChunk(source, data, first, total):
+   # Metrics of a part of a streamed message (total: size of message if known)
+   if first:
+      metrics.inc('messages_from_%s_total' % source)
+      metrics.inc('streamed_total')
+      if total != None:
+         metrics.observe('message_size_bytes', total)
+   metrics.inc('bytes_from_%s_total' % source, len(data))
+   return None
+#  countChunk()
+
+def truncate(message):
+   # Message truncated at MAX_MSG_LEN, unless large messages are streamed
+   # (STREAM_THRESHOLD): then messages are forwarded whole
+   if STREAM_THRESHOLD or len(message) <= MAX_MSG_LEN:
+      return message
+   metrics.inc('truncated_total')
+   return message[:MAX_MSG_LEN]+'...'
+#  truncate()
+
+def newBalancer(engines, policy, size, codec):
+   # Balancer over an EnginePool per engine, with health checker.
+   # Engines down at the start are out of rotation until a probe succeeds.
+   pools = []
+   for host, port in parseEndpoints(engines, TCP_HOST):
+      pool = EnginePool(host, port, 0, POOL_MAX, codec)
+      pool.size = size
+      try:
+         pool.prewarm()
+      except:
+         pool.healthy = False
+         syslog.error("Engine at %s on port %s not available" % (host, port))
+      pools.append(pool)
+   balancer = Balancer(pools, policy, lambda client: client['address'][0])
+
+   def onChange(pool):
+      # Engine left or rejoined the rotation
+      syslog.error("Engine at %s on port %s %s" % (pool.host, pool.port, "back in rotation" if pool.healthy
+                   else "out of rotation after %d failed probes" % pool.failures))
+      if pool.healthy:
+         try:
+            pool.prewarm()
+         except:
+            pass
+
+   probe = codec.encode(toBytes(HEALTH_PROBE)) if HEALTH_PROBE else None
+   HealthChecker(balancer, HEALTH_INTERVAL, HEALTH_TIMEOUT, HEALTH_FAILS, probe, onChange).start()
+   return balancer
+#  newBalancer()
+
+def newCache(prefixes):
+   # ResponseCache for requests starting with one of prefixes
+   return ResponseCache(prefixes, CACHE_TTL, CACHE_MAX_BYTES, CACHE_MAX_ENTRIES)
+#  newCache()
+
+def cacheOptions():
+   # Options of the response cache for async and workers mode
+   return {'cache_prefixes': CACHE_PREFIXES, 'cache_ttl': CACHE_TTL,
+           'cache_max_bytes': CACHE_MAX_BYTES, 'cache_max_entries': CACHE_MAX_ENTRIES}
+#  cacheOptions()
+
+def record(direction, clientId, payload=b"", flags=0):
+   # Message recorded if the traffic recorder is on (record command, RECORD_FILE)
+   if recorder != None:
+      recorder.record(direction, clientId, payload, flags)
+   return None
+#  record()
+
+def partFlags(first, last):
+   # Record flags of a part of a streamed message
+   return FLAG_PART | (FLAG_FIRST if first else 0) | (FLAG_LAST if last else 0)
+#  partFlags()
+
+def newRecorder(path):
+   # Recorder writing to path (appended if it exists), started
+   recorder = Recorder(path, RECORD_BUFFER_MAX)
+   recorder.start()
+   syslog.info("Recording traffic to %s" % path)
+   return recorder
+#  newRecorder()
+
+def newRouter(mode):
+   # RequestRouter for routing mode 'fifo' or 'id'; None for 'broadcast'
+   if mode == 'broadcast':
+      return None
+   return RequestRouter(mode, ROUTING_ID_PATTERN, ROUTING_TIMEOUT)
+#  newRouter()
+
+class SampleFilter(logging.Filter):
+   # Passes 1 of every rate records (records of all threads counted together)
+   def __init__(self, rate):
+      logging.Filter.__init__(self)
+      self.rate = max(1, rate)
+      self.count = 0
+      self.lock = threading.Lock()
+
+   def filter(self, record):
+      with self.lock:
+         self.count += 1
+         return self.count % self.rate == 0
+# END class SampleFilter
+
+if hasattr(logging.handlers, 'QueueHandler'):
+   class DropQueueHandler(logging.handlers.QueueHandler):
+      # Records for a bounded queue; dropped (counted) if the queue is full,
+      # so a flood of messages cannot grow the memory of the bridge
+      dropped = 0
+
+      def enqueue(self, record):
+         try:
+            self.queue.put_nowait(record)
+         except Full:
+            self.dropped += 1
+   # END class DropQueueHandler
+
 def initLogging():
-   # Log names: ALERT, SYS
+   # Log names: ALERT, SYS, MSG (MSG.traffic: forwarded messages, sampled)
    # Levelnames: DEBUG, INFO, WARNING, ERROR and CRITICAL.
-   global syslog, msglog, alert
+   global syslog, msglog, trafficlog, alert, msglogListener, msglogQueue
 
    syslog = logging.getLogger('SYS')   # system logfile
    msglog = logging.getLogger('MSG')   # message logfile
+   trafficlog = logging.getLogger('MSG.traffic')   # message logfile, per message (MSGLOG_SAMPLE)
    alert  = logging.getLogger('ALERT') # console + logfile
+   if msglogListener != None:
+      msglogListener.stop()   # initLogging called again (worker process)
+      msglogListener = None
+   for log in (syslog, msglog, trafficlog, alert):
+      del log.handlers[:]
+      log.filters = []
 
    formatter1 = logging.Formatter('%(levelname)-8s: %(message)s')
    formatter2 = logging.Formatter("%(name)-6s %(levelname)-6s %(asctime)s: %(message)s")
@@ -73,7 +414,8 @@ def initLogging():
    hConsole = logging.StreamHandler()
    hConsole.setFormatter(formatter1)
    hFileSys = logging.FileHandler(filename=SYSLOG_FILE, mode='a')
-   hFileMsg = logging.FileHandler(filename=MSGLOG_FILE, mode='a')
+   hFileMsg = logging.handlers.RotatingFileHandler(filename=MSGLOG_FILE, mode='a',
+                  maxBytes=MSGLOG_MAX_BYTES, backupCount=MSGLOG_BACKUPS)
    hFileSys.setFormatter(formatter5)
    hFileMsg.setFormatter(formatter4)
 
@@ -84,11 +426,34 @@ def initLogging():
    syslog.setLevel(logging.DEBUG)
    syslog.addHandler(hFileSys)
    msglog.setLevel(logging.DEBUG)
-   msglog.addHandler(hFileMsg)
+   if MSGLOG_SAMPLE > 1:
+      trafficlog.addFilter(SampleFilter(MSGLOG_SAMPLE))   # records of MSG itself all logged
+   if hasattr(logging.handlers, 'QueueHandler'):
+      # Message logfile written by a background thread (Python 3.2+)
+      msgQueue = Queue(MSGLOG_QUEUE_MAX)
+      msglogQueue = DropQueueHandler(msgQueue)
+      msglog.addHandler(msglogQueue)
+      msglogListener = logging.handlers.QueueListener(msgQueue, hFileMsg)
+      msglogListener.start()
+   else:
+      msglog.addHandler(hFileMsg)
 
    return None
 #  initLogging()
 
+def reconnectDelay():
+   # Reconnect delays (min, max) for async and workers mode; None: no reconnect
+   return (RECONNECT_DELAY_MIN, RECONNECT_DELAY_MAX) if RECONNECT else None
+#  reconnectDelay()
+
+def clientOptions():
+   # Options of the http upgrade request, frame size, heartbeats and slow clients for async and workers mode
+   return {'handshake_timeout': HANDSHAKE_TIMEOUT, 'handshake_max_size': HANDSHAKE_MAX_SIZE,
+           'handshake_max_headers': HANDSHAKE_MAX_HEADERS, 'max_frame_size': MAX_FRAME_SIZE,
+           'ping_interval': PING_INTERVAL, 'idle_timeout': IDLE_TIMEOUT,
+           'out_buffer_max': OUT_BUFFER_MAX, 'slow_client_policy': SLOW_CLIENT_POLICY}
+#  clientOptions()
+
 def clearLogFiles():
    with open(SYSLOG_FILE, 'w'):
       pass
@@ -104,13 +469,59 @@ def showStatus():
    if mySock.sock != None:
       status.append("Tcp socket connection opened.")
       status.append("    host %s and port %s"  % (current.tcp_host, current.tcp_port))
+      status.append("    message framing: %s" % mySock.codec.name)
+   elif tReceiveHandler.isListening:
+      status.append("Tcp socket connection broken; reconnecting.")
+      status.append("    buffered: %d messages, %d bytes" % (len(mySock.pending), mySock.pendingBytes))
    else:
       status.append("Tcp socket connection closed")
    if tWebsocketHandler.server != None:
       status.append("Websocket connection opened.")
       status.append("    host %s and port %s"  % (current.ws_host, current.ws_port))
+      if tlsContext != None:
+         stats = tWebsocketHandler.server.tls_stats
+         status.append("    TLS: %d handshakes, %d resumed, %d failed, mean %.1f ms" %
+                       (stats.handshakes, stats.resumed, stats.failures,
+                        1e3 * stats.seconds / stats.handshakes if stats.handshakes else 0))
+      if DEFLATE:
+         stats = tWebsocketHandler.server.deflate_stats
+         status.append("    compression: %d messages, ratio %.2f, cpu %.3f s" %
+                       (stats.messages_out + stats.messages_in, stats.ratio(), stats.cpu_time))
+      for client in list(tWebsocketHandler.server.clients):
+         queue = client['handler'].out_queue
+         if queue is None: continue
+         status.append("    client(%d): queue %d/%d, dropped %d" %
+                       (client['id'], len(queue), queue.maxsize, queue.dropped))
    else:
       status.append("Websocket connection closed")
+   if BINARY_MODE:
+      status.append("Binary mode: tcp server messages forwarded as binary frames")
+   if STREAM_THRESHOLD:
+      status.append("Streaming: messages over %d bytes forwarded in parts" % STREAM_THRESHOLD)
+   if router != None:
+      status.append("Routing of replies %s" % router.status())
+   if cache != None:
+      status.append("Cache: %s" % cache.status())
+   if recorder != None:
+      status.append("Recording: %s" % recorder.status())
+   if msglogQueue != None and msglogQueue.dropped:
+      status.append("Message logfile: %d records dropped (queue full)" % msglogQueue.dropped)
+   if profiler != None:
+      status.append("Profiler on: %s" % profiler.status())
+   if isinstance(enginePool, Balancer):
+      status.append("Engines: %s" % enginePool.status())
+      for pool in enginePool.backends:
+         status.append("    %s:%s %s, %d outstanding, probe %s" %
+                       (pool.host, pool.port, "up" if pool.healthy else "DOWN", pool.outstanding,
+                        "%.1f ms" % (pool.probeTime * 1e3) if pool.probeTime != None else "-"))
+         status.append("        sessions: %s" % pool.status())
+   elif enginePool != None:
+      status.append("Engine pool at host %s and port %s (%s)" % (enginePool.host, enginePool.port, enginePool.codec.name))
+      status.append("    sessions: %s" % enginePool.status())
+   status.append("")
+   status.append("Metrics (also at http://<ws host>:<ws port>/metrics)")
+   for line in metrics.summary():
+      status.append("    " + line)
    print(" " + "_"*60)
    for line in status:
       print("|" + (" " + line).ljust(60) + "|")
@@ -128,14 +539,161 @@ class State:
       self.state['tcp_port'] = 27531
 # END class State 
 
+def toBytes(msg):
+   # Message text to bytes for the tcp connection (UTF-8)
+   if isinstance(msg, bytes):
+      return msg
+   return msg.encode('utf-8')
+
+class ReceiveBuffer:
+   # Reusable buffer for the stream of a tcp connection.
+   # Bytes are read with recv_into directly in a bytearray (no chunk concatenation).
+   # The codec splits the messages (see web2tcp_codecs); a partial message
+   # at the end stays in the buffer for the next read.
+   # The read size adapts to the traffic; the buffer never grows beyond maxSize.
+   # Messages larger than streamThreshold are returned in parts (StreamChunk)
+   # as they arrive; the buffer stays small.
+
+   def __init__(self, codec=None, maxSize=RECV_BUF_MAX, streamThreshold=STREAM_THRESHOLD):
+      self.codec = codec or makeCodec(TCP_CODEC, TERMINATOR)
+      self.maxSize = maxSize
+      self.readSize = RECV_READ_MIN
+      self.buf = bytearray(min(RECV_READ_MAX, maxSize))
+      self.start = 0   # begin of first unprocessed message
+      self.end = 0     # end of received data
+      self.scan = 0    # bytes before this position are searched already
+      self.need = 0    # bytes missing of next message if known (length codecs)
+      self.streamThreshold = streamThreshold
+      self.streaming = False   # delimiter codecs: in a streamed message
+      self.streamLeft = 0      # header codecs: body bytes of streamed message still to come
+
+   def makeRoom(self):
+      # Make room for the next read; returns number of bytes to read.
+      # A large message of known length is read at once.
+      pending = self.end - self.start
+      size = min(max(self.readSize, self.need), self.maxSize - pending)
+      if size <= 0:
+         raise Exception("receive exception: message larger than %d bytes" % self.maxSize)
+      if self.end + size <= len(self.buf):
+         return size
+      if self.start > 0:
+         # move partial message to begin of buffer
+         self.buf[:pending] = self.buf[self.start:self.end]
+         self.scan -= self.start
+         self.start, self.end = 0, pending
+      if self.end + size > len(self.buf):
+         newSize = min(max(2 * len(self.buf), self.end + size), self.maxSize)
+         self.buf.extend(bytearray(newSize - len(self.buf)))
+      return size
+
+   def fill(self, sock):
+      # Read available bytes from sock; returns number of bytes read
+      size = self.makeRoom()
+      view = memoryview(self.buf)[self.end:self.end + size]
+      try:
+         nbytes = sock.recv_into(view)
+      finally:
+         view.release()
+      # adapt read size: grow on full reads, shrink on small reads
+      if nbytes == self.readSize:
+         self.readSize = min(2 * self.readSize, RECV_READ_MAX)
+      elif nbytes < self.readSize // 4:
+         self.readSize = max(self.readSize // 2, RECV_READ_MIN)
+      self.end += nbytes
+      return nbytes
+
+   def messages(self):
+      # Returns list of complete messages (bytes, without framing);
+      # parts of large messages as StreamChunk
+      messages = self.codec.decode(self)
+      if self.start == self.end:
+         self.start = self.end = self.scan = 0   # buffer empty; reuse from begin
+      return messages
+
+# *** END class ReceiveBuffer ***
+
+class TcpWriter(threading.Thread):
+   # Writer thread of a tcp connection.
+   # Every message is written completely; messages queued meanwhile are written
+   # together in one scatter-gather write.
+
+   def __init__(self, sock):
+      threading.Thread.__init__(self)
+      self.daemon = True
+      self.sock = sock
+      self.pending = deque()
+      self.pendingBytes = 0
+      self.since = 0.0      # time the oldest pending message was queued
+      self.cond = threading.Condition()
+      self.error = None     # set if connection broken
+      self.stopped = False
+
+   def waitRoom(self):
+      # Blocks while TCP_WRITE_MAX bytes are pending (parts of streamed
+      # messages; memory stays bounded if the tcp-server is slow)
+      with self.cond:
+         while self.pendingBytes >= TCP_WRITE_MAX and self.error == None and not self.stopped:
+            self.cond.wait()
+
+   def put(self, data):
+      with self.cond:
+         if self.error != None:
+            raise Exception("send exception: %s" % self.error)
+         if not self.pending:
+            self.since = clock()
+         self.pending.append(data)
+         self.pendingBytes += len(data)
+         self.cond.notify_all()
+
+   def stop(self):
+      with self.cond:
+         self.stopped = True
+         self.cond.notify_all()
+
+   def unsent(self):
+      # Messages not yet taken for writing (a batch being written is not included)
+      with self.cond:
+         return list(self.pending)
+
+   def run(self):
+      while True:
+         with self.cond:
+            while not self.pending and not self.stopped:
+               self.cond.wait()
+            if self.stopped: break
+            batch = list(self.pending)
+            self.pending.clear()
+            self.pendingBytes = 0
+            since = self.since
+            self.cond.notify_all()   # room for waiting parts
+         t0 = stage('stage_tcp_queue_seconds', since)
+         try:
+            sendall_buffers(self.sock, batch)
+         except (socket.error, AttributeError):
+            with self.cond:
+               self.error = "socket tcp connection broken"
+               self.cond.notify_all()
+            break
+         stage('stage_tcp_write_seconds', t0)
+      return None
+# *** END class TcpWriter ***
+
 class MySocket:
    # Socket class
    # New since Python 2.3: sock = socket.create_connection( (host,port), timeout=10 )
    #    It will try to resolve hostname for both AF_INET and AF_INET6
    #
 
-   def __init__(self):
+   def __init__(self, codec=None):
       self.sock = None
+      self.codec = codec or makeCodec(TCP_CODEC, TERMINATOR)
+      self.buffer = ReceiveBuffer(self.codec)
+      self.writer = None
+      self.sendLock = threading.Lock()
+      self.streamLock = threading.Lock()   # held from first to last part of a streamed message
+      self.buffering = False   # True while reconnecting: messages kept in pending
+      self.pending = deque()   # messages (bytes) to send after reconnect
+      self.pendingBytes = 0
 
    def test(self, txt):
       print(txt)
@@ -143,9 +701,10 @@ class MySocket:
    def open(self):
       try:
          self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+         self.buffer = ReceiveBuffer(self.codec)
       except:
          self.sock = None
-         raise Exception("socket exception: failed to open")
+         raise socket.error("socket exception: failed to open")
       return self
    # def open(self)
 
@@ -156,69 +715,368 @@ class MySocket:
       except socket.error as msg:
          #self.sock.close()
          self.sock = None
-         raise Exception("tcp connection exception: failed to connect")
+         raise socket.error("tcp connection exception: failed to connect")
       if self.sock != None:
          self.sock.settimeout(None)  # default
+         set_socket_options(self.sock, TCP_NODELAY, SO_SNDBUF_SIZE, SO_RCVBUF_SIZE)
+         self.setQuickAck()
+         writer = TcpWriter(self.sock)
+         writer.start()
+         with self.sendLock:
+            # messages buffered while reconnecting are sent first
+            if self.pending:
+               syslog.info("Sending %d messages buffered while reconnecting" % len(self.pending))
+            while self.pending:
+               writer.put(self.pending.popleft())
+            self.pendingBytes = 0
+            self.buffering = False
+            if self.writer != None: self.writer.stop()
+            self.writer = writer
       return self
    # def connect(self)
 
-   def send999(self, imsg):
-      #sent = self.sock.send(msg)  # simple send
-      msg =  imsg + TERMINATOR
-      msgLen = len(msg)
-      totalsent = 0
-      while totalsent < msgLen:
+   def close(self, buffering=False):
+      # Connection broken or closed. With buffering, messages are kept for reconnect,
+      # including messages the writer did not take yet.
+      with self.sendLock:
+         if self.writer != None:
+            self.writer.stop()
+            if buffering:
+               for data in self.writer.unsent():
+                  self.bufferMessage(data)
+         self.writer = None
+         self.buffering = buffering
+         if self.sock != None:
+            try:
+               self.sock.close()
+            except socket.error:
+               pass
+         self.sock = None
+      return None
+   # def close(self)
+
+   def bufferMessage(self, data):
+      # Keep message for reconnect (sendLock held); raises exception if buffer full
+      if self.pendingBytes + len(data) > RECONNECT_BUFFER_MAX:
+         metrics.inc('buffer_dropped_total')
+         raise Exception("send exception: reconnecting, buffer full")
+      self.pending.append(data)
+      self.pendingBytes += len(data)
+      return None
+   # def bufferMessage(self)
+
+   def setQuickAck(self):
+      # TCP_QUICKACK is reset by the kernel; set again after every read
+      if TCP_QUICKACK and hasattr(socket, 'TCP_QUICKACK'):
          try:
-            sent = self.sock.send(msg[totalsent:])
-         except:
-            raise Exception("send exception: no tcp connection")
-            return None
-         if sent == 0:
-            raise Exception("send exception: socket tcp connection broken")
-            break
-         totalsent = totalsent + sent
-      # end while
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+         except socket.error:
+            pass
       return None
-   # def send999(self)
+   # def setQuickAck(self)
 
    def send(self, msg):
       # Send message to tcp-server
+      # Queued for the writer thread; raises exception if connection broken.
+      # While reconnecting the message is buffered.
+      # Waits while a streamed message is sent (messages are never interleaved).
+      data = self.codec.encode(toBytes(msg))
+      with self.streamLock:
+         self.put(data)
+      return None
+   # def send(self)
+
+   def put(self, data, wait=False):
+      # Queue encoded bytes for the writer thread, or buffer them while reconnecting.
+      # wait: first wait for room in the writer (parts of streamed messages)
+      writer = self.writer
+      if wait and writer != None:
+         writer.waitRoom()   # without sendLock
+      with self.sendLock:
+         if self.writer != None:
+            self.writer.put(data)
+         elif self.buffering:
+            self.bufferMessage(data)
+         else:
+            raise Exception("send exception: no tcp connection")
+      return None
+   # def put(self)
+
+   def sendChunk(self, chunk, first, last, total=None):
+      # Send part of a large message to tcp-server as it arrives (STREAM_THRESHOLD).
+      # total: size of the message if known; length codecs need it.
+      # Other messages wait from the first part until the last part is sent.
+      if first:
+         self.streamLock.acquire()
       try:
-         self.sock.send(msg + TERMINATOR)
+         data = chunk
+         if first:
+            data = self.codec.header(total) + data
+         if last:
+            data = data + self.codec.trailer()
+         self.put(data, wait=True)
       except:
-         raise Exception("send exception: no tcp connection")
+         if first:
+            self.streamLock.release()
+         else:
+            self.abortStream()
+         raise
+      if last:
+         self.streamLock.release()
       return None
-   # def send(self)
+   # def sendChunk(self)
+
+   def abortStream(self):
+      # Streamed message not completed (client left or error). Delimiter codecs
+      # end the message (tcp-server gets it truncated); with a length or header
+      # codec the stream cannot be repaired: the connection is closed (reconnect).
+      try:
+         trailer = self.codec.trailer()
+         if trailer:
+            self.put(trailer)
+         else:
+            syslog.error("Streamed message aborted; tcp connection closed")
+            self.close()
+      except:
+         pass
+      finally:
+         self.streamLock.release()
+      return None
+   # def abortStream(self)
 
    def receive(self):
       # Receive messages from tcp-socket server
-      # Chunks of the stream is concatenated until last char is the TERMINATOR
-      # The concatenated chunks contain multiple messages (but often just one)
-      # Returns list of received messages
-      recvdString = ""  # Received string
+      # Returns list of received messages (text)
+      return [msg.decode('utf-8', 'replace') for msg in self.receiveBytes()]
+   # def receive(self)
+
+   def receiveBytes(self):
+      # Receive messages from tcp-socket server
+      # The stream is read in the receive buffer until at least one complete message
+      # (see codec) is received. A partial message at the end is kept
+      # in the buffer for the next call.
+      # Returns list of received messages (bytes, not decoded)
       while True:
-         # Collect message chunks until null character found
          try:
-            chunk = self.sock.recv(1024)
-         except:
+            nbytes = self.buffer.fill(self.sock)
+         except socket.error:
+            raise Exception("receive exception: no tcp connection")
+         except AttributeError:
             raise Exception("receive exception: no tcp connection")
-            return None
 
-         if chunk == "":
+         if nbytes == 0:
             raise Exception("receive exception: socket tcp connection broken")
-            return None
-         recvdString += chunk
-         if recvdString.strip()[-1] == TERMINATOR: break   # stop if last char is TERM
-
-      #print("final received string: " + recvdString)
+         t0 = clock()
+         self.setQuickAck()
+         recvdMessages = self.buffer.messages()
+         stage('stage_tcp_read_seconds', t0)
+         if recvdMessages: break
 
-      recvdMessages = recvdString.split(TERMINATOR)
-      recvdMessages.pop()  # remove last item (is empty)
       return recvdMessages
-   # def receive(self)
+   # def receiveBytes(self)
 
 # *** END class MySocket ***
 
+class EngineSession(threading.Thread):
+   # Engine connection of the EnginePool with its own receive thread.
+   # Messages from the engine are sent only to the browser client owning the session.
+
+   def __init__(self, pool, host, port, codec=None):
+      threading.Thread.__init__(self)
+      self.daemon = True
+      self.pool = pool
+      self.client = None   # owner: websocket client (dict) or None if idle
+      self.outstanding = 0 # requests sent without reply
+      self.pendingKeys = deque()   # cache key (or None) per request without reply
+      self.sock = MySocket(codec).open().connect(host, port)
+      return None
+   # def __init__()
+
+   def send(self, msg, key=None):
+      # key: response cache key of the request (one reply per request, in order)
+      self.pendingKeys.append(key)
+      self.pool.countRequest(self, 1)   # before the reply can arrive
+      try:
+         self.sock.send(msg)
+      except:
+         self.pendingKeys.pop()
+         self.pool.countRequest(self, -1)
+         raise
+      return None
+   # def send()
+
+   def close(self):
+      # Connection shut down; the receive thread stops, closes the socket
+      # and removes the session from the pool
+      try:
+         self.sock.sock.shutdown(socket.SHUT_RDWR)
+      except (socket.error, AttributeError):
+         pass
+      return None
+   # def close()
+
+   def run(self):
+      # Handling incoming messages from the engine of this session.
+      while True:
+         try:
+            recvdMessages = self.sock.receiveBytes()   # wait for received messages
+         except:
+            break
+         t0 = clock()
+         client = self.client
+         # a streamed reply is outstanding until its last part
+         self.pool.countRequest(self, -sum(1 for message in recvdMessages
+                                     if message.__class__ is not StreamChunk or message.last))
+         for message in recvdMessages:
+            if message.__class__ is StreamChunk:
+               # part of a large message: fragment to the owner of the session
+               countChunk('server', message.data, message.first, message.total)
+               record(FROM_SERVER, client['id'] if client != None else 0, message.data,
+                      partFlags(message.first, message.last))
+               if message.first and self.pendingKeys:
+                  self.pendingKeys.popleft()   # streamed replies are not cached
+               if client != None and tWebsocketHandler.server != None:
+                  tWebsocketHandler.server.send_fragment(client, message.data,
+                     OPCODE_BINARY if BINARY_MODE else OPCODE_TEXT, message.first, message.last)
+               continue
+            tm = clock()
+            countReceived('server', message)
+            record(FROM_SERVER, client['id'] if client != None else 0, message)
+            key = self.pendingKeys.popleft() if self.pendingKeys else None
+            if key != None and cache != None:
+               cache.put(key, message)
+            if not BINARY_MODE:
+               message = truncate(message.decode('utf-8', 'replace').strip())
+            if client is None:
+               msglog.info("%-22s %s (idle session)", "server ==> bridge:", message)
+               continue
+            try:
+               tm = stage('stage_dispatch_seconds', tm)
+               if BINARY_MODE:
+                  tWebsocketHandler.send_binary(client, message)
+               else:
+                  tWebsocketHandler.send(client, message)
+               stage('stage_ws_send_seconds', tm)
+               metrics.observe('latency_to_clients_seconds', clock() - t0)
+            except:
+               metrics.inc('forward_errors_total')
+               err = sys.exc_info()[1]
+               print( "Error forwarding message to ws-client: %s" % err )
+      # end while listening
+
+      self.sock.close()
+      self.pool.discard(self)
+      syslog.error("Engine session closed; tcp connection broken")
+      return None
+   # def run()
+
+# CLASS EngineSession
+
+class EnginePool:
+   # Size-bounded pool of engine connections, pre-warmed when created.
+   # Every browser client gets its own engine session; the session is reused
+   # by a next client after the client disconnects.
+
+   def __init__(self, host, port, size=POOL_SIZE, maxSize=POOL_MAX, codec=None):
+      self.host = host
+      self.port = port
+      self.codec = codec or makeCodec(TCP_CODEC, TERMINATOR)
+      self.size = size
+      self.maxSize = max(size, maxSize)
+      self.idle = []       # sessions without client
+      self.busy = set()    # sessions owned by a client
+      self.lock = threading.Lock()
+      self.outstanding = 0 # requests sent without reply (for least_outstanding balancing)
+      self.connecting = 0  # sessions being opened by acquire (count for maxSize)
+      self.healthy = True  # in rotation of the balancer (see web2tcp_balancer)
+      self.failures = 0    # failed health probes in a row
+      self.probeTime = None
+      for i in range(size):
+         self.idle.append(self.newSession())
+      return None
+   # def __init__()
+
+   def prewarm(self):
+      # Open idle sessions up to size again (engine back after a failure)
+      while len(self.idle) < self.size and len(self.idle) + len(self.busy) + self.connecting < self.maxSize:
+         session = self.newSession()
+         with self.lock:
+            self.idle.append(session)
+      return None
+   # def prewarm()
+
+   def countRequest(self, session, delta):
+      # Requests sent (+1) and replies received (-n) by a session
+      with self.lock:
+         delta = max(delta, -session.outstanding)
+         session.outstanding += delta
+         self.outstanding += delta
+      return None
+   # def countRequest()
+
+   def newSession(self):
+      session = EngineSession(self, self.host, self.port, self.codec)
+      session.start()
+      return session
+   # def newSession()
+
+   def acquire(self, client):
+      # Returns a session for client; raises PoolExhausted if pool exhausted,
+      # socket.error if the engine cannot be reached.
+      # A new session connects outside the lock (receive threads of the
+      # other sessions count their replies meanwhile).
+      with self.lock:
+         if self.idle:
+            session = self.idle.pop()
+         elif len(self.busy) + self.connecting < self.maxSize:
+            session = None
+            self.connecting += 1
+         else:
+            raise PoolExhausted("engine pool exhausted (%d sessions)" % self.maxSize)
+      if session is None:
+         try:
+            session = self.newSession()
+         finally:
+            with self.lock:
+               self.connecting -= 1
+      with self.lock:
+         session.client = client
+         self.busy.add(session)
+      return session
+   # def acquire()
+
+   def release(self, session):
+      # Session back to pool for reuse. A session still waiting for replies
+      # is closed: the replies would reach the next client.
+      with self.lock:
+         session.client = None
+         self.busy.discard(session)
+         reuse = session.outstanding == 0 and session.sock.sock != None
+         if reuse:
+            session.pendingKeys.clear()
+            self.idle.append(session)
+      if not reuse:
+         session.close()
+      return None
+   # def release()
+
+   def discard(self, session):
+      # Remove session with broken connection from pool
+      with self.lock:
+         self.busy.discard(session)
+         if session in self.idle:
+            self.idle.remove(session)
+         self.outstanding -= session.outstanding   # no replies will come
+         session.outstanding = 0
+      return None
+   # def discard()
+
+   def status(self):
+      return "%d busy, %d idle, max %d" % (len(self.busy), len(self.idle), self.maxSize)
+   # def status()
+
+# CLASS EnginePool
+
 class WebsocketHandler(threading.Thread):
    # Subslass of Thread to handle events of the WebsocketServer.
    # To receive and send messages from/to a browser webscocket client.
@@ -228,6 +1086,8 @@ class WebsocketHandler(threading.Thread):
       self.server = None
       self.host = WS_HOST
       self.port = WS_PORT
+      self.sessions = {}   # client id => EngineSession (if enginePool is used)
+      self.streams = {}    # client id => [engine socket, info] of message being streamed
       return None
    # def __init__()
 
@@ -235,6 +1095,13 @@ class WebsocketHandler(threading.Thread):
       # Called by server for every client connecting to server (after handshake)
       # ** PRIVATE **
       print("\n" + "New client connected and was given id %d" % iClient['id'])
+      record(CLIENT_OPEN, iClient['id'])
+      if enginePool != None:
+         try:
+            self.sessions[iClient['id']] = enginePool.acquire(iClient)
+         except:
+            err = sys.exc_info()[1]
+            print( "Error acquiring engine session for client(%d): %s" % (iClient['id'], err) )
       prompt()
       ###self.server.send_message_to_all( "#Hey all, a new client has joined us" )
       ###self.server.send_message(iClient, "#ws connection opened")
@@ -245,6 +1112,10 @@ class WebsocketHandler(threading.Thread):
       # Called by server for every client disconnecting from bridge (ws-server)
       # ** PRIVATE **
       print("\n" + "Client(%d) disconnected from bridge (ws-server)" % iClient['id'])
+      record(CLIENT_CLOSE, iClient['id'])
+      session = self.sessions.pop(iClient['id'], None)
+      if session != None:
+         enginePool.release(session)
       prompt()
       return None
    # def onClientLeft()
@@ -253,12 +1124,14 @@ class WebsocketHandler(threading.Thread):
       # RECEIVE MESSAGE BY WS_SERVER FROM WS_CLIENT
       # Runs when bridge (ws-server) receives a message send by a ws-client
       # ** PRIVATE **
-      if len(iMessage) > MAX_MSG_LEN:
-         iMessage = iMessage[:MAX_MSG_LEN]+'...'
-      msg_info = "client(%d) ==> bridge:" % iClient['id']
-      msg_info = msg_info.ljust(22)  + " " + iMessage 
-      print("\n" + "Message from " + msg_info)
-      msglog.info(msg_info)
+      t0 = clock()
+      countReceived('clients', iMessage)
+      received = iMessage
+      iMessage = truncate(iMessage)
+      key, response = self.cacheLookup(iMessage)
+      record(FROM_CLIENT, iClient['id'], received.encode('utf-8'),   # payload as received
+             FLAG_CACHED if response != None else 0)
+      showMessage("client(%d) ==> bridge:" % iClient['id'], iMessage, newline=True)
 
       # Send message back from server to other clients
       # ************* TEST TEST TEST ***
@@ -272,11 +1145,16 @@ class WebsocketHandler(threading.Thread):
 
       # FORWARD MESSAGE FROM WS_CLIENT TO TCP_SERVER
       try:
-         mySock.send(iMessage)
-         msg_info = "bridge ==> server:".ljust(22) + " " + iMessage
-         print( "Message from " + msg_info )
-         msglog.info(msg_info)
+         t1 = stage('stage_on_receive_seconds', t0)
+         if response != None:
+            self.answerFromCache(iClient, response)
+         else:
+            self.forward(iClient, iMessage, key)
+            stage('stage_tcp_send_seconds', t1)
+            metrics.observe('latency_to_server_seconds', clock() - t0)
+            showMessage("bridge ==> server:", iMessage)
       except:
+         metrics.inc('forward_errors_total')
          err = sys.exc_info()[1]
          print( "Error forwarding message to tcp-server: %s" % err )
 
@@ -284,31 +1162,223 @@ class WebsocketHandler(threading.Thread):
       return None
    # def onReceive()
 
+   def onReceiveBinary(self, iClient, iServer, iData):
+      # RECEIVE BINARY MESSAGE BY WS_SERVER FROM WS_CLIENT
+      # Forwarded to the tcp-server as is (no decoding, no truncation)
+      # ** PRIVATE **
+      t0 = clock()
+      countReceived('clients', iData)
+      key, response = self.cacheLookup(iData)
+      record(FROM_CLIENT, iClient['id'], iData, FLAG_BINARY | (FLAG_CACHED if response != None else 0))
+      info = "<binary %d bytes>" % len(iData)
+      showMessage("client(%d) ==> bridge:" % iClient['id'], info, newline=True)
+      try:
+         t1 = stage('stage_on_receive_seconds', t0)
+         if response != None:
+            self.answerFromCache(iClient, response)
+         else:
+            self.forward(iClient, iData, key)
+            stage('stage_tcp_send_seconds', t1)
+            metrics.observe('latency_to_server_seconds', clock() - t0)
+            showMessage("bridge ==> server:", info)
+      except:
+         metrics.inc('forward_errors_total')
+         err = sys.exc_info()[1]
+         print( "Error forwarding message to tcp-server: %s" % err )
+
+      prompt()
+      return None
+   # def onReceiveBinary()
+
+   def onStreamReceived(self, iClient, iServer, iOpcode, iChunk, iFirst, iLast, iTotal):
+      # RECEIVE PART OF A LARGE MESSAGE BY WS_SERVER FROM WS_CLIENT (STREAM_THRESHOLD)
+      # Forwarded to the tcp-server as it arrives; never truncated.
+      # ** PRIVATE **
+      t0 = clock()
+      clientId = iClient['id']
+      countChunk('clients', iChunk, iFirst, iTotal)
+      record(FROM_CLIENT, clientId, iChunk,
+             partFlags(iFirst, iLast) | (FLAG_BINARY if iOpcode == OPCODE_BINARY else 0))
+      if iFirst:
+         info = "<%s message of %s bytes, streamed>" % ('binary' if iOpcode == OPCODE_BINARY else 'text',
+                                                        iTotal if iTotal != None else 'unknown')
+         showMessage("client(%d) ==> bridge:" % clientId, info, newline=True)
+         try:
+            sock = self.engineSocket(iClient)
+         except:
+            metrics.inc('forward_errors_total')
+            print( "Error forwarding message to tcp-server: %s" % sys.exc_info()[1] )
+            return None
+         if router != None and enginePool == None:
+            router.request(clientId, iChunk)   # id in the first part
+         self.streams[clientId] = [sock, info]
+      stream = self.streams.get(clientId)
+      if stream == None:
+         return None   # stream failed; rest of the message dropped
+      try:
+         stream[0].sendChunk(iChunk, iFirst, iLast, iTotal)
+      except:
+         del self.streams[clientId]
+         metrics.inc('forward_errors_total')
+         err = sys.exc_info()[1]
+         print( "Error forwarding message to tcp-server: %s" % err )
+         return None
+      if iLast:
+         del self.streams[clientId]
+         metrics.observe('latency_to_server_seconds', clock() - t0)
+         showMessage("bridge ==> server:", stream[1])
+         prompt()
+      return None
+   # def onStreamReceived()
+
+   def onStreamAborted(self, iClient, iServer):
+      # Client left in the middle of a streamed message
+      # ** PRIVATE **
+      stream = self.streams.pop(iClient['id'], None)
+      if stream != None:
+         syslog.error("Client(%d) left while streaming; message to tcp-server aborted" % iClient['id'])
+         stream[0].abortStream()
+      return None
+   # def onStreamAborted()
+
+   def engineSocket(self, iClient):
+      # Tcp connection for messages of client: own engine session or the shared one
+      if enginePool != None:
+         return self.engineSession(iClient).sock
+      return mySock
+   # def engineSocket()
+
+   def engineSession(self, iClient):
+      # Own engine session of client. A broken session is replaced by a new
+      # one (with the engines command: on an engine in rotation).
+      session = self.sessions.get(iClient['id'])
+      if session == None or session.sock.sock == None:
+         if session != None:
+            metrics.inc('engine_failovers_total')
+            syslog.error("Engine session of client(%d) broken; new session" % iClient['id'])
+         try:
+            session = enginePool.acquire(iClient)
+         except:
+            self.sessions.pop(iClient['id'], None)
+            raise Exception("no engine session for client: %s" % sys.exc_info()[1])
+         self.sessions[iClient['id']] = session
+      return session
+   # def engineSession()
+
+   def cacheLookup(self, iMessage):
+      # Response cache key of a client request and the cached response:
+      # (None, None) if not cacheable, (key, None) if not cached
+      if cache == None or (enginePool == None and router == None):
+         return None, None
+      key = cache.key(iMessage)
+      if key == None:
+         return None, None
+      response = cache.get(key)
+      metrics.inc('cache_hits_total' if response != None else 'cache_misses_total')
+      return key, response
+   # def cacheLookup()
+
+   def forward(self, iClient, iMessage, key=None):
+      # Send message of client to tcp-server
+      # Own engine session of the client if the engine pool is used
+      # key: response cache key of the request (see cacheLookup)
+      if enginePool != None:
+         self.engineSession(iClient).send(iMessage, key)
+      elif router != None:
+         # remember the request before the reply can arrive
+         entry = router.request(iClient['id'], iMessage, key)
+         try:
+            mySock.send(iMessage)
+         except:
+            router.cancel(entry)
+            raise
+      else:
+         mySock.send(iMessage)
+      return None
+   # def forward()
+
+   def answerFromCache(self, iClient, iResponse):
+      # Cached response of tcp-server sent to client as if forwarded
+      if BINARY_MODE:
+         showMessage("bridge(cache) ==> client(%d):" % iClient['id'], "<binary %d bytes>" % len(iResponse))
+         self.server.send_binary(iClient, iResponse)
+      else:
+         message = truncate(iResponse.decode('utf-8', 'replace').strip())
+         showMessage("bridge(cache) ==> client(%d):" % iClient['id'], message)
+         self.server.send_message(iClient, message)
+      return None
+   # def answerFromCache()
+
    def send(self, iClient, iMessage):
-      # Send message to client iClient. NOT USED (send_to_all USED)
-      msg_info = "bridge ==> client(%d):".ljust(22) +  " " + iMessage  % iClient['id']
-      print("\n" + "Message from " + msg_info)
+      # Send message to client iClient. Used for engine sessions of the pool.
+      showMessage("bridge ==> client(%d):" % iClient['id'], iMessage, newline=True)
       prompt()
-      msglog.info(msg_info)
       self.server.send_message(iClient, iMessage)
       return None
    # def send()
 
+   def onHttpRequest(self, iPath):
+      # Plain http request on the websocket port; serves the metrics
+      # ** PRIVATE **
+      if iPath.split('?')[0] == '/metrics':
+         return ('text/plain; version=0.0.4', metrics.text())
+      return None
+   # def onHttpRequest()
+
    def send_to_all(self, iMessage):
       # Send message to all connected clients Use it for calls from outside.
       self.server.send_message_to_all(iMessage)
       return None
    # def send_to_all()
 
+   def send_binary(self, iClient, iData):
+      # Send bytes in a binary frame to client iClient
+      showMessage("bridge ==> client(%d):" % iClient['id'], "<binary %d bytes>" % len(iData))
+      self.server.send_binary(iClient, iData)
+      return None
+   # def send_binary()
+
+   def send_binary_to_all(self, iData):
+      # Send bytes in a binary frame to all connected clients
+      self.server.send_binary_to_all(iData)
+      return None
+   # def send_binary_to_all()
+
    def run(self):
       # Handling events, sending and receiving messages of websocket server.
       # Executes when thread started. Overriding python threading.Thread.run()
       # Exception handling is annoying for the start of a thread. Leave it as.
       # ** PRIVATE **
       self.server = WebsocketServer(self.port, self.host)
+      self.server.out_queue_size = OUT_QUEUE_SIZE
+      self.server.slow_consumer_policy = SLOW_CLIENT_POLICY
+      self.server.tcp_nodelay = TCP_NODELAY
+      self.server.sndbuf_size = SO_SNDBUF_SIZE
+      self.server.rcvbuf_size = SO_RCVBUF_SIZE
+      self.server.handshake_timeout = HANDSHAKE_TIMEOUT
+      self.server.handshake_max_size = HANDSHAKE_MAX_SIZE
+      self.server.handshake_max_headers = HANDSHAKE_MAX_HEADERS
+      self.server.ping_interval = PING_INTERVAL
+      self.server.idle_timeout = IDLE_TIMEOUT
+      self.server.max_frame_size = MAX_FRAME_SIZE
+      self.server.max_message_size = MAX_MESSAGE_SIZE
+      self.server.stream_threshold = STREAM_THRESHOLD
+      self.server.stream_chunk_size = STREAM_CHUNK_SIZE
+      self.server.stream_read_timeout = STREAM_READ_TIMEOUT
+      self.server.deflate = DEFLATE
+      self.server.deflate_context_takeover = DEFLATE_CONTEXT_TAKEOVER
+      self.server.deflate_window_bits = DEFLATE_WINDOW_BITS
+      self.server.deflate_min_size = DEFLATE_MIN_SIZE
+      self.server.stage_timer = observeStage if STAGE_TIMING else None
+      self.server.ssl_context = tlsContext
+      self.server.tls_timer = observeTls
       self.server.set_fn_new_client(self.onClientNew)
       self.server.set_fn_client_left(self.onClientLeft)
       self.server.set_fn_message_received(self.onReceive)
+      self.server.set_fn_binary_received(self.onReceiveBinary)
+      self.server.set_fn_http_request(self.onHttpRequest)
+      self.server.set_fn_stream_received(self.onStreamReceived)
+      self.server.set_fn_stream_aborted(self.onStreamAborted)
       self.server.run_forever()   # WAIT...
       return self.server
    # def run(self)
@@ -321,7 +1391,7 @@ def runConsoleHandler(stack):
    syslog.info("Application started")
    msglog.info("Application started")
 
-   global mySock, lock
+   global mySock, lock, enginePool, tReceiveHandler, router, cache, recorder, profiler, BINARY_MODE
    while True:
       if len(stack) > 0:
          comm = stack.pop()
@@ -333,6 +1403,10 @@ def runConsoleHandler(stack):
       if comm.lower().startswith('q'):  # quit
          syslog.info("Application terminated by user " )
          msglog.info("Application terminated by user " )
+         if msglogListener != None:
+            msglogListener.stop()   # flush queued messages to logfile
+         if recorder != None:
+            recorder.stop()   # write recorded messages
          os._exit(1)   # does no cleanups
 
       elif comm.lower().startswith('h') or comm.startswith('?'):
@@ -366,6 +1440,8 @@ def runConsoleHandler(stack):
             tWebsocketHandler.start()   # exec run() of thread
             ###print( "xxx Websocket server started xxx " )
             info_txt = "Listening at %s on port %s for messages from browser clients ..." %(host,port)
+            if tlsContext != None:
+               info_txt += " (TLS, wss://)"
             msglog.info(info_txt)
             syslog.info( "Websocket server started at %s on port %s" %(host,port) )
             current.ws_host = host
@@ -381,14 +1457,16 @@ def runConsoleHandler(stack):
             print("Already connected")
             continue
          if tReceiveHandler.isListening:
-            print("Receivehandler already listening; first restart application to connect")
+            print("Reconnecting to tcp-server at %s on port %s; please wait" % (current.tcp_host, current.tcp_port))
             continue
 
-         host, port = TCP_HOST, TCP_PORT  # default
+         host, port, codec = TCP_HOST, TCP_PORT, TCP_CODEC  # default
          words = comm.split()
          if len(words) == 2: _,host = words
          if len(words) == 3: _,host,port = words
+         if len(words) == 4: _,host,port,codec = words
          try :
+            mySock.codec = makeCodec(codec, TERMINATOR)
             mySock.open()
             mySock.connect(host, int(port))  # with timeout
             info_txt = "Listening at %s on port %s for messages from server ..." %(host,port)
@@ -405,8 +1483,145 @@ def runConsoleHandler(stack):
             continue
 
          if mySock.sock != None:  # check connected
-            # prevent starting receivehandler twice
-            if not tReceiveHandler.isListening: tReceiveHandler.start()
+            # prevent starting receivehandler twice; new thread after a stopped one
+            if not tReceiveHandler.is_alive():
+               if tReceiveHandler.ident != None: tReceiveHandler = ReceiveHandler()
+               tReceiveHandler.start()
+
+      elif comm.lower().startswith('binary'):
+         # *** binary pass-through of tcp-server messages on/off ***
+         words = comm.split()
+         if len(words) == 2: BINARY_MODE = (words[1].lower() == 'on')
+         print("Binary mode %s" % ("on" if BINARY_MODE else "off"))
+         syslog.info("Binary mode %s" % ("on" if BINARY_MODE else "off"))
+
+      elif comm.lower().startswith('route'):
+         # *** tcp-server replies to requesting client or to all clients ***
+         words = comm.split()
+         if len(words) == 2:
+            try:
+               router = newRouter(words[1].lower())
+            except ValueError as err:
+               print("Error: %s" % err)
+               continue
+         print("Routing of tcp server messages: %s" % (router.status() if router else "broadcast"))
+         syslog.info("Routing %s" % (router.mode if router else "broadcast"))
+
+      elif comm.lower().startswith('cache'):
+         # *** response cache: cache on <prefix> <prefix> .. | off | clear ***
+         words = comm.split()
+         if len(words) >= 2 and words[1].lower() == 'on':
+            prefixes = words[2:] or CACHE_PREFIXES
+            cache = newCache(prefixes)
+            print("Response cache on for requests starting with: %s" % " ".join(prefixes))
+            if router == None and enginePool == None:
+               print("Note: the cache needs route fifo|id or engine sessions (pool, engines)")
+         elif len(words) >= 2 and words[1].lower() == 'off':
+            cache = None
+            print("Response cache off")
+         elif len(words) >= 2 and words[1].lower() == 'clear':
+            if cache != None: cache.clear()
+            print("Response cache cleared")
+         else:
+            print("Response cache: %s" % (cache.status() if cache != None else "off"))
+         syslog.info("Command %s" % comm.strip())
+
+      elif comm.lower().startswith('record'):
+         # *** traffic recording: record on <file> | off ***
+         words = comm.split()
+         if len(words) >= 2 and words[1].lower() == 'on':
+            if recorder != None:
+               recorder.stop()
+            try:
+               recorder = newRecorder(words[2] if len(words) > 2 else RECORD_FILE or 'web2tcp_traffic.rec')
+            except (IOError, OSError) as err:
+               recorder = None
+               print("Error: %s" % err)
+               continue
+            print("Recording traffic to %s" % recorder.path)
+         elif len(words) >= 2 and words[1].lower() == 'off':
+            if recorder != None:
+               recorder.stop()
+               print("Recording stopped: %s" % recorder.status())
+            recorder = None
+         else:
+            print("Recording: %s" % (recorder.status() if recorder != None else "off"))
+         syslog.info("Command %s" % comm.strip())
+
+      elif comm.lower().startswith('profile'):
+         # *** profiler: profile on [sample [<ms>]|cprofile] | off [<file>] ***
+         words = comm.split()
+         if len(words) >= 2 and words[1].lower() == 'on':
+            if profiler != None:
+               print("Profiler already on: %s" % profiler.status())
+               continue
+            kind = words[2].lower() if len(words) > 2 else 'sample'
+            try:
+               interval = float(words[3]) / 1000.0 if len(words) > 3 else PROFILE_INTERVAL
+               profiler = newProfiler(kind, interval)
+            except ValueError as err:
+               print("Error: %s" % err)
+               continue
+            print("Profiler on: %s" % profiler.status())
+         elif len(words) >= 2 and words[1].lower() == 'off':
+            if profiler == None:
+               print("Profiler not on")
+               continue
+            profiler.stop()
+            path = words[2] if len(words) > 2 else \
+                   PROFILE_FILE + ('.txt' if profiler.kind == 'sample' else '.pstats')
+            try:
+               profiler.dump(path)
+               print("Profile of %.1f s written to %s" % (profiler.elapsed, path))
+            except (IOError, OSError) as err:
+               print("Error writing profile: %s" % err)
+            lock.acquire()   # LOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCK
+            print("\n".join(profiler.report(10).splitlines()[:14]))
+            lock.release()   # LOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCK
+            profiler = None
+         else:
+            print("Profiler: %s" % (profiler.status() if profiler != None else "off"))
+         syslog.info("Command %s" % comm.strip())
+
+      elif comm.lower().startswith('pool'):
+         # *** per-client engine sessions from a pool of tcp connections ***
+         if enginePool != None:
+            print("Engine pool already created")
+            continue
+         host, port, size, codec = TCP_HOST, TCP_PORT, POOL_SIZE, TCP_CODEC  # default
+         words = comm.split()
+         if len(words) == 2: _,host = words
+         if len(words) == 3: _,host,port = words
+         if len(words) == 4: _,host,port,size = words
+         if len(words) == 5: _,host,port,size,codec = words
+         try:
+            enginePool = EnginePool(host, int(port), int(size), POOL_MAX, makeCodec(codec, TERMINATOR))
+            print("Engine pool created: %s" % enginePool.status())
+            syslog.info( "Engine pool created at %s on port %s: %s" %(host, port, enginePool.status()) )
+         except:
+            err = sys.exc_info()[1]
+            print( "Error trying to create engine pool: %s" % err )
+            continue
+
+      elif comm.lower().startswith('engines'):
+         # *** per-client engine sessions spread over equivalent engines ***
+         if enginePool != None:
+            print("Engine pool already created")
+            continue
+         engines, policy, size, codec = ENGINES, BALANCE_POLICY, POOL_SIZE, TCP_CODEC  # default
+         words = comm.split()
+         if len(words) >= 2: engines = words[1]
+         if len(words) >= 3: policy = words[2]
+         if len(words) >= 4: size = words[3]
+         if len(words) >= 5: codec = words[4]
+         try:
+            enginePool = newBalancer(engines, policy, int(size), makeCodec(codec, TERMINATOR))
+            print("Engines: %s" % enginePool.status())
+            syslog.info("Engines %s: %s" % (engines, enginePool.status()))
+         except:
+            err = sys.exc_info()[1]
+            print( "Error trying to create engine balancer: %s" % err )
+            continue
 
       elif comm.lower().startswith('chats'):
          # *** outgoing CHAT message to TCP_Server ***
@@ -418,9 +1633,7 @@ def runConsoleHandler(stack):
             syslog.info("Send chat message to tcp_server: %s" %comm.strip() )
             try:
                mySock.send(msg)
-               msg_info = "bridge(*) ==> server:".ljust(22) + " " + msg
-               print("Message from " + msg_info)
-               msglog.info(msg_info)
+               showMessage("bridge(*) ==> server:", msg)
                syslog.info("Send chat message to server: %s" %comm.strip() )
             except:
                err = sys.exc_info()[1]
@@ -440,9 +1653,7 @@ def runConsoleHandler(stack):
             msg = msg.strip()            # trim whitespace
             try:
                tWebsocketHandler.send_to_all(msg)
-               msg_info = "bridge(*) ==> clients:".ljust(22) + " " + msg
-               print("Message from " + msg_info)
-               msglog.info(msg_info)
+               showMessage("bridge(*) ==> clients:", msg)
                syslog.info("Send chat message to clients: %s" %comm.strip() )
             except:
                err = sys.exc_info()[1]
@@ -498,9 +1709,40 @@ def printHelp():
    help.append("                  start websocket server" )
    help.append("                  default host %s and port %s " %(WS_HOST, WS_PORT) )
    help.append("")
-   help.append("connect <host> <port>: " )
+   help.append("connect <host> <port> <codec>: " )
    help.append("                  connect to tcp server " )
    help.append("                  default host %s and port %s "  %(TCP_HOST, TCP_PORT) )
+   help.append("                  codec: null, newline, length2, length4 or " )
+   help.append("                  header:<size>:<offset>:<length size> " )
+   help.append("                  (default %s) " % TCP_CODEC )
+   help.append("")
+   help.append("engines <host:port,..> <policy> <size> <codec>: " )
+   help.append("                  sessions spread over equivalent engines; " )
+   help.append("                  policy round_robin, least_outstanding or " )
+   help.append("                  sticky (default %s) " % BALANCE_POLICY )
+   help.append("pool <host> <port> <size> <codec>: " )
+   help.append("                  own tcp server connection per browser client " )
+   help.append("                  from a pool of <size> connections (default %s) " % POOL_SIZE )
+   help.append("")
+   help.append("binary on|off:    forward tcp server messages as binary frames " )
+   help.append("route broadcast|fifo|id: " )
+   help.append("                  tcp server replies to all clients or to the " )
+   help.append("                  client of the request (default %s) " % ROUTING )
+   help.append("")
+   help.append("cache on <prefix> ..|off|clear: " )
+   help.append("                  answer repeated requests starting with a " )
+   help.append("                  prefix from the response cache " )
+   help.append("")
+   help.append("record on <file>|off: " )
+   help.append("                  record all messages to a binary file for " )
+   help.append("                  replay (test/replay_traffic.py) " )
+   help.append("")
+   help.append("profile on [sample [<ms>]|cprofile]: " )
+   help.append("                  profile the running bridge: stack samples " )
+   help.append("                  of all threads or cProfile (Python 3.12+) " )
+   help.append("profile off [<file>]: " )
+   help.append("                  stop profiling, write result to <file> " )
+   help.append("                  (default %s.txt or .pstats) " % PROFILE_FILE )
    help.append("")
    help.append("chatS <msg>:      send chat message to tcp server " )
    help.append("chatC <msg>:      send chat message to all browser clients " )
@@ -519,6 +1761,9 @@ class ReceiveHandler(threading.Thread):
    def __init__(self):
       threading.Thread.__init__(self)
       self.isListening = False
+      self.streaming = False    # in the middle of a streamed message of tcp-server
+      self.streamClients = []   # clients that get the streamed message
+      self.streamClientId = None   # client of a routed streamed message (None: all clients)
 
    def run(self):
       # Handling incoming messages from socket server.
@@ -530,36 +1775,75 @@ class ReceiveHandler(threading.Thread):
       syslog.info("Starts listening to TCP socket server" )
       while True:
          try:
-            recvdMessages = mySock.receive()   # wait for received messages
+            recvdMessages = mySock.receiveBytes()   # wait for received messages
          except:
             err = sys.exc_info()[1]
             print( "Error %s" % err )
+            if RECONNECT and self.reconnect():
+               continue
             break
 
          # RECEIVE MESSAGE BY BRIDGE (TCP_CLIENT) FROM TCP_SERVER
+         t0 = clock()
          lock.acquire()   # LOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCK
 
          for message in recvdMessages:
-            # Use strip to remove all whitespace at the start and end of a message.
-            # Including spaces, tabs, newlines and carriage returns.
-            message = message.strip()
-            if len(message) > MAX_MSG_LEN:
-               message = message[:MAX_MSG_LEN]+'...'   # truncate
+            if message.__class__ is StreamChunk:
+               # parts may wait for room in the queues of slow clients: not under the lock
+               lock.release()   # LOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCK
+               self.forwardChunk(message)
+               lock.acquire()   # LOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCKLOCK
+               continue
+            tm = clock()
+            countReceived('server', message)
+            client = None   # None: to all clients
+            clientId = None
+            if router != None:
+               clientId, key = router.replyWithKey(message)
+               if key != None and cache != None:
+                  cache.put(key, message)
+            record(FROM_SERVER, clientId or 0, message)
+            if clientId != None:
+               client = tWebsocketHandler.server.id_to_client(clientId) if tWebsocketHandler.server else None
+               if client == None:
+                  metrics.inc('replies_dropped_total')
+                  msglog.info("%-22s client(%d) disconnected; reply dropped", "server ==> bridge:", clientId)
+                  continue
+            if BINARY_MODE:
+               # pass-through: bytes forwarded as binary frame
+               info = "<binary %d bytes>" % len(message)
+               sendToClients = tWebsocketHandler.send_binary_to_all
+            else:
+               # Use strip to remove all whitespace at the start and end of a message.
+               # Including spaces, tabs, newlines and carriage returns.
+               message = truncate(message.decode('utf-8', 'replace').strip())
+               info = message
+               sendToClients = tWebsocketHandler.send_to_all
 
-            msg_info = "server ==> bridge:".ljust(22) + " " + message
-            print("\n" + "Message from " + msg_info)
-            msglog.info(msg_info)
+            showMessage("server ==> bridge:", info, newline=True)
 
             # FORWARD MESSAGE FROM TCP_SERVER TO WS_CLIENT
             if tWebsocketHandler.server == None:
+               metrics.inc('forward_errors_total')
                print("Error forwarding message: websocket server not started")
             else:
                try:
-                  tWebsocketHandler.send_to_all(message)   # to all ws-clients
-                  msg_info = "bridge ==> clients:".ljust(22) + " " + message
-                  print("Message from " + msg_info)
-                  msglog.info(msg_info)
+                  tm = stage('stage_dispatch_seconds', tm)
+                  if client != None:
+                     # reply to the requesting client only
+                     if BINARY_MODE:
+                        tWebsocketHandler.send_binary(client, message)
+                     else:
+                        tWebsocketHandler.send(client, message)
+                     stage('stage_ws_send_seconds', tm)
+                     metrics.inc('replies_routed_total')
+                  else:
+                     sendToClients(message)   # to all ws-clients
+                     stage('stage_ws_send_seconds', tm)
+                     showMessage("bridge ==> clients:", info)
+                  metrics.observe('latency_to_clients_seconds', clock() - t0)
                except:
+                  metrics.inc('forward_errors_total')
                   err = sys.exc_info()[1]
                   print( "Error forwarding message to ws-client: %s" % err )
 
@@ -568,13 +1852,80 @@ class ReceiveHandler(threading.Thread):
       # end while listening
 
       self.isListening = False
-      mySock.sock = None
+      mySock.close()
       syslog.error("Listening to tcp-server stopped; tcp connection broken")
       print("Tcp connection broken; receiving messages from server stopped. ")
       prompt()
       return None
    # def run(self)
 
+   def forwardChunk(self, chunk):
+      # Part of a large message of tcp-server (STREAM_THRESHOLD): forwarded as
+      # a websocket fragment as it arrives. Routing by the first part; clients
+      # connecting meanwhile do not get the rest of the message.
+      t0 = clock()
+      countChunk('server', chunk.data, chunk.first, chunk.total)
+      if chunk.first:
+         self.streamClientId = router.reply(chunk.data) if router != None else None   # id in the first part
+      record(FROM_SERVER, self.streamClientId or 0, chunk.data, partFlags(chunk.first, chunk.last))
+      server = tWebsocketHandler.server
+      if server == None:
+         metrics.inc('forward_errors_total')
+         print("Error forwarding message: websocket server not started")
+         return None
+      if chunk.first:
+         showMessage("server ==> bridge:", "<message of %s bytes, streamed>" %
+                     (chunk.total if chunk.total != None else 'unknown'), newline=True)
+         self.streamClients = list(server.clients)
+         if self.streamClientId != None:
+            client = server.id_to_client(self.streamClientId)
+            self.streamClients = [client] if client != None else []
+            metrics.inc('replies_routed_total' if client != None else 'replies_dropped_total')
+      self.streaming = not chunk.last
+      try:
+         server.send_fragment_to_all(chunk.data, OPCODE_BINARY if BINARY_MODE else OPCODE_TEXT,
+                                     chunk.first, chunk.last, self.streamClients)
+         if chunk.last:
+            metrics.observe('latency_to_clients_seconds', clock() - t0)
+      except:
+         metrics.inc('forward_errors_total')
+         err = sys.exc_info()[1]
+         print( "Error forwarding message to ws-client: %s" % err )
+      return None
+   # def forwardChunk(self)
+
+   def reconnect(self):
+      # Reconnect to tcp-server after a broken connection. Messages of clients are
+      # buffered meanwhile (RECONNECT_BUFFER_MAX) and sent after reconnect.
+      # Delay between attempts: exponential backoff with jitter.
+      # Returns True if reconnected (tries until success).
+      if self.streaming:
+         self.forwardChunk(StreamChunk(b"", False, True))   # clients get the message truncated
+      mySock.close(buffering=True)
+      host, port = current.tcp_host, int(current.tcp_port)
+      syslog.error("Tcp connection broken; reconnecting to %s on port %s" % (host, port))
+      print("Tcp connection broken; reconnecting to tcp-server at %s on port %s ..." % (host, port))
+      prompt()
+      t0 = clock()
+      delay = RECONNECT_DELAY_MIN
+      while True:
+         time.sleep(delay * random.uniform(0.5, 1.0))   # jitter: no reconnect storm of bridges
+         try:
+            mySock.open()
+            mySock.connect(host, port)
+            break
+         except:
+            mySock.sock = None
+            delay = min(delay * 2, RECONNECT_DELAY_MAX)
+      outage = clock() - t0
+      metrics.inc('server_reconnects_total')
+      metrics.observe('reconnect_seconds', outage)
+      syslog.info("Bridge reconnected to tcp-server at %s on port %s after %.1f s" % (host, port, outage))
+      print("\nReconnected to tcp-server after %.1f s" % outage)
+      prompt()
+      return True
+   # def reconnect(self)
+
 # CLASS ReceiveHandler
 
 if __name__ == '__main__':
@@ -586,15 +1937,56 @@ if __name__ == '__main__':
    lock = threading.Lock() # global
    initLogging()           # globals: syslog
    current = State()       # global
+   enginePool = None       # global, EnginePool if per-client engine sessions used
+   router = newRouter(ROUTING)  # global, RequestRouter if replies go to requesting client
+   cache = newCache(CACHE_PREFIXES) if CACHE_PREFIXES else None  # global, ResponseCache
+   recorder = newRecorder(RECORD_FILE) if RECORD_FILE else None  # global, Recorder
+   profiler = None         # global, profiler of the profile command
+   try:
+      tlsContext = newTlsContext()   # global, ssl.SSLContext of the websocket listener (wss://)
+   except (IOError, OSError, ValueError) as err:
+      print("Error loading TLS certificate %s: %s" % (TLS_CERT_FILE, err))
+      sys.exit(1)
 
    # use 2 threads to simultaneous websocket and tcp-socket traffic
    tReceiveHandler = ReceiveHandler()   # Thread subclass instance. Start when connected.
    tWebsocketHandler = WebsocketHandler() 
 
+   if len(sys.argv) == 4:
+      # optional websocket and tcp port after the mode argument
+      WS_PORT, TCP_PORT = int(sys.argv[2]), int(sys.argv[3])
+      del sys.argv[2:]
+
    if len(sys.argv) == 2:
       arg1, arg2 = sys.argv   # script arguments
       if arg2 == "auto":
          runConsoleHandler(["start", "connect"])
+      elif arg2 == "headless":
+         # as auto, without console output per message
+         HEADLESS = True
+         runConsoleHandler(["start", "connect"])
+      elif arg2 == "async":
+         # asyncio serving mode: one event loop instead of thread per client
+         from web2tcp_asyncbridge import runAsyncBridge
+         runAsyncBridge(WS_HOST, WS_PORT, TCP_HOST, TCP_PORT,
+                        codec=makeCodec(TCP_CODEC, TERMINATOR), max_msg_len=MAX_MSG_LEN, metrics=metrics,
+                        router=router, cache=cache, recorder=recorder, ssl_context=tlsContext,
+                        reconnect=reconnectDelay(), buffer_max=RECONNECT_BUFFER_MAX, recv_max=RECV_BUF_MAX,
+                        **clientOptions())
+         if recorder != None:
+            recorder.stop()
+      elif arg2 == "workers":
+         # worker processes sharing the websocket port (SO_REUSEPORT)
+         from web2tcp_workers import runWorkers
+         MSGLOG_MAX_BYTES = 0   # logfiles shared by workers: no rotation
+         if recorder != None:
+            recorder.stop()
+            print("Recording of traffic not available in workers mode")
+         runWorkers(WORKERS, WS_HOST, WS_PORT, TCP_HOST, TCP_PORT, initLogging, newMetrics,
+                    codec=makeCodec(TCP_CODEC, TERMINATOR), max_msg_len=MAX_MSG_LEN,
+                    routing=ROUTING, routing_id_pattern=ROUTING_ID_PATTERN, routing_timeout=ROUTING_TIMEOUT,
+                    reconnect=reconnectDelay(), buffer_max=RECONNECT_BUFFER_MAX, recv_max=RECV_BUF_MAX,
+                    **dict(clientOptions(), **dict(cacheOptions(), **tlsOptions())))
    else:
          runConsoleHandler([])
    # ================================================================================
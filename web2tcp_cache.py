@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""
+|===================================================================================
+| Web2Tcp: cache of tcp server responses                                            |
+|===================================================================================
+| Browser clients often send the tcp server byte-identical requests (the same
+| position, the same setup command). With a ResponseCache the bridge answers a
+| repeated request from memory, without the tcp server.
+|
+| Only requests starting with one of the configured prefixes are cached: the
+| tcp server must give the same answer to the same request (idempotent).
+| A response is paired with its request like routing does (one reply per
+| request, in order of the requests or by id), so the cache needs a routing
+| mode fifo or id, or an own engine session per client.
+|
+| Eviction: least recently used entry first if maxEntries or maxBytes is
+| exceeded; entries older than ttl seconds are not used.
+====================================================================================
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+ENTRY_OVERHEAD = 120   # bytes per entry for dict, tuple and bytes objects (estimate)
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+class ResponseCache:
+   # LRU cache: request (bytes) => response (bytes) with time to live and memory bound
+
+   def __init__(self, prefixes, ttl=60.0, maxBytes=16777216, maxEntries=10000):
+      self.prefixes = tuple(prefix.encode('utf-8') if not isinstance(prefix, bytes) else prefix
+                            for prefix in prefixes)
+      self.ttl = ttl               # seconds; 0: no expiry
+      self.maxBytes = maxBytes
+      self.maxEntries = maxEntries
+      self.entries = OrderedDict() # key => (response, time stored), least recently used first
+      self.bytes = 0
+      self.lock = threading.Lock()
+      self.hits = 0
+      self.misses = 0
+      self.evicted = 0
+
+   def key(self, message):
+      # Cache key of a request (str or bytes); None if it may not be cached
+      if not isinstance(message, bytes):
+         message = message.encode('utf-8')
+      return message if message.startswith(self.prefixes) else None
+
+   def get(self, key):
+      # Cached response of request key, None if not cached (miss)
+      with self.lock:
+         entry = self.entries.get(key)
+         if entry is not None and self.ttl and monotonic() - entry[1] > self.ttl:
+            self.remove(key)
+            entry = None
+         if entry is None:
+            self.misses += 1
+            return None
+         self.entries[key] = self.entries.pop(key)   # most recently used
+         self.hits += 1
+         return entry[0]
+
+   def put(self, key, response):
+      # Response of the tcp server to request key
+      size = len(key) + len(response) + ENTRY_OVERHEAD
+      if size > self.maxBytes:
+         return None
+      with self.lock:
+         if key in self.entries:
+            self.remove(key)
+         self.entries[key] = (bytes(response), monotonic())
+         self.bytes += size
+         while len(self.entries) > self.maxEntries or self.bytes > self.maxBytes:
+            self.remove(next(iter(self.entries)))
+            self.evicted += 1
+      return None
+
+   def remove(self, key):
+      # Remove entry (lock held)
+      response, stored = self.entries.pop(key)
+      self.bytes -= len(key) + len(response) + ENTRY_OVERHEAD
+
+   def clear(self):
+      with self.lock:
+         self.entries.clear()
+         self.bytes = 0
+
+   def status(self):
+      total = self.hits + self.misses
+      return "%d entries, %d bytes, %d hits, %d misses (%.0f%% hits)" % \
+             (len(self.entries), self.bytes, self.hits, self.misses, 100.0 * self.hits / total if total else 0)
+# END class ResponseCache
+
+#=====================================================================================
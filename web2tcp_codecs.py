@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+"""
+|===================================================================================
+| Web2Tcp: message framing of the tcp connection                                    |
+|===================================================================================
+| Tcp is a stream of bytes; a codec marks where a message ends.
+|   null       message ends with a null character (default, DamExchange)
+|   newline    message ends with a newline
+|   length2    2-byte big-endian length, then the message (binary safe)
+|   length4    4-byte big-endian length, then the message (binary safe)
+|   header:<size>:<offset>:<length size>
+|              fixed header of <size> bytes with a big-endian length field of
+|              the body at <offset>; the message is header and body together
+|
+| Delimiter codecs search new bytes for the delimiter. Header codecs read
+| the length and wait for exactly that many bytes; nothing is searched.
+|
+| Streaming: with rb.streamThreshold set, a message larger than the threshold
+| is not buffered whole but returned in parts (StreamChunk) as it arrives;
+| header(total) and trailer() frame a message that is sent in parts.
+====================================================================================
+"""
+
+import struct
+
+LENGTH_FORMATS = {1: '>B', 2: '>H', 4: '>I', 8: '>Q'}   # length field size => struct format
+
+class StreamChunk:
+   # Part of a large message; total: size of message if known, else None
+   __slots__ = ('data', 'first', 'last', 'total')
+
+   def __init__(self, data, first, last, total=None):
+      self.data = data
+      self.first = first
+      self.last = last
+      self.total = total
+# END class StreamChunk
+
+class DelimiterCodec:
+   # Messages separated by a delimiter (not binary safe)
+
+   headerSize = 0
+
+   def __init__(self, delimiter):
+      self.delimiter = delimiter
+      self.name = {b"\0": 'null', b"\n": 'newline'}.get(delimiter, repr(delimiter))
+
+   def encode(self, payload):
+      return payload + self.delimiter
+
+   def header(self, total):
+      return b""
+
+   def trailer(self):
+      return self.delimiter
+
+   def decode(self, rb):
+      # Complete messages in ReceiveBuffer rb (bytes, without delimiter).
+      # Only bytes after rb.scan are searched.
+      messages = []
+      delimLen = len(self.delimiter)
+      while True:
+         pos = rb.buf.find(self.delimiter, rb.scan, rb.end)
+         if pos < 0: break
+         if rb.streaming:
+            messages.append(StreamChunk(bytes(rb.buf[rb.start:pos]), False, True))
+            rb.streaming = False
+         else:
+            messages.append(bytes(rb.buf[rb.start:pos]))
+         rb.start = rb.scan = pos + delimLen
+      rb.scan = max(rb.start, rb.end - delimLen + 1)
+      if rb.streamThreshold and (rb.streaming or rb.end - rb.start > rb.streamThreshold):
+         # no delimiter yet: bytes that cannot be part of it are passed on
+         if rb.scan > rb.start:
+            messages.append(StreamChunk(bytes(rb.buf[rb.start:rb.scan]), not rb.streaming, False))
+            rb.streaming = True
+            rb.start = rb.scan
+      rb.need = 0   # unknown
+      return messages
+# END class DelimiterCodec
+
+class HeaderCodec:
+   # Messages with a fixed-size header holding the length of the body.
+   # Subclasses define headerSize, bodyLength(header) and message(header, body).
+
+   headerSize = 0
+
+   def trailer(self):
+      return b""
+
+   def decode(self, rb):
+      # Complete messages in ReceiveBuffer rb; rb.need is set to the bytes
+      # missing for the next message (exact size of next read)
+      messages = []
+      while True:
+         available = rb.end - rb.start
+         if rb.streamLeft:
+            # body of a streamed message: passed on as it arrives
+            if available == 0:
+               rb.need = 0
+               break
+            size = min(available, rb.streamLeft)
+            rb.streamLeft -= size
+            messages.append(StreamChunk(bytes(rb.buf[rb.start:rb.start + size]), False, rb.streamLeft == 0))
+            rb.start += size
+            continue
+         if available < self.headerSize:
+            rb.need = self.headerSize - available
+            break
+         header = bytes(rb.buf[rb.start:rb.start + self.headerSize])
+         length = self.bodyLength(header)
+         if rb.streamThreshold and self.headerSize + length > rb.streamThreshold:
+            # large message: header part first, then the body in parts
+            prefix = self.message(header, b"")
+            size = min(available - self.headerSize, length)
+            body = bytes(rb.buf[rb.start + self.headerSize:rb.start + self.headerSize + size])
+            rb.streamLeft = length - size
+            messages.append(StreamChunk(prefix + body, True, rb.streamLeft == 0, len(prefix) + length))
+            rb.start += self.headerSize + size
+            continue
+         if self.headerSize + length > rb.maxSize:
+            raise Exception("receive exception: message larger than %d bytes" % rb.maxSize)
+         if available < self.headerSize + length:
+            rb.need = self.headerSize + length - available
+            break
+         body = bytes(rb.buf[rb.start + self.headerSize:rb.start + self.headerSize + length])
+         messages.append(self.message(header, body))
+         rb.start += self.headerSize + length
+      rb.scan = rb.start
+      return messages
+# END class HeaderCodec
+
+class LengthPrefixCodec(HeaderCodec):
+   # Big-endian length of 2 or 4 bytes before every message (binary safe)
+
+   def __init__(self, size=4):
+      if size not in (2, 4):
+         raise ValueError("length prefix of 2 or 4 bytes, not %s" % size)
+      self.headerSize = size
+      self.format = LENGTH_FORMATS[size]
+      self.name = 'length%d' % size
+
+   def encode(self, payload):
+      return self.header(len(payload)) + payload
+
+   def header(self, total):
+      # Length prefix of a message sent in parts: the size must be known
+      if total is None:
+         raise Exception("send exception: %s needs the message size; fragmented message not streamed" % self.name)
+      if total >= 1 << (8 * self.headerSize):
+         raise Exception("send exception: message too long for %s" % self.name)
+      return struct.pack(self.format, total)
+
+   def bodyLength(self, header):
+      return struct.unpack(self.format, header)[0]
+
+   def message(self, header, body):
+      return body
+# END class LengthPrefixCodec
+
+class FixedHeaderCodec(HeaderCodec):
+   # Fixed header of headerSize bytes with the body length at lengthOffset.
+   # Messages are complete records (header and body) in both directions:
+   # messages of browser clients are sent as they are.
+
+   def __init__(self, headerSize, lengthOffset, lengthSize):
+      if lengthSize not in LENGTH_FORMATS or lengthOffset + lengthSize > headerSize:
+         raise ValueError("bad header layout %d:%d:%d" % (headerSize, lengthOffset, lengthSize))
+      self.headerSize = headerSize
+      self.lengthOffset = lengthOffset
+      self.format = LENGTH_FORMATS[lengthSize]
+      self.name = 'header:%d:%d:%d' % (headerSize, lengthOffset, lengthSize)
+
+   def encode(self, payload):
+      if len(payload) < self.headerSize or \
+         self.bodyLength(payload[:self.headerSize]) != len(payload) - self.headerSize:
+         raise Exception("send exception: message is no %s record" % self.name)
+      return payload
+
+   def header(self, total):
+      return b""   # the message has its own header
+
+   def bodyLength(self, header):
+      return struct.unpack_from(self.format, header, self.lengthOffset)[0]
+
+   def message(self, header, body):
+      return header + body
+# END class FixedHeaderCodec
+
+def makeCodec(spec, terminator="\0"):
+   # Codec by name (see above); 'null' uses terminator
+   if not isinstance(spec, str):
+      return spec   # codec already
+   words = spec.lower().split(':')
+   if words[0] == 'null':
+      return DelimiterCodec(terminator.encode('latin-1'))
+   if words[0] == 'newline':
+      return DelimiterCodec(b"\n")
+   if words[0] in ('length2', 'length4'):
+      return LengthPrefixCodec(int(words[0][-1]))
+   if words[0] == 'header' and len(words) == 4:
+      try:
+         return FixedHeaderCodec(int(words[1]), int(words[2]), int(words[3]))
+      except ValueError as err:
+         raise ValueError("codec %s: %s" % (spec, err))
+   raise ValueError("unknown codec %s (null, newline, length2, length4 or header:<size>:<offset>:<length size>)" % spec)
+#  makeCodec()
+
+#=====================================================================================
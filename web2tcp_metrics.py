@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""
+|===================================================================================
+| Web2Tcp: live metrics                                                             |
+|===================================================================================
+| Counters and histograms of the bridge server, updated while forwarding messages.
+| Shown by the console command info and served in Prometheus text format on the
+| websocket listener: http://<host>:<port>/metrics
+====================================================================================
+"""
+
+import threading
+import time
+from bisect import bisect_left
+
+clock = getattr(time, 'perf_counter', time.time)   # for forwarding latency
+
+# Histogram buckets (upper bounds)
+LATENCY_BUCKETS = [0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]        # seconds
+SIZE_BUCKETS = [16, 64, 128, 256, 512, 1024, 4096, 16384, 65536, 262144, 1048576]  # bytes
+OUTAGE_BUCKETS = [0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0]  # seconds
+STAGE_BUCKETS = [0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025,
+                 0.0005, 0.001, 0.0025, 0.01, 0.1, 1.0]                    # seconds
+
+class Histogram:
+   # Counts of observed values per bucket, plus count and sum
+
+   def __init__(self, buckets):
+      self.buckets = buckets
+      self.counts = [0] * (len(buckets) + 1)   # last: larger than all buckets
+      self.count = 0
+      self.sum = 0.0
+
+   def observe(self, value):
+      self.counts[bisect_left(self.buckets, value)] += 1
+      self.count += 1
+      self.sum += value
+
+   def percentile(self, p):
+      # Upper bound of bucket containing percentile p (0..100); None if empty
+      if self.count == 0:
+         return None
+      rank = p / 100.0 * self.count
+      total = 0
+      for i, n in enumerate(self.counts):
+         total += n
+         if total >= rank and n > 0:
+            return self.buckets[i] if i < len(self.buckets) else float('inf')
+      return float('inf')
+# END class Histogram
+
+class Metrics:
+   # Registry of named counters, gauges and histograms (thread safe)
+
+   def __init__(self, prefix='web2tcp_'):
+      self.prefix = prefix
+      self.lock = threading.Lock()
+      self.names = []        # in order of definition
+      self.help = {}
+      self.counters = {}
+      self.gauges = {}       # name => function returning current value
+      self.histograms = {}
+
+   def define(self, name, help):
+      self.names.append(name)
+      self.help[name] = help
+
+   def counter(self, name, help):
+      self.define(name, help)
+      self.counters[name] = 0
+
+   def gauge(self, name, help, fn):
+      self.define(name, help)
+      self.gauges[name] = fn
+
+   def histogram(self, name, help, buckets):
+      self.define(name, help)
+      self.histograms[name] = Histogram(buckets)
+
+   def inc(self, name, value=1):
+      with self.lock:
+         self.counters[name] += value
+
+   def observe(self, name, value):
+      with self.lock:
+         self.histograms[name].observe(value)
+
+   def value(self, name):
+      if name in self.gauges:
+         try:
+            return self.gauges[name]()
+         except Exception:
+            return 0
+      return self.counters.get(name, 0)
+
+   def snapshot(self):
+      # Current values as plain data, e.g. to send to another process
+      with self.lock:
+         snapshot = {'counters': dict(self.counters), 'histograms': {}}
+         for name, hist in self.histograms.items():
+            snapshot['histograms'][name] = (list(hist.counts), hist.count, hist.sum)
+      snapshot['gauges'] = dict((name, self.value(name)) for name in self.gauges)
+      return snapshot
+
+   def add(self, snapshot):
+      # Add values of a snapshot (aggregation of several processes)
+      with self.lock:
+         for name, value in snapshot['counters'].items():
+            if name in self.counters:
+               self.counters[name] += value
+         for name, (counts, count, total) in snapshot['histograms'].items():
+            hist = self.histograms.get(name)
+            if hist is None: continue
+            hist.counts = [a + b for a, b in zip(hist.counts, counts)]
+            hist.count += count
+            hist.sum += total
+         for name, value in snapshot['gauges'].items():
+            if name in self.gauges:
+               current = self.value(name)
+               self.gauges[name] = lambda total=current + value: total
+
+   def text(self):
+      # Prometheus text exposition format
+      lines = []
+      with self.lock:
+         for name in self.names:
+            full = self.prefix + name
+            lines.append("# HELP %s %s" % (full, self.help[name]))
+            if name in self.histograms:
+               hist = self.histograms[name]
+               lines.append("# TYPE %s histogram" % full)
+               total = 0
+               for bound, n in zip(hist.buckets, hist.counts):
+                  total += n
+                  lines.append('%s_bucket{le="%g"} %d' % (full, bound, total))
+               lines.append('%s_bucket{le="+Inf"} %d' % (full, hist.count))
+               lines.append("%s_sum %g" % (full, hist.sum))
+               lines.append("%s_count %d" % (full, hist.count))
+            else:
+               kind = "gauge" if name in self.gauges else "counter"
+               lines.append("# TYPE %s %s" % (full, kind))
+               lines.append("%s %s" % (full, self.value(name)))
+      return "\n".join(lines) + "\n"
+
+   def summary(self):
+      # Lines for console status info
+      lines = []
+      with self.lock:
+         for name in self.names:
+            if name in self.histograms:
+               hist = self.histograms[name]
+               if hist.count == 0:
+                  lines.append("%s: -" % name)
+                  continue
+               lines.append("%s: n=%d p50<%g p99<%g" %
+                            (name, hist.count, hist.percentile(50), hist.percentile(99)))
+            else:
+               lines.append("%s: %s" % (name, self.value(name)))
+      return lines
+# END class Metrics
+
+#=====================================================================================
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""
+|===================================================================================
+| Web2Tcp: profiler of a running bridge                                             |
+|===================================================================================
+| Switched on and off at runtime by the console command profile, e.g. under real
+| load, without a restart. Two kinds:
+|   sample    a thread takes the stacks of all threads every interval seconds
+|             (sys._current_frames); little overhead, for production instances.
+|             Dump: samples per function and folded stacks (flame graph tools:
+|             flamegraph.pl, speedscope).
+|   cprofile  deterministic profile of all threads with cProfile (Python 3.12 or
+|             newer; older versions only profile the thread that enables it).
+|             Every call is counted: the bridge runs slower while it is on.
+|             Dump: pstats file (python -m pstats <file>).
+| Samples of threads waiting for input (recv, Condition.wait) are included;
+| they show where threads wait, not where time is spent.
+====================================================================================
+"""
+
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+KINDS = ('sample', 'cprofile')
+
+class SamplingProfiler(threading.Thread):
+   # Stack samples of all other threads every interval seconds
+
+   def __init__(self, interval=0.005):
+      threading.Thread.__init__(self)
+      self.daemon = True
+      self.kind = 'sample'
+      self.interval = interval
+      self.stacks = Counter()   # (thread name, function, .., function) => samples
+      self.samples = 0          # sampling rounds
+      self.started = time.time()
+      self.elapsed = None
+      self.stopped = threading.Event()
+
+   def run(self):
+      while not self.stopped.wait(self.interval):
+         self.sample()
+
+   def sample(self):
+      names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+      own = threading.current_thread().ident
+      for ident, frame in sys._current_frames().items():
+         if ident == own: continue
+         stack = []
+         while frame is not None:
+            code = frame.f_code
+            stack.append("%s (%s:%d)" % (code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+         stack.append(names.get(ident, "thread-%d" % ident))
+         stack.reverse()
+         self.stacks[tuple(stack)] += 1
+      self.samples += 1
+
+   def stop(self):
+      self.stopped.set()
+      self.join(1.0)
+      self.elapsed = time.time() - self.started
+
+   def functions(self):
+      # Samples per function: (own samples: function on top, total: on the stack)
+      own = Counter()
+      total = Counter()
+      for stack, n in self.stacks.items():
+         own[stack[-1]] += n
+         for function in set(stack[1:]):
+            total[function] += n
+      return own, total
+
+   def report(self, top=30):
+      # Text of the profile; top: functions listed
+      own, total = self.functions()
+      count = sum(self.stacks.values()) or 1
+      lines = ["# sampling profile: %d rounds every %g ms over %.1f s, %d stack samples" %
+               (self.samples, self.interval * 1e3, self.elapsed or time.time() - self.started, count)]
+      lines.append("# functions by own samples (total: samples with the function on the stack)")
+      lines.append("#     own      %     total      %   function")
+      for function, n in own.most_common(top):
+         lines.append("# %7d %6.1f %9d %6.1f   %s" %
+                      (n, 100.0 * n / count, total[function], 100.0 * total[function] / count, function))
+      lines.append("# folded stacks: thread;caller;..;function samples")
+      for stack, n in self.stacks.most_common():
+         lines.append("%s %d" % (";".join(stack), n))
+      return "\n".join(lines) + "\n"
+
+   def dump(self, path):
+      with open(path, 'w') as file:
+         file.write(self.report())
+
+   def status(self):
+      return "sampling every %g ms, %d rounds" % (self.interval * 1e3, self.samples)
+# END class SamplingProfiler
+
+class CProfiler:
+   # cProfile session; all threads on Python 3.12 or newer (sys.monitoring)
+
+   def __init__(self):
+      if sys.version_info < (3, 12):
+         raise ValueError("cprofile sees all threads only on Python 3.12 or newer; use profile on sample")
+      self.kind = 'cprofile'
+      self.profile = cProfile.Profile()
+      self.started = time.time()
+      self.elapsed = None
+
+   def start(self):
+      self.profile.enable()
+
+   def stop(self):
+      self.profile.disable()
+      self.elapsed = time.time() - self.started
+
+   def report(self, top=30):
+      out = io.StringIO()
+      pstats.Stats(self.profile, stream=out).sort_stats('tottime').print_stats(top)
+      return out.getvalue()
+
+   def dump(self, path):
+      self.profile.dump_stats(path)
+
+   def status(self):
+      return "cProfile for %.1f s" % (time.time() - self.started)
+# END class CProfiler
+
+def newProfiler(kind='sample', interval=0.005):
+   # Profiler of kind (see KINDS), started
+   if kind == 'sample':
+      profiler = SamplingProfiler(interval)
+   elif kind == 'cprofile':
+      profiler = CProfiler()
+   else:
+      raise ValueError("unknown profiler %s (%s)" % (kind, ", ".join(KINDS)))
+   profiler.start()
+   return profiler
+#  newProfiler()
+
+#=====================================================================================
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+"""
+|===================================================================================
+| Web2Tcp: binary traffic recording                                                 |
+|===================================================================================
+| Every message in both directions is appended to a binary file, complete (not
+| truncated) with a timestamp in nanoseconds, direction and client id.
+| Streamed messages (STREAM_THRESHOLD) are recorded per part as they arrive;
+| the reader joins the parts again.
+| Replay: python test/replay_traffic.py <file>
+|
+| File: MAGIC, then records of a fixed header and the payload:
+|   int64   time (nanoseconds since the epoch)
+|   uint8   direction: FROM_CLIENT, FROM_SERVER, CLIENT_OPEN or CLIENT_CLOSE
+|   uint8   flags: FLAG_BINARY for binary websocket frames,
+|           FLAG_CACHED for client requests answered from the response cache,
+|           FLAG_PART (with FLAG_FIRST, FLAG_LAST) for parts of streamed messages
+|   uint16  reserved
+|   uint32  client id (FROM_SERVER: client of a routed reply, 0 for all clients)
+|   uint32  payload length
+| All numbers little-endian. The file is only appended to; a record cut off by
+| a crash at the end is ignored by the reader.
+|
+| Records wait in memory for the disk at most maxPending bytes; records beyond
+| that are dropped (counted), for a streamed message all its remaining parts.
+====================================================================================
+"""
+
+import mmap
+import struct
+import threading
+import time
+from collections import deque
+
+MAGIC = b"W2TREC1\n"
+HEADER = struct.Struct("<qBBHII")
+
+FROM_CLIENT = 1    # message of a browser client
+FROM_SERVER = 2    # message of the tcp server
+CLIENT_OPEN = 3    # browser client connected (after handshake)
+CLIENT_CLOSE = 4   # browser client disconnected
+
+FLAG_BINARY = 1
+FLAG_CACHED = 2    # FROM_CLIENT: answered from the response cache, not forwarded
+FLAG_PART = 4      # part of a streamed message (parts of one direction and client in order)
+FLAG_FIRST = 8     # first part of a streamed message
+FLAG_LAST = 16     # last part of a streamed message
+
+if hasattr(time, 'time_ns'):
+   timeNs = time.time_ns
+else:
+   def timeNs():
+      return int(time.time() * 1e9)
+
+class Recorder(threading.Thread):
+   # Appends records to the file in a background thread; record() never
+   # waits for the disk. Records queued meanwhile are written together.
+
+   def __init__(self, path, maxPending=33554432):
+      threading.Thread.__init__(self)
+      self.daemon = True
+      self.path = path
+      self.file = open(path, 'ab')
+      if self.file.tell() == 0:
+         self.file.write(MAGIC)
+      self.pending = deque()
+      self.pendingBytes = 0
+      self.maxPending = maxPending   # bytes waiting for the disk; more records are dropped
+      self.dropping = set()          # (direction, clientId) of streamed messages being dropped
+      self.cond = threading.Condition()
+      self.stopped = False
+      self.records = 0
+      self.bytes = 0
+      self.dropped = 0
+
+   def record(self, direction, clientId, payload=b"", flags=0):
+      size = HEADER.size + len(payload)
+      header = HEADER.pack(timeNs(), direction, flags, 0, clientId, len(payload))
+      with self.cond:
+         if flags & FLAG_PART:
+            # parts after a dropped part are dropped too: the reader never joins an incomplete message
+            stream = (direction, clientId)
+            if flags & FLAG_FIRST:
+               self.dropping.discard(stream)
+            if stream in self.dropping or self.pendingBytes + size > self.maxPending:
+               self.dropping.add(stream)
+               if flags & FLAG_LAST:
+                  self.dropping.discard(stream)
+               self.dropped += 1
+               return None
+         elif self.pendingBytes + size > self.maxPending:
+            self.dropped += 1
+            return None
+         self.pending.append(header)
+         if payload:
+            self.pending.append(payload)
+         self.pendingBytes += size
+         self.records += 1
+         self.bytes += size
+         self.cond.notify()
+      return None
+
+   def run(self):
+      while True:
+         with self.cond:
+            while not self.pending and not self.stopped:
+               self.cond.wait()
+            batch = list(self.pending)
+            self.pending.clear()
+            self.pendingBytes = 0
+            stopped = self.stopped
+         if batch:
+            self.file.writelines(batch)
+            self.file.flush()
+         if stopped and not batch:
+            break
+      self.file.close()
+
+   def stop(self):
+      # Pending records are written, then the file is closed
+      with self.cond:
+         self.stopped = True
+         self.cond.notify()
+      self.join(5.0)
+
+   def status(self):
+      return "%s: %d records, %d bytes, %d dropped" % (self.path, self.records, self.bytes, self.dropped)
+# END class Recorder
+
+class Record:
+   # Record of a recording; payload is a memoryview into the mapped file
+   __slots__ = ('time', 'direction', 'flags', 'clientId', 'payload')
+
+   def __init__(self, time, direction, flags, clientId, payload):
+      self.time = time
+      self.direction = direction
+      self.flags = flags
+      self.clientId = clientId
+      self.payload = payload
+# END class Record
+
+class RecordReader:
+   # Records of a recording, read through mmap (payloads are not copied).
+   # Iterating gives the messages: the parts of a streamed message joined in
+   # one record (copied) at the place of its last part; records() gives the parts.
+
+   def __init__(self, path):
+      self.file = open(path, 'rb')
+      try:
+         self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+      except ValueError:
+         self.file.close()
+         raise ValueError("%s: empty file" % path)
+      if self.map[:len(MAGIC)] != MAGIC:
+         self.close()
+         raise ValueError("%s: no traffic recording" % path)
+
+   def __iter__(self):
+      streams = {}   # (direction, clientId) => first part and payloads of a streamed message
+      for rec in self.records():
+         if not rec.flags & FLAG_PART:
+            if rec.direction == CLIENT_CLOSE:
+               streams.pop((FROM_CLIENT, rec.clientId), None)   # message aborted
+            yield rec
+            continue
+         stream = (rec.direction, rec.clientId)
+         if rec.flags & FLAG_FIRST:
+            streams[stream] = (rec, [])
+         if stream not in streams:
+            continue   # first part not recorded (dropped)
+         first, payloads = streams[stream]
+         payloads.append(bytes(rec.payload))
+         if rec.flags & FLAG_LAST:
+            del streams[stream]
+            flags = first.flags & ~(FLAG_PART | FLAG_FIRST | FLAG_LAST)
+            yield Record(rec.time, rec.direction, flags, rec.clientId, b"".join(payloads))
+
+   def records(self):
+      size = len(self.map)
+      view = memoryview(self.map)
+      offset = len(MAGIC)
+      while offset + HEADER.size <= size:
+         stamp, direction, flags, reserved, clientId, length = HEADER.unpack_from(self.map, offset)
+         start = offset + HEADER.size
+         if start + length > size:
+            break   # cut off
+         yield Record(stamp, direction, flags, clientId, view[start:start + length])
+         offset = start + length
+
+   def close(self):
+      try:
+         self.map.close()
+      except BufferError:
+         pass   # payloads still in use: unmapped when they are garbage collected
+      self.file.close()
+# END class RecordReader
+
+#=====================================================================================
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+r"""
+|===================================================================================
+| Web2Tcp: routing of tcp server replies                                            |
+|===================================================================================
+| By default every message of the tcp server is sent to all browser clients.
+| With a RequestRouter the bridge remembers which client sent each request,
+| and a reply of the server goes to that client only:
+|   fifo   replies come in the order of the requests (one reply per request)
+|   id     request and reply carry the same id, found by a regular expression
+|          with one group, e.g.  "id"\s*:\s*"?([\w.-]+)  for JSON messages
+| Server messages that match no outstanding request are sent to all clients.
+| Requests without reply are forgotten after a timeout.
+| A request can carry a key (response cache); the reply returns it.
+====================================================================================
+"""
+
+import re
+import threading
+import time
+from collections import deque
+
+class RequestRouter:
+   # Outstanding requests of browser clients, matched with replies of the tcp server
+
+   def __init__(self, mode='fifo', idPattern=None, timeout=30.0):
+      if mode not in ('fifo', 'id'):
+         raise ValueError("unknown routing mode %s (fifo or id)" % mode)
+      if mode == 'id' and not idPattern:
+         raise ValueError("routing mode id needs an id pattern")
+      self.mode = mode
+      self.idPattern = re.compile(idPattern) if idPattern else None
+      self.timeout = timeout   # seconds; 0: requests kept until reply
+      self.lock = threading.Lock()
+      self.queue = deque()     # [clientId, time, id, key] in order of requests (fifo: in order of replies)
+      self.ids = {}            # id mode: id => deque of entries (clients may use the same ids)
+      self.outstanding = 0
+      self.routed = 0          # replies sent to one client
+      self.unmatched = 0       # server messages sent to all clients
+
+   def messageId(self, message):
+      # Id of a message (str or bytes) by idPattern, or None
+      if isinstance(message, bytes):
+         message = message.decode('latin-1')
+      match = self.idPattern.search(message)
+      return match.group(1) if match else None
+
+   def request(self, clientId, message, key=None):
+      # Request of client forwarded to tcp server; returns entry for cancel(),
+      # None if the request has no id (id mode: its reply goes to all clients)
+      requestId = None
+      if self.mode == 'id':
+         requestId = self.messageId(message)
+         if requestId is None:
+            return None
+      entry = [clientId, time.time(), requestId, key]
+      with self.lock:
+         self.expire(entry[1])
+         self.queue.append(entry)
+         if requestId is not None:
+            self.ids.setdefault(requestId, deque()).append(entry)
+         self.outstanding += 1
+      return entry
+
+   def cancel(self, entry):
+      # Request could not be forwarded: no reply expected
+      if entry is None: return
+      with self.lock:
+         if entry[0] is not None:
+            entry[0] = None   # skipped when its turn comes
+            self.outstanding -= 1
+
+   def reply(self, message):
+      # Client id the server message must be sent to; None: send to all clients.
+      # The client may have disconnected meanwhile: the caller drops the reply
+      # (in fifo mode the reply still takes the turn of the request).
+      return self.replyWithKey(message)[0]
+
+   def replyWithKey(self, message):
+      # As reply(); returns (client id, key of the request)
+      with self.lock:
+         self.expire(time.time())
+         if self.mode == 'fifo':
+            entries = self.queue
+         else:
+            replyId = self.messageId(message)
+            entries = self.ids.get(replyId) if replyId is not None else None
+         clientId = key = None
+         while entries and clientId is None:
+            entry = entries.popleft()
+            clientId, entry[0] = entry[0], None   # entry done; removed from queue by expire
+            key = entry[3]
+         if self.mode == 'id' and entries is not None and not entries:
+            del self.ids[replyId]
+         if clientId is None:
+            self.unmatched += 1
+            return None, None
+         self.outstanding -= 1
+         self.routed += 1
+         return clientId, key
+
+   def expire(self, now):
+      # Forget requests older than timeout (lock held); id mode: done
+      # requests are removed from the queue as well
+      limit = now - self.timeout if self.timeout else None
+      queue = self.queue
+      while queue and (queue[0][0] is None or (limit is not None and queue[0][1] < limit)):
+         entry = queue.popleft()
+         if entry[0] is None: continue
+         entry[0] = None
+         self.outstanding -= 1
+         entries = self.ids.get(entry[2])
+         if entries is not None:
+            while entries and entries[0][0] is None:
+               entries.popleft()
+            if not entries:
+               del self.ids[entry[2]]
+
+   def status(self):
+      return "%s: %d outstanding, %d routed, %d to all" % (self.mode, self.outstanding, self.routed, self.unmatched)
+# END class RequestRouter
+
+#=====================================================================================
@@ -15,12 +15,36 @@
 # Changes of original source:
 # - new message "send_message_to_other"
 # - extra parameter 'host' in WebsocketServer  
+# - bulk unmasking of client payloads (unmask_payload)
+# - broadcast frames are encoded once for all clients (_multicast_payload_)
+# - bounded outbound queue and writer thread per client (OutboundQueue)
+# - clients in an indexed registry per server instance (ClientRegistry, Client)
+# - binary frames and fragmented messages (send_binary, set_fn_binary_received)
+# - permessage-deflate compression negotiated in handshake (PerMessageDeflate)
+# - plain http GET requests answered by set_fn_http_request (e.g. /metrics)
+# - queued frames written in one scatter-gather write; socket options (tcp_nodelay)
+# - incremental handshake parser with size limits and deadline (HandshakeRequest)
+# - ping/pong and eviction of idle clients by one timer thread (Heartbeat)
+# - size limit of client frames; large frames passed on in chunks (set_fn_stream_received)
+# - time per stage of a message reported to a function (stage_timer)
+# - TLS (wss://) with session resumption by tickets (ssl_context, make_ssl_context)
 # ===============================================================================
 
 import re, sys
 import struct
+import socket
+import threading
+import time
+import zlib
+from collections import deque
 from base64 import b64encode
 from hashlib import sha1
+try:
+	import ssl
+	TLS_SOCKET = ssl.SSLSocket
+except ImportError:
+	ssl = None
+	TLS_SOCKET = ()
 
 if sys.version_info[0] < 3 :
 	from SocketServer import ThreadingMixIn, TCPServer, StreamRequestHandler
@@ -45,14 +69,34 @@ else:
 '''
 
 FIN    = 0x80
+RSV1   = 0x40   # set on first frame of compressed message (permessage-deflate)
 OPCODE = 0x0f
 MASKED = 0x80
 PAYLOAD_LEN = 0x7f
 PAYLOAD_LEN_EXT16 = 0x7e
 PAYLOAD_LEN_EXT64 = 0x7f
 
+OPCODE_CONTINUATION = 0x0
 OPCODE_TEXT = 0x01
+OPCODE_BINARY = 0x02
 CLOSE_CONN  = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_UNSUPPORTED_DATA = 1003
+CLOSE_INVALID_DATA = 1007
+CLOSE_POLICY_VIOLATION = 1008
+CLOSE_TOO_BIG = 1009
+
+# CPU time of current thread, for compression counters
+cpu_time = getattr(time, 'thread_time', None) or getattr(time, 'process_time', None) or time.clock
+
+# Clock for heartbeats; not affected by changes of system time
+monotonic = getattr(time, 'monotonic', time.time)
+
+# High resolution clock for stage timing
+perf_clock = getattr(time, 'perf_counter', time.time)
 
 # -------------------------------- API ---------------------------------
 
@@ -73,18 +117,43 @@ class API():
         pass
     def message_received(self, client, server, message):
         pass
+    def binary_received(self, client, server, data):
+        pass
+    def http_request(self, path):
+        return None   # (content_type, body) or None for 404
+    def stream_received(self, client, server, opcode, chunk, first, last, total):
+        pass   # total: size of message if known (message of one frame), else None
+    def stream_aborted(self, client, server):
+        pass
     def set_fn_new_client(self, fn):
         self.new_client=fn
     def set_fn_client_left(self, fn):
         self.client_left=fn
     def set_fn_message_received(self, fn):
         self.message_received=fn
+    def set_fn_binary_received(self, fn):
+        self.binary_received=fn
+    def set_fn_http_request(self, fn):
+        self.http_request=fn
+    def set_fn_stream_received(self, fn):
+        self.stream_received=fn
+    def set_fn_stream_aborted(self, fn):
+        self.stream_aborted=fn
     def send_message(self, client, msg):
         self._unicast_(client, msg)
     def send_message_to_all(self, msg):
         self._multicast_(msg)
     def send_message_to_other(self, client, msg):
         self._multicast2_(client, msg)
+    def send_binary(self, client, data):
+        client.handler.send_binary(data)
+    def send_binary_to_all(self, data):
+        self._multicast_payload_(bytes(data), OPCODE_BINARY)
+    def send_fragment(self, client, data, opcode, first, last):
+        client.handler.send_frame(encode_fragment(data, opcode, first, last), wait=True)
+    def send_fragment_to_all(self, data, opcode, first, last, clients=None):
+        # clients: those that got the first fragment (default: all clients)
+        self._multicast_frame_(encode_fragment(data, opcode, first, last), clients)
 
 # *** END class API ***
 
@@ -93,59 +162,222 @@ class API():
 class WebsocketServer(ThreadingMixIn, TCPServer, API):
 
 	allow_reuse_address = True
+	request_queue_size = 128   # listen backlog, for many clients reconnecting at once
 	daemon_threads = True # comment to keep threads alive until finished
 
 	'''
-	clients is a list of dict:
-	    {
-	     'id'      : id,
-	     'handler' : handler,
-	     'address' : (addr, port)
-	    }
+	clients is a ClientRegistry of Client records:
+	     client.id      : id
+	     client.handler : handler
+	     client.address : (addr, port)
+	Client records also support client['id'] etc. like the former dicts.
 	'''
-	clients=[]
-	id_counter=0
+
+	# Outbound queue per client, see OutboundQueue
+	out_queue_size = 100
+	slow_consumer_policy = 'drop_oldest'   # 'drop_oldest', 'drop_newest' or 'disconnect'
+
+	# permessage-deflate compression, see PerMessageDeflate
+	deflate = False                    # accept compression offered by clients
+	deflate_context_takeover = True    # False: every message compressed on its own
+	deflate_window_bits = 15           # 9..15; server compression window
+	deflate_min_size = 64              # smaller messages are sent uncompressed
+	deflate_level = 6
+
+	# Options of client sockets; 0 for buffer sizes means system default
+	tcp_nodelay = False      # True: disable Nagle algorithm
+	sndbuf_size = 0
+	rcvbuf_size = 0
+
+	# Http upgrade request, see HandshakeRequest
+	handshake_timeout = 10.0       # seconds for the complete request; 0: no deadline
+	handshake_max_size = 8192      # bytes of request line and headers
+	handshake_max_headers = 64
+
+	# Heartbeats, see Heartbeat; 0 means off
+	ping_interval = 0        # seconds between pings to a client that sent nothing
+	idle_timeout = 0         # seconds without any frame from a client: evicted
+
+	# Large messages; 0 means no limit / no streaming
+	max_frame_size = 0       # larger frames are refused before reading (close 1009)
+	max_message_size = 0     # limit for all frames of a fragmented message
+	stream_threshold = 0     # larger frames are passed on in chunks (set_fn_stream_received)
+	stream_chunk_size = 65536
+	stream_send_timeout = 10.0   # seconds a fragment waits for room in the full outbound queues
+	stream_read_timeout = 0      # seconds from first to last chunk of a streamed client message
+
+	# Instrumentation: function(stage, seconds) called with the time of a stage:
+	#   ws_read  : frame header received to message complete (read, unmask, inflate)
+	#   ws_queue : oldest frame of a batch waiting in the outbound queue
+	#   ws_write : socket write of a batch of frames
+	# None: no timing
+	stage_timer = None
+
+	# TLS (wss://), see make_ssl_context; None: plain ws://
+	# The TLS handshake runs in the thread of the client (within handshake_timeout).
+	ssl_context = None
+	tls_timer = None         # function(seconds, resumed) called after every TLS handshake
 
 	def __init__(self, port, host='127.0.0.1'):
 		self.port=port
 		self.host=host   # AKA
+		self.clients=ClientRegistry()   # per instance, not shared between servers
+		self.id_counter=0
+		self.deflate_stats=DeflateStats()
+		self.tls_stats=TlsStats()
+		self.heartbeat=None
 		TCPServer.__init__(self, (host, port), WebSocketHandler)
 
+	def get_request(self):
+		# Accepted connection; wrapped for TLS without handshake (done by the handler)
+		sock, addr = TCPServer.get_request(self)
+		if self.ssl_context is not None:
+			sock = self.ssl_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+		return sock, addr
+
+	def server_close(self):
+		if self.heartbeat is not None:
+			self.heartbeat.stop()
+		TCPServer.server_close(self)
+
 	def _message_received_(self, handler, msg):
 		self.message_received(self.handler_to_client(handler), self, msg)
 
+	def _binary_received_(self, handler, data):
+		self.binary_received(self.handler_to_client(handler), self, data)
+
 	def _new_client_(self, handler):
 		self.id_counter += 1
-		client={
-			'id'      : self.id_counter,
-			'handler' : handler,
-			'address' : handler.client_address
-		}
-		self.clients.append(client)
+		client=Client(self.id_counter, handler, handler.client_address)
+		self.clients.add(client)
+		if self.heartbeat is None and (self.ping_interval or self.idle_timeout or
+		                               self.stream_threshold and self.stream_read_timeout):
+			self.heartbeat = Heartbeat(self)
+			self.heartbeat.start()
 		self.new_client(client, self)
 
+	def _stream_received_(self, handler, opcode, chunk, first, last, total):
+		self.stream_received(self.handler_to_client(handler), self, opcode, chunk, first, last, total)
+
+	def _stream_aborted_(self, handler):
+		self.stream_aborted(self.handler_to_client(handler), self)
+
 	def _client_left_(self, handler):
 		client=self.handler_to_client(handler)
+		if client is None:
+			return   # handshake not completed
 		self.client_left(client, self)
-		if client in self.clients:
-			self.clients.remove(client)
+		self.clients.remove(client)
 	
 	def _unicast_(self, to_client, msg):
-		to_client['handler'].send_message(msg)
+		to_client.handler.send_message(msg)
 
 	def _multicast_(self, msg):
-		for client in self.clients:
-			self._unicast_(client, msg)
+		payload = make_text_payload(msg)
+		if payload is None:
+			return
+		self._multicast_payload_(payload, OPCODE_TEXT)
 
 	def _multicast2_(self, exc_client, msg):
+		payload = make_text_payload(msg)
+		if payload is None:
+			return
+		self._multicast_payload_(payload, OPCODE_TEXT, exc_client)
+
+	def _multicast_frame_(self, frame, clients=None):
+		# Fragment to every client, never compressed. Waits for room in the
+		# queues of slow clients, for all of them together up to
+		# stream_send_timeout; a client still full then is disconnected.
+		deadline = monotonic() + self.stream_send_timeout
+		for client in (self.clients if clients is None else clients):
+			client.handler.send_frame(frame, wait=max(0.0, deadline - monotonic()))
+
+	def _multicast_payload_(self, payload, opcode, exc_client=None):
+		# Frame is built once and the same bytes are sent to every client.
+		# Compressing clients with context takeover need a frame of their own;
+		# without context takeover the compressed frame is shared as well.
+		frames = {}
 		for client in self.clients:
-			if client['id'] != exc_client['id']:
-				self._unicast_(client, msg)
+			if client is exc_client:
+				continue
+			handler = client.handler
+			deflate = handler.deflate
+			if deflate is None or len(payload) < self.deflate_min_size:
+				if None not in frames:
+					frames[None] = encode_frame(payload, opcode)
+				handler.send_frame(frames[None])
+			elif deflate.server_no_context_takeover:
+				if deflate.window_bits not in frames:
+					frames[deflate.window_bits] = deflate.encode_frame(payload, opcode)
+				handler.send_frame(frames[deflate.window_bits])
+			else:
+				handler.send_payload(payload, opcode)
 		
 	def handler_to_client(self, handler):
-		for client in self.clients:
-			if client['handler'] == handler:
-				return client
+		return self.clients.by_handler(handler)
+
+	def id_to_client(self, id):
+		return self.clients.by_id(id)
+
+
+
+class Client(object):
+	'''
+	Record of a connected client. Uses __slots__: no dict per client.
+	'''
+	__slots__ = ('id', 'handler', 'address')
+
+	def __init__(self, id, handler, address):
+		self.id = id
+		self.handler = handler
+		self.address = address
+
+	def __getitem__(self, key):
+		# client['id'] as with the former dict records
+		try:
+			return getattr(self, key)
+		except AttributeError:
+			raise KeyError(key)
+
+
+
+class ClientRegistry(object):
+	'''
+	Connected clients indexed by handler and by id; lookups are O(1).
+	Iteration is over a snapshot, so clients may connect or leave meanwhile.
+	'''
+
+	def __init__(self):
+		self._by_id = {}
+		self._by_handler = {}
+		self._lock = threading.Lock()
+
+	def add(self, client):
+		with self._lock:
+			self._by_id[client.id] = client
+			self._by_handler[client.handler] = client
+
+	def remove(self, client):
+		with self._lock:
+			self._by_id.pop(client.id, None)
+			self._by_handler.pop(client.handler, None)
+
+	def by_id(self, id):
+		return self._by_id.get(id)
+
+	def by_handler(self, handler):
+		return self._by_handler.get(handler)
+
+	def __contains__(self, client):
+		return self._by_id.get(client.id) is client
+
+	def __len__(self):
+		return len(self._by_id)
+
+	def __iter__(self):
+		with self._lock:
+			clients = list(self._by_id.values())
+		return iter(clients)
 
 
 
@@ -160,13 +392,57 @@ class WebSocketHandler(StreamRequestHandler):
 		self.keep_alive = True
 		self.handshake_done = False
 		self.valid_client = False
+		self.out_queue = None
+		self.fragments = None   # payloads of fragmented message being received
+		self.fragments_opcode = None
+		self.fragments_compressed = False
+		self.fragments_size = 0
+		self.streaming = False  # message being passed on in chunks
+		self.stream_deadline = None    # streamed message must be complete before (monotonic)
+		self.closing = False    # close frame queued
+		self.deflate = None     # PerMessageDeflate if negotiated
+		self.send_lock = threading.Lock()
+		self.last_seen = monotonic()   # time of last frame from client
+		self.ping_sent = None          # time of ping without pong yet
+		set_socket_options(self.request, self.server.tcp_nodelay,
+		                   self.server.sndbuf_size, self.server.rcvbuf_size)
+		if isinstance(self.request, TLS_SOCKET):
+			self.keep_alive = self.tls_handshake()
+
+	def tls_handshake(self):
+		'''
+		TLS handshake within handshake_timeout. A browser that connected
+		before resumes its session (session cache or ticket): no full handshake.
+		Returns False if the handshake failed.
+		'''
+		server = self.server
+		t0 = perf_clock()
+		try:
+			self.request.settimeout(server.handshake_timeout or None)
+			self.request.do_handshake()
+			self.request.settimeout(None)
+		except (socket.error, ValueError) as e:
+			server.tls_stats.failures += 1
+			print("TLS handshake failed -- %s" % e)
+			return False
+		seconds = perf_clock() - t0
+		resumed = self.request.session_reused
+		server.tls_stats.add(seconds, resumed)
+		if server.tls_timer is not None:
+			server.tls_timer(seconds, resumed)
+		return True
 
 	def handle(self):
-		while self.keep_alive:
-			if not self.handshake_done:
-				self.handshake()
-			elif self.valid_client:
-				self.read_next_message()
+		try:
+			while self.keep_alive:
+				if not self.handshake_done:
+					self.handshake()
+				elif self.valid_client:
+					self.read_next_message()
+		except (socket.error, ValueError):
+			if not isinstance(self.request, TLS_SOCKET):
+				raise
+			self.keep_alive = False   # TLS connection broken or closed by disconnect
 
 	def read_bytes(self, num):
 		# python3 gives ordinal of byte directly
@@ -178,17 +454,20 @@ class WebSocketHandler(StreamRequestHandler):
 
 	def read_next_message(self):
 
-		b1, b2 = self.read_bytes(2)
+		header = self.read_bytes(2)
+		if len(header) < 2:
+			print("Client closed connection.")
+			self.keep_alive = 0
+			return
+		b1, b2 = header
+		t0 = perf_clock()
 
 		fin    = b1 & FIN
+		rsv1   = b1 & RSV1
 		opcode = b1 & OPCODE
 		masked = b2 & MASKED
 		payload_length = b2 & PAYLOAD_LEN
 
-		if not b1:
-			print("Client closed connection.")
-			self.keep_alive = 0
-			return
 		if opcode == CLOSE_CONN:
 			print("Client asked to close connection.")
 			self.keep_alive = 0
@@ -203,12 +482,172 @@ class WebSocketHandler(StreamRequestHandler):
 		elif payload_length == 127:
 			payload_length = struct.unpack(">Q", self.rfile.read(8))[0]
 
-		masks = self.read_bytes(4)
-		decoded = ""
-		for char in self.read_bytes(payload_length):
-			char ^= masks[len(decoded) % 4]
-			decoded += chr(char)
-		self.server._message_received_(self, decoded)
+		if not self.check_frame_size(opcode, payload_length):
+			return
+
+		masks = self.rfile.read(4)
+		server = self.server
+		if server.stream_threshold and opcode in (OPCODE_TEXT, OPCODE_BINARY, OPCODE_CONTINUATION) and \
+		   not rsv1 and not self.fragments_compressed and \
+		   (self.streaming or payload_length > server.stream_threshold or
+		    (self.fragments is not None and self.fragments_size + payload_length > server.stream_threshold)):
+			self.stream_frame(fin, opcode, masks, payload_length)
+			self.last_seen = monotonic()
+			return
+		payload = unmask_payload(masks, self.rfile.read(payload_length))
+		self.last_seen = monotonic()
+
+		# Control frames may come between the frames of a fragmented message
+		if opcode == OPCODE_PING:
+			self.send_frame(encode_frame(payload, OPCODE_PONG))
+			return
+		if opcode == OPCODE_PONG:
+			self.ping_sent = None
+			return
+
+		# Fragmented messages: first frame has opcode text/binary without FIN,
+		# next frames are continuation frames; the last one has FIN.
+		if opcode == OPCODE_CONTINUATION:
+			if self.fragments is None:
+				print("Continuation frame without start of message.")
+				self.keep_alive = 0
+				return
+			self.fragments.append(payload)
+			self.fragments_size += len(payload)
+			if not fin:
+				return
+			payload = bytes().join(self.fragments)
+			opcode = self.fragments_opcode
+			rsv1 = self.fragments_compressed
+			self.fragments = None
+		elif opcode in (OPCODE_TEXT, OPCODE_BINARY):
+			if not fin:
+				self.fragments = [payload]
+				self.fragments_opcode = opcode
+				self.fragments_compressed = rsv1
+				self.fragments_size = len(payload)
+				return
+		else:
+			print("Unsupported opcode %d, frame ignored." % opcode)
+			return
+
+		if rsv1:
+			if self.deflate is None:
+				print("Compressed message but permessage-deflate not negotiated.")
+				self.keep_alive = 0
+				return
+			try:
+				payload = self.deflate.decompress(payload, self.server.max_message_size)
+			except zlib.error as e:
+				print("Could not decompress message -- %s" % e)
+				self.keep_alive = 0
+				return
+			if payload is None:
+				print("Decompressed message larger than %d bytes: disconnecting." % self.server.max_message_size)
+				self.send_close(CLOSE_TOO_BIG)
+				return
+
+		timer = self.server.stage_timer
+		if opcode == OPCODE_BINARY:
+			if timer is not None:
+				timer('ws_read', perf_clock() - t0)
+			self.server._binary_received_(self, payload)
+		else:
+			try:
+				decoded = payload.decode('utf-8')
+			except UnicodeDecodeError:
+				print("Text message is not valid UTF-8: disconnecting.")
+				self.send_close(CLOSE_INVALID_DATA)
+				return
+			if timer is not None:
+				timer('ws_read', perf_clock() - t0)
+			self.server._message_received_(self, decoded)
+
+	def check_frame_size(self, opcode, payload_length):
+		'''
+		Frame size checked before anything is read or allocated.
+		Returns False if the connection is closed.
+		'''
+		server = self.server
+		if opcode & 0x8 and payload_length > 125:
+			print("Control frame larger than 125 bytes: disconnecting.")
+			self.send_close(CLOSE_PROTOCOL_ERROR)
+			return False
+		if server.max_frame_size and payload_length > server.max_frame_size:
+			print("Frame of %d bytes larger than %d: disconnecting." % (payload_length, server.max_frame_size))
+			self.send_close(CLOSE_TOO_BIG)
+			return False
+		size = payload_length
+		if opcode == OPCODE_CONTINUATION and (self.fragments is not None or self.streaming):
+			size += self.fragments_size   # all frames of the message
+		if server.max_message_size and size > server.max_message_size:
+			print("Message larger than %d bytes: disconnecting." % server.max_message_size)
+			self.send_close(CLOSE_TOO_BIG)
+			return False
+		return True
+
+	def stream_frame(self, fin, opcode, masks, length):
+		'''
+		Payload read and passed on in chunks of stream_chunk_size; only one
+		chunk is in memory. A fragmented message keeps streaming until FIN.
+		'''
+		server = self.server
+		first = not self.streaming
+		if first and server.stream_read_timeout:
+			self.stream_deadline = monotonic() + server.stream_read_timeout   # checked by Heartbeat
+		if opcode == OPCODE_CONTINUATION:
+			if first and self.fragments is None:
+				print("Continuation frame without start of message.")
+				self.keep_alive = 0
+				return
+			opcode = self.fragments_opcode
+		if first and self.fragments is None:
+			self.fragments_size = 0
+		self.fragments_size += length
+		if first and self.fragments:
+			# buffered start of a fragmented message is the first chunk
+			self.streaming = True
+			server._stream_received_(self, opcode, bytes().join(self.fragments), True, False, None)
+			first = False
+		self.fragments = None
+		self.fragments_opcode = opcode
+		self.streaming = True
+		total = length if first and fin else None   # size known for a message of one frame
+		chunk_size = max(4, server.stream_chunk_size - server.stream_chunk_size % 4)   # mask alignment
+		remaining = length
+		while True:
+			n = min(chunk_size, remaining)
+			data = self.rfile.read(n)
+			if len(data) < n:
+				print("Client closed connection.")
+				self.keep_alive = 0
+				return   # stream aborted in finish
+			remaining -= n
+			self.last_seen = monotonic()
+			last = fin and remaining == 0
+			if last:
+				self.streaming = False
+				self.stream_deadline = None
+			server._stream_received_(self, opcode, unmask_payload(masks, data), first, last, total)
+			first = False
+			if remaining == 0:
+				break
+
+	def send_close(self, status):
+		# Close frame with status code, then the connection is closed
+		self.closing = True
+		self.keep_alive = 0
+		self.send_frame(encode_frame(struct.pack(">H", status), CLOSE_CONN))
+
+	def abort_stream(self):
+		# Streamed message not complete before stream_deadline: close frame,
+		# and the read side shut down to wake up the reading thread (the
+		# writer thread still sends the close frame). The stream is aborted in finish.
+		self.send_close(CLOSE_POLICY_VIOLATION)
+		try:
+			socket.socket.shutdown(self.request, socket.SHUT_RD)
+		except socket.error:
+			pass
 
 	def send_message(self, message):
 		self.send_text(message)
@@ -219,80 +658,760 @@ class WebSocketHandler(StreamRequestHandler):
 		Fragmented(=continuation) messages are not being used since their usage
 		is needed in very limited cases - when we don't know the payload length.
 		'''
-	
-		# Validate message
-		if isinstance(message, bytes):
-			message = try_decode_UTF8(message) # this is slower but assures we have UTF-8
-			if not message:
-				print("Can\'t send message, message is not valid UTF-8")
-				return False
-		elif isinstance(message, str) or isinstance(message, unicode):
-			pass
-		else:
-			print('Can\'t send message, message has to be a string or bytes. Given type is %s' % type(message))
+		payload = make_text_payload(message)
+		if payload is None:
 			return False
+		self.send_payload(payload, OPCODE_TEXT)
 
-		header  = bytearray()
-		payload = encode_to_UTF8(message)
-		payload_length = len(payload)
-
-		# Normal payload
-		if payload_length <= 125:
-			header.append(FIN | OPCODE_TEXT)
-			header.append(payload_length)
-
-		# Extended payload
-		elif payload_length >= 126 and payload_length <= 65535:
-			header.append(FIN | OPCODE_TEXT)
-			header.append(PAYLOAD_LEN_EXT16)
-			header.extend(struct.pack(">H", payload_length))
-
-		# Huge extended payload
-		elif payload_length < 18446744073709551616:
-			header.append(FIN | OPCODE_TEXT)
-			header.append(PAYLOAD_LEN_EXT64)
-			header.extend(struct.pack(">Q", payload_length))
-			
-		else:
-			raise Exception("Message is too big. Consider breaking it into chunks.")
+	def send_binary(self, data):
+		self.send_payload(bytes(data), OPCODE_BINARY)
+
+	def send_payload(self, payload, opcode):
+		# Compressed if permessage-deflate negotiated and payload large enough
+		if self.deflate is None or len(payload) < self.server.deflate_min_size:
+			self.send_frame(encode_frame(payload, opcode))
 			return
+		with self.send_lock:
+			# compression context: frames must be queued in compression order
+			self.send_frame(self.deflate.encode_frame(payload, opcode))
+
+	def send_frame(self, frame, wait=False):
+		# frame: complete websocket frame (bytes), see encode_frame
+		# Queued for the writer thread of this client; never blocks the caller,
+		# unless wait: blocks while the queue is full, up to stream_send_timeout
+		# (wait True) or wait seconds.
+		timeout = None
+		if wait is True:
+			timeout = self.server.stream_send_timeout
+		elif wait is not False:
+			timeout = wait
+		if self.out_queue is None:
+			self.request.send(frame)
+		elif not self.out_queue.put(frame, timeout):
+			print("Client too slow, outbound queue full: disconnecting.")
+			self.disconnect()
+
+	def queue_depth(self):
+		if self.out_queue is None:
+			return 0
+		return len(self.out_queue)
+
+	def start_writer(self):
+		self.out_queue = OutboundQueue(self.server.out_queue_size, self.server.slow_consumer_policy)
+		self.writer = threading.Thread(target=self.write_frames)
+		self.writer.daemon = True
+		self.writer.start()
 
-		self.request.send(header + payload)
+	def write_frames(self):
+		# Writer thread: drain the outbound queue to the client socket
+		while True:
+			frames = self.out_queue.get_all()   # all pending frames in one write
+			if frames is None:
+				break
+			timer = self.server.stage_timer
+			if timer is not None:
+				t0 = perf_clock()
+				timer('ws_queue', t0 - self.out_queue.batch_since)
+			try:
+				sendall_buffers(self.request, frames)
+			except socket.error:
+				self.disconnect()
+				break
+			if timer is not None:
+				timer('ws_write', perf_clock() - t0)
+
+	def disconnect(self):
+		self.keep_alive = False
+		try:
+			if isinstance(self.request, TLS_SOCKET):
+				# socket shut down without unwrapping TLS: nothing can be sent in plain text
+				socket.socket.shutdown(self.request, socket.SHUT_RDWR)
+			else:
+				self.request.shutdown(socket.SHUT_RDWR)   # wakes up reading thread
+		except socket.error:
+			pass
 
 	def handshake(self):
-		message = self.request.recv(1024).decode().strip()
-		upgrade = re.search('\nupgrade[\s]*:[\s]*websocket', message.lower())
-		if not upgrade:
+		request = self.read_handshake()
+		if request is None:
 			self.keep_alive = False
 			return
-		key = re.search('\n[sS]ec-[wW]eb[sS]ocket-[kK]ey[\s]*:[\s]*(.*)\r\n', message)
-		if key:
-			key = key.group(1)
-		else:
+		if not request.is_upgrade():
+			self.answer_http(request.path)
+			self.keep_alive = False
+			return
+		key = request.key()
+		if key is None:
 			print("Client tried to connect but was missing a key")
 			self.keep_alive = False
 			return
-		response = self.make_handshake_response(key)
+		extensions = None
+		if self.server.deflate:
+			self.deflate = negotiate_deflate(request.header('sec-websocket-extensions'), self.server)
+			if self.deflate is not None:
+				extensions = self.deflate.response_header()
+		response = make_handshake_response(key, extensions)
 		self.handshake_done = self.request.send(response.encode())
 		self.valid_client = True
+		self.start_writer()
 		self.server._new_client_(self)
 		
+	def read_handshake(self):
+		'''
+		Reads the http request until the empty line after the headers, in as
+		many tcp segments as it takes. Bytes after the headers (a first frame)
+		stay in rfile. Returns the HandshakeRequest, or None if the client
+		closed the connection, missed the deadline or sent a bad request.
+		'''
+		server = self.server
+		request = HandshakeRequest(server.handshake_max_size, server.handshake_max_headers)
+		deadline = monotonic() + server.handshake_timeout if server.handshake_timeout else None
+		peek = getattr(self.rfile, 'peek', None)   # Python 3: no copy of buffered bytes
+		try:
+			while not request.complete:
+				if deadline is not None:
+					remaining = deadline - monotonic()
+					if remaining <= 0:
+						raise socket.timeout()
+					self.request.settimeout(remaining)
+				if peek is not None:
+					data = peek(1)
+					if not data:
+						return None
+					self.rfile.read(request.feed(data))
+				else:
+					data = self.rfile.readline(server.handshake_max_size + 1)
+					if not data:
+						return None
+					request.feed(data)
+		except socket.timeout:
+			print("Client handshake not completed within %s seconds" % server.handshake_timeout)
+			return None
+		except socket.error:
+			return None
+		except HandshakeError as e:
+			self.answer_error(e.status)
+			return None
+		finally:
+			try:
+				self.request.settimeout(None)
+			except socket.error:
+				pass
+		return request
+
+	def answer_error(self, status):
+		try:
+			self.request.sendall(('HTTP/1.1 %s\r\nContent-Length: 0\r\n'
+			                      'Connection: close\r\n\r\n' % status).encode())
+		except socket.error:
+			pass
+
 	def make_handshake_response(self, key):
-		return \
-		  'HTTP/1.1 101 Switching Protocols\r\n'\
-		  'Upgrade: websocket\r\n'              \
-		  'Connection: Upgrade\r\n'             \
-		  'Sec-WebSocket-Accept: %s\r\n'        \
-		  '\r\n' % self.calculate_response_key(key)
+		return make_handshake_response(key)
+
+	def answer_http(self, path):
+		# Plain http request on the websocket port, e.g. GET /metrics
+		if path is None:
+			return
+		try:
+			result = self.server.http_request(path)
+		except Exception as e:
+			print("Error answering http request %s -- %s" % (path, e))
+			result = None
+		if result is None:
+			status, content_type, body = '404 Not Found', 'text/plain', 'Not found\n'
+		else:
+			status, (content_type, body) = '200 OK', result
+		body = body.encode('UTF-8')
+		header = 'HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n' \
+		         'Connection: close\r\n\r\n' % (status, content_type, len(body))
+		try:
+			self.request.sendall(header.encode() + body)
+		except socket.error:
+			pass
 		
 	def calculate_response_key(self, key):
-		GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
-		hash = sha1(key.encode() + GUID.encode())
-		response_key = b64encode(hash.digest()).strip()
-		return response_key.decode('ASCII')
+		return calculate_response_key(key)
 
 	def finish(self):
+		if self.streaming:
+			self.server._stream_aborted_(self)
 		self.server._client_left_(self)
+		if self.out_queue is not None:
+			self.out_queue.close(drain=self.closing)
+			if self.closing:
+				self.writer.join(1.0)   # close frame written before the socket is closed
+
+
+
+class Heartbeat(threading.Thread):
+	'''
+	One timer thread per server for all clients (no timer per connection).
+	Every tick, clients silent for ping_interval get a ping (one frame shared
+	by all) and clients silent for idle_timeout are disconnected: half-open
+	connections leave the registry and broadcasts stop going to them.
+	A pong or any other frame from the client counts as alive.
+	A client streaming a message longer than stream_read_timeout is disconnected.
+	'''
+
+	def __init__(self, server):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.server = server
+		self.stopped = threading.Event()
+		self.pings = 0
+		self.evicted = 0
+
+	def tick_seconds(self):
+		server = self.server
+		intervals = [t for t in (server.ping_interval, server.idle_timeout,
+		                         server.stream_threshold and server.stream_read_timeout) if t]
+		return max(0.1, min(intervals) / 2.0)
+
+	def run(self):
+		while not self.stopped.wait(self.tick_seconds()):
+			self.tick(monotonic())
+
+	def tick(self, now):
+		server = self.server
+		ping_frame = None
+		for client in server.clients:
+			handler = client.handler
+			if not handler.keep_alive:
+				continue   # disconnecting
+			if handler.stream_deadline is not None and now >= handler.stream_deadline:
+				print("Client(%d) streamed message not complete in %g seconds: disconnecting." %
+				      (client.id, server.stream_read_timeout))
+				handler.abort_stream()
+				continue
+			silent = now - handler.last_seen
+			if server.idle_timeout and silent >= server.idle_timeout:
+				print("Client(%d) silent for %d seconds: disconnecting." % (client.id, silent))
+				self.evicted += 1
+				handler.disconnect()
+			elif server.ping_interval and silent >= server.ping_interval and \
+			     (handler.ping_sent is None or handler.ping_sent < handler.last_seen):
+				if ping_frame is None:
+					ping_frame = encode_frame(b'', OPCODE_PING)
+				handler.ping_sent = now
+				self.pings += 1
+				handler.send_frame(ping_frame)
+
+	def stop(self):
+		self.stopped.set()
+
+
+
+class OutboundQueue(object):
+	'''
+	Bounded queue of frames for one client, drained by its writer thread.
+	If the queue is full the policy decides:
+	  drop_oldest: oldest frame is discarded
+	  drop_newest: new frame is discarded
+	  disconnect : put returns False, the client has to be disconnected
+	'''
+
+	def __init__(self, maxsize, policy='drop_oldest'):
+		if policy not in ('drop_oldest', 'drop_newest', 'disconnect'):
+			raise Exception("Unknown slow consumer policy: %s" % policy)
+		self.maxsize = maxsize
+		self.policy = policy
+		self.frames = deque()
+		self.dropped = 0
+		self.closed = False
+		self.cond = threading.Condition()
+		self.since = 0.0         # time the oldest pending frame was queued (perf_clock)
+		self.batch_since = 0.0   # same for the frames of the last get_all
+
+	def __len__(self):
+		return len(self.frames)
+
+	def put(self, frame, timeout=None):
+		# timeout: wait up to timeout seconds for room instead of the policy
+		# (fragments of a streamed message must not be dropped)
+		with self.cond:
+			if timeout is not None:
+				deadline = monotonic() + timeout
+				while len(self.frames) >= self.maxsize and not self.closed:
+					remaining = deadline - monotonic()
+					if remaining <= 0:
+						return False
+					self.cond.wait(remaining)
+			if self.closed:
+				return True   # client gone; frame discarded
+			if len(self.frames) >= self.maxsize:
+				if self.policy == 'disconnect':
+					return False
+				self.dropped += 1
+				if self.policy == 'drop_newest':
+					return True
+				self.frames.popleft()
+			if not self.frames:
+				self.since = perf_clock()
+			self.frames.append(frame)
+			self.cond.notify()
+		return True
+
+	def get_all(self):
+		# Blocks until frames are available; returns list of all pending frames,
+		# None if queue closed
+		with self.cond:
+			while not self.frames and not self.closed:
+				self.cond.wait()
+			if not self.frames:
+				return None   # closed
+			frames = list(self.frames)
+			self.frames.clear()
+			self.batch_since = self.since
+			self.cond.notify_all()   # room for waiting fragments
+			return frames
+
+	def close(self, drain=False):
+		# drain: frames still pending are written first (e.g. a close frame)
+		with self.cond:
+			self.closed = True
+			if not drain:
+				self.frames.clear()
+			self.cond.notify()
+
+
+
+IOV_MAX = 1024   # max buffers in one sendmsg call
+
+def sendall_buffers(sock, buffers):
+	'''
+	Write all buffers completely, with one scatter-gather sendmsg call if
+	possible (no concatenation). Partial writes are continued.
+	'''
+	if len(buffers) == 1 or not hasattr(sock, 'sendmsg') or isinstance(sock, TLS_SOCKET):
+		sock.sendall(bytes().join(buffers))   # TLS: encrypted in records anyway
+		return
+	views = [memoryview(buffer) for buffer in buffers]
+	first = 0
+	while first < len(views):
+		sent = sock.sendmsg(views[first:first + IOV_MAX])
+		while sent > 0:
+			size = len(views[first])
+			if sent >= size:
+				sent -= size
+				first += 1
+			else:
+				views[first] = views[first][sent:]
+				sent = 0
+
+
+
+def set_socket_options(sock, nodelay=False, sndbuf=0, rcvbuf=0):
+	'''
+	Nagle algorithm off (nodelay) and socket buffer sizes (0: system default).
+	'''
+	try:
+		if nodelay:
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		if sndbuf:
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+		if rcvbuf:
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+	except (socket.error, AttributeError) as e:
+		print("Could not set socket options -- %s" % e)
+
+
+
+class HandshakeError(Exception):
+	'''
+	Bad http upgrade request; status is the http answer.
+	'''
+	def __init__(self, status, message):
+		Exception.__init__(self, message)
+		self.status = status
+
+
+
+class HandshakeRequest(object):
+	'''
+	Incremental parser of the http upgrade request. Data is fed as it is
+	received (any split in tcp segments); every complete line is parsed
+	at once with precompiled patterns, so size and header limits apply
+	before the whole request is buffered.
+	  request.method, request.path : of the request line
+	  request.headers              : lower case name => value
+	  request.complete             : True after the empty line
+	'''
+	REQUEST_LINE = re.compile(br'^([A-Z]+)[ ]+([^ ]+)(?:[ ]+HTTP/\d\.\d)?$')
+	HEADER_LINE = re.compile(br'^([!#$%&\'*+.^_`|~0-9A-Za-z-]+)[ \t]*:[ \t]*(.*?)[ \t]*$')
+
+	def __init__(self, max_size=8192, max_headers=64):
+		self.max_size = max_size
+		self.max_headers = max_headers
+		self.size = 0
+		self.line = b''        # incomplete line of previous feed
+		self.method = None
+		self.path = None
+		self.headers = {}
+		self.complete = False
+
+	def feed(self, data):
+		'''
+		Parses data; returns the number of bytes used. Bytes after the end
+		of the headers are not used. Raises HandshakeError for a bad request.
+		'''
+		data = bytes(data)
+		start = 0
+		while not self.complete:
+			end = data.find(b'\n', start)
+			if end < 0:
+				self.add_size(len(data) - start)
+				self.line += data[start:]
+				return len(data)
+			self.add_size(end + 1 - start)
+			line = self.line + data[start:end]
+			self.line = b''
+			start = end + 1
+			self.parse_line(line.rstrip(b'\r'))
+		return start
+
+	def add_size(self, n):
+		self.size += n
+		if self.size > self.max_size:
+			raise HandshakeError('431 Request Header Fields Too Large', 'request larger than %d bytes' % self.max_size)
+
+	def parse_line(self, line):
+		if self.method is None:
+			match = self.REQUEST_LINE.match(line)
+			if not match:
+				raise HandshakeError('400 Bad Request', 'bad request line')
+			self.method = match.group(1).decode('latin-1')
+			self.path = match.group(2).decode('latin-1')
+		elif not line:
+			self.complete = True
+		else:
+			match = self.HEADER_LINE.match(line)
+			if not match:
+				raise HandshakeError('400 Bad Request', 'bad header line')
+			if len(self.headers) >= self.max_headers:
+				raise HandshakeError('431 Request Header Fields Too Large', 'more than %d headers' % self.max_headers)
+			name = match.group(1).decode('latin-1').lower()
+			value = match.group(2).decode('latin-1')
+			if name in self.headers:
+				value = self.headers[name] + ', ' + value   # repeated header
+			self.headers[name] = value
+
+	def header(self, name):
+		return self.headers.get(name)
+
+	def is_upgrade(self):
+		return self.method == 'GET' and 'websocket' in self.headers.get('upgrade', '').lower()
+
+	def key(self):
+		key = self.headers.get('sec-websocket-key')
+		return key or None
+
+
+
+def make_handshake_response(key, extensions=None):
+	if extensions:
+		extensions = 'Sec-WebSocket-Extensions: %s\r\n' % extensions
+	return \
+	  'HTTP/1.1 101 Switching Protocols\r\n'\
+	  'Upgrade: websocket\r\n'              \
+	  'Connection: Upgrade\r\n'             \
+	  'Sec-WebSocket-Accept: %s\r\n'        \
+	  '%s'                                  \
+	  '\r\n' % (calculate_response_key(key), extensions or '')
+
+
+
+def calculate_response_key(key):
+	GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+	hash = sha1(key.encode() + GUID.encode())
+	response_key = b64encode(hash.digest()).strip()
+	return response_key.decode('ASCII')
+
+
+
+def make_text_payload(message):
+	'''
+	Returns the UTF-8 payload of a text message (str or UTF-8 bytes),
+	or None if message can't be sent.
+	'''
+	if isinstance(message, bytes):
+		message = try_decode_UTF8(message) # this is slower but assures we have UTF-8
+		if message is False:
+			print("Can\'t send message, message is not valid UTF-8")
+			return None
+	elif isinstance(message, str) or isinstance(message, unicode):
+		pass
+	else:
+		print('Can\'t send message, message has to be a string or bytes. Given type is %s' % type(message))
+		return None
+	payload = encode_to_UTF8(message)
+	if payload is False:
+		return None   # e.g. lone surrogate; message printed by encode_to_UTF8
+	return payload
+
+
+
+def encode_frame(payload, opcode=OPCODE_TEXT, rsv1=False, fin=True):
+	'''
+	Returns a complete unmasked server frame (header + payload) as bytes.
+	fin=False for all but the last frame of a fragmented message.
+	'''
+	header  = bytearray()
+	payload_length = len(payload)
+	if rsv1:
+		opcode |= RSV1
+	if fin:
+		opcode |= FIN
+
+	# Normal payload
+	if payload_length <= 125:
+		header.append(opcode)
+		header.append(payload_length)
+
+	# Extended payload
+	elif payload_length >= 126 and payload_length <= 65535:
+		header.append(opcode)
+		header.append(PAYLOAD_LEN_EXT16)
+		header.extend(struct.pack(">H", payload_length))
+
+	# Huge extended payload
+	elif payload_length < 18446744073709551616:
+		header.append(opcode)
+		header.append(PAYLOAD_LEN_EXT64)
+		header.extend(struct.pack(">Q", payload_length))
+
+	else:
+		raise Exception("Message is too big. Consider breaking it into chunks.")
+
+	return bytes(header + payload)
+
+
+
+class DeflateStats(object):
+	'''
+	Counters of permessage-deflate compression of all clients of a server.
+	'''
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.messages_out = 0
+		self.bytes_raw_out = 0
+		self.bytes_compressed_out = 0
+		self.messages_in = 0
+		self.bytes_compressed_in = 0
+		self.bytes_raw_in = 0
+		self.cpu_time = 0.0
+
+	def add_out(self, raw, compressed, cpu):
+		with self.lock:
+			self.messages_out += 1
+			self.bytes_raw_out += raw
+			self.bytes_compressed_out += compressed
+			self.cpu_time += cpu
+
+	def add_in(self, compressed, raw, cpu):
+		with self.lock:
+			self.messages_in += 1
+			self.bytes_compressed_in += compressed
+			self.bytes_raw_in += raw
+			self.cpu_time += cpu
+
+	def ratio(self):
+		# compressed size / original size of sent messages
+		if not self.bytes_raw_out:
+			return 1.0
+		return float(self.bytes_compressed_out) / self.bytes_raw_out
+
+
+
+class TlsStats(object):
+	'''
+	Counters of the TLS handshakes of a server
+	'''
+
+	def __init__(self):
+		self.handshakes = 0
+		self.resumed = 0     # sessions resumed (session cache or ticket)
+		self.failures = 0
+		self.seconds = 0.0   # time of all completed handshakes
+
+	def add(self, seconds, resumed):
+		self.handshakes += 1
+		self.seconds += seconds
+		if resumed:
+			self.resumed += 1
+
+
+
+def make_ssl_context(certfile, keyfile=None, num_tickets=2):
+	'''
+	Server context for TLS 1.2 and newer with certificate chain and key (PEM).
+	Resumption:
+	- num_tickets > 0: session tickets, the session state is kept by the client,
+	  encrypted with a ticket key of this context. TLS 1.3: num_tickets tickets
+	  per handshake (Python 3.8+, else the OpenSSL default).
+	- num_tickets 0: no tickets (OP_NO_TICKET); a TLS 1.3 handshake is always full.
+	The session id cache of OpenSSL is left as it is (on, default size and
+	timeout; the ssl module cannot configure it): a TLS 1.2 client can also
+	resume by session id, but only a session that was closed with a TLS
+	shutdown (close_notify). Counters: context.session_stats().
+	Ticket keys and cache belong to the context (not shared between processes).
+	'''
+	context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+	if hasattr(context, 'minimum_version'):
+		context.minimum_version = ssl.TLSVersion.TLSv1_2
+	else:
+		context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1
+	context.load_cert_chain(certfile, keyfile)
+	# no renegotiation: the reader and writer thread of a client share the socket
+	context.options |= getattr(ssl, 'OP_NO_RENEGOTIATION', 0)
+	if num_tickets:
+		if hasattr(context, 'num_tickets'):
+			context.num_tickets = num_tickets
+	else:
+		context.options |= ssl.OP_NO_TICKET
+		if hasattr(context, 'num_tickets'):
+			context.num_tickets = 0
+	context.set_ciphers('ECDHE+AESGCM:ECDHE+CHACHA20')   # TLS 1.2; TLS 1.3 suites are not affected
+	return context
+
+
+
+class PerMessageDeflate(object):
+	'''
+	permessage-deflate (RFC 7692) state of one client.
+	A message is compressed as a raw deflate stream, flushed with Z_SYNC_FLUSH;
+	the 4 trailing bytes 00 00 ff ff are removed for sending and added again
+	for receiving. Without context takeover a new compressor is used per message.
+	'''
+	TAIL = b'\x00\x00\xff\xff'
+
+	def __init__(self, server_no_context_takeover=False, client_no_context_takeover=False,
+	             window_bits=15, client_window_bits=None, level=6, stats=None):
+		self.server_no_context_takeover = server_no_context_takeover
+		self.client_no_context_takeover = client_no_context_takeover
+		self.window_bits = window_bits
+		self.client_window_bits = client_window_bits
+		self.level = level
+		self.stats = stats
+		self.compressor = None
+		self.decompressor = None
+
+	def response_header(self):
+		params = ['permessage-deflate']
+		if self.server_no_context_takeover:
+			params.append('server_no_context_takeover')
+		if self.client_no_context_takeover:
+			params.append('client_no_context_takeover')
+		if self.window_bits < 15:
+			params.append('server_max_window_bits=%d' % self.window_bits)
+		if self.client_window_bits is not None:
+			params.append('client_max_window_bits=%d' % self.client_window_bits)
+		return '; '.join(params)
+
+	def compress(self, payload):
+		t0 = cpu_time()
+		if self.compressor is None or self.server_no_context_takeover:
+			self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, -self.window_bits)
+		data = self.compressor.compress(payload) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+		if data.endswith(self.TAIL):
+			data = data[:-4]
+		if self.stats is not None:
+			self.stats.add_out(len(payload), len(data), cpu_time() - t0)
+		return data
+
+	def decompress(self, data, max_size=0):
+		'''
+		Returns the decompressed message, or None if it is larger than
+		max_size bytes (0: no limit); no more than max_size + 1 bytes are
+		inflated (compressed data can expand a thousandfold).
+		'''
+		t0 = cpu_time()
+		if self.decompressor is None or self.client_no_context_takeover:
+			self.decompressor = zlib.decompressobj(-15)
+		payload = self.decompressor.decompress(data + self.TAIL, max_size + 1 if max_size else 0)
+		if max_size and (len(payload) > max_size or self.decompressor.unconsumed_tail):
+			return None
+		if self.stats is not None:
+			self.stats.add_in(len(data), len(payload), cpu_time() - t0)
+		return payload
+
+	def encode_frame(self, payload, opcode):
+		return encode_frame(self.compress(payload), opcode, rsv1=True)
+
+
+
+def negotiate_deflate(extensions, server):
+	'''
+	Returns PerMessageDeflate for the first permessage-deflate offer in
+	extensions (value of the Sec-WebSocket-Extensions header), or None.
+	'''
+	if not extensions:
+		return None
+	for offer in extensions.split(','):
+		params = [param.strip() for param in offer.split(';')]
+		if params[0].lower() != 'permessage-deflate':
+			continue
+		options = {}
+		for param in params[1:]:
+			name, _, value = param.partition('=')
+			options[name.strip().lower()] = value.strip().strip('"')
+
+		window_bits = max(9, min(15, server.deflate_window_bits))
+		if options.get('server_max_window_bits'):
+			try:
+				requested = int(options['server_max_window_bits'])
+			except ValueError:
+				continue
+			if requested < 9:
+				continue   # zlib can't compress with a window of 256 bytes
+			window_bits = min(window_bits, requested)
+		# we accept any client window; an offered limit is answered with a
+		# value not greater than it (RFC 7692, 7.1.2.2), no value: left out
+		client_window_bits = None
+		if options.get('client_max_window_bits'):
+			try:
+				client_window_bits = int(options['client_max_window_bits'])
+			except ValueError:
+				continue
+			if not 8 <= client_window_bits <= 15:
+				continue
+		no_takeover = not server.deflate_context_takeover
+		return PerMessageDeflate(
+			server_no_context_takeover = no_takeover or 'server_no_context_takeover' in options,
+			client_no_context_takeover = 'client_no_context_takeover' in options,
+			window_bits = window_bits,
+			client_window_bits = client_window_bits,
+			level = server.deflate_level,
+			stats = server.deflate_stats)
+	return None
+
+
+
+def encode_fragment(data, opcode, first, last):
+	'''
+	Frame of a message sent in parts: the first part has the opcode,
+	the next parts are continuation frames; the last part has FIN.
+	'''
+	return encode_frame(data, opcode if first else OPCODE_CONTINUATION, fin=last)
+
+
+
+def unmask_payload(masks, payload):
+	'''
+	Unmask a client payload in bulk instead of byte by byte.
+	The 4-byte mask is repeated over the payload length and the XOR is done
+	on the whole buffer as one big integer, so the cost per byte is constant.
+	'''
+	length = len(payload)
+	if length == 0:
+		return bytes()
+	if sys.version_info[0] < 3:
+		masks = bytearray(masks)
+		return bytes(bytearray(b ^ masks[i & 3] for i, b in enumerate(bytearray(payload))))
+	key = (masks * (length // 4 + 1))[:length]
+	unmasked = int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')
+	return unmasked.to_bytes(length, 'big')
 
 
 
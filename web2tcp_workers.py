@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+"""
+|===================================================================================
+| Web2Tcp: multi-process mode                                                       |
+|===================================================================================
+| Several worker processes bind the same websocket port with SO_REUSEPORT;
+| the kernel spreads new browser connections over the workers.
+| Every worker runs the bridge in asyncio mode with its own tcp connection.
+| The supervisor (the process started from the terminal) restarts workers that
+| stop and prints the metrics of all workers together. It stops the workers on
+| Ctrl-C and SIGTERM; a worker stops by itself if the supervisor is killed.
+|
+| Start from a terminal: python web2tcp_bridge.py workers
+| Requires Python 3.7 or newer and SO_REUSEPORT (Linux, BSD).
+====================================================================================
+"""
+
+import sys, os, time
+import socket
+import signal
+import logging
+import multiprocessing
+
+try:
+   import queue
+except ImportError:
+   import Queue as queue
+
+STATS_INTERVAL = 10.0    # seconds between metrics of workers
+RESTART_DELAY = 1.0      # min seconds between restarts of a worker
+PARENT_CHECK = 1.0       # seconds between checks of a worker that the supervisor still runs
+STOP_TIMEOUT = 5.0       # max seconds to wait for a worker to stop
+
+def runWorker(workerId, ws_host, ws_port, tcp_host, tcp_port, statsQueue, initLogging, newMetrics, options,
+              parentPid):
+   # Worker process: asyncio bridge on a shared websocket port
+   # Runs until the supervisor (process parentPid) stops it or is gone
+   import asyncio
+   from web2tcp_asyncbridge import AsyncBridge
+
+   signal.signal(signal.SIGTERM, signal.SIG_DFL)   # not the handler of the supervisor (fork)
+   initLogging()
+   syslog = logging.getLogger('SYS')
+   metrics = newMetrics()
+   options = dict(options)
+   routing = options.pop('routing', 'broadcast')
+   pattern = options.pop('routing_id_pattern', None)
+   timeout = options.pop('routing_timeout', 30.0)
+   if routing != 'broadcast':
+      from web2tcp_routing import RequestRouter
+      options['router'] = RequestRouter(routing, pattern, timeout)
+   prefixes = options.pop('cache_prefixes', None)
+   cacheArgs = dict((arg, options.pop(name)) for name, arg in
+                    (('cache_ttl', 'ttl'), ('cache_max_bytes', 'maxBytes'), ('cache_max_entries', 'maxEntries'))
+                    if name in options)
+   if prefixes:
+      from web2tcp_cache import ResponseCache
+      options['cache'] = ResponseCache(prefixes, **cacheArgs)
+   certFile = options.pop('tls_cert_file', None)
+   keyFile = options.pop('tls_key_file', None)
+   tickets = options.pop('tls_tickets', 2)
+   if certFile:
+      # own context per worker: session cache and ticket keys are not shared
+      from web2tcp_websocketserver import make_ssl_context
+      options['ssl_context'] = make_ssl_context(certFile, keyFile or None, tickets)
+   bridge = AsyncBridge(ws_host, ws_port, tcp_host, tcp_port, metrics=metrics, reuse_port=True, **options)
+
+   async def reportStats():
+      while True:
+         await asyncio.sleep(STATS_INTERVAL)
+         try:
+            statsQueue.put_nowait((workerId, metrics.snapshot()))
+         except queue.Full:
+            pass
+
+   async def watchParent():
+      # Returns when the supervisor is gone (killed without stopping the workers):
+      # the worker is then adopted by another process
+      while os.getppid() == parentPid:
+         await asyncio.sleep(PARENT_CHECK)
+      syslog.error("Worker %d: supervisor (pid %d) is gone; stopping" % (workerId, parentPid))
+
+   async def serve():
+      await bridge.start()
+      syslog.info("Worker %d (pid %d) started" % (workerId, os.getpid()))
+      asyncio.ensure_future(reportStats())
+      async with bridge.server:
+         await watchParent()   # serving started by bridge.start()
+
+   try:
+      asyncio.run(serve())
+   except KeyboardInterrupt:
+      pass
+   except OSError as err:
+      syslog.error("Worker %d: %s" % (workerId, err))
+      print("Worker %d: %s" % (workerId, err))
+      sys.exit(1)
+   return None
+# def runWorker()
+
+class Supervisor:
+   # Starts the workers, restarts stopped workers and aggregates their metrics
+
+   def __init__(self, count, ws_host, ws_port, tcp_host, tcp_port, initLogging, newMetrics, **options):
+      self.count = count
+      self.args = (ws_host, ws_port, tcp_host, tcp_port)
+      self.initLogging = initLogging
+      self.newMetrics = newMetrics
+      self.options = options
+      self.statsQueue = multiprocessing.Queue(1000)
+      self.workers = {}      # workerId => multiprocessing.Process
+      self.started = {}      # workerId => start time
+      self.restarts = 0
+      self.stopping = False
+      self.stats = {}        # workerId => last metrics snapshot
+      self.retired = []      # last snapshots of stopped workers (counters kept)
+      self.syslog = logging.getLogger('SYS')
+
+   def startWorker(self, workerId):
+      args = (workerId,) + self.args + (self.statsQueue, self.initLogging, self.newMetrics, self.options,
+                                        os.getpid())
+      worker = multiprocessing.Process(target=runWorker, args=args)
+      worker.daemon = True
+      worker.start()
+      self.workers[workerId] = worker
+      self.started[workerId] = time.time()
+      return worker
+
+   def checkWorkers(self):
+      # Restart stopped workers (not more often than RESTART_DELAY)
+      for workerId, worker in list(self.workers.items()):
+         if worker.is_alive() or self.stopping: continue
+         if time.time() - self.started[workerId] < RESTART_DELAY: continue
+         self.syslog.error("Worker %d stopped (exit code %s); restarting" % (workerId, worker.exitcode))
+         print("Worker %d stopped (exit code %s); restarting" % (workerId, worker.exitcode))
+         snapshot = self.stats.pop(workerId, None)
+         if snapshot is not None:
+            snapshot['gauges'] = {}
+            self.retired.append(snapshot)
+         self.restarts += 1
+         self.startWorker(workerId)
+
+   def collectStats(self, timeout):
+      try:
+         workerId, snapshot = self.statsQueue.get(timeout=timeout)
+         self.stats[workerId] = snapshot
+      except queue.Empty:
+         pass
+
+   def aggregate(self):
+      # Metrics of all workers together
+      metrics = self.newMetrics()
+      for snapshot in self.retired + list(self.stats.values()):
+         metrics.add(snapshot)
+      return metrics
+
+   def showStats(self):
+      alive = len([w for w in self.workers.values() if w.is_alive()])
+      print("Workers: %d of %d running, %d restarts" % (alive, self.count, self.restarts))
+      for line in self.aggregate().summary():
+         print("    " + line)
+      return None
+
+   def onTerminate(self, signum, frame):
+      # SIGTERM (kill, systemd, docker stop): stop like Ctrl-C
+      self.stopping = True
+
+   def stopWorkers(self):
+      # Terminate the workers and wait until they are gone; the websocket port
+      # must not stay shared with workers of a stopped supervisor
+      self.stopping = True
+      for worker in self.workers.values():
+         if worker.is_alive():
+            worker.terminate()
+      deadline = time.time() + STOP_TIMEOUT
+      for worker in self.workers.values():
+         worker.join(max(0.0, deadline - time.time()))
+         if worker.is_alive():
+            os.kill(worker.pid, signal.SIGKILL)
+            worker.join()
+      return None
+
+   def run(self):
+      if not hasattr(socket, 'SO_REUSEPORT'):
+         print("Error: multi-process mode needs SO_REUSEPORT (not available on this system)")
+         return None
+      signal.signal(signal.SIGTERM, self.onTerminate)
+      for workerId in range(1, self.count + 1):
+         self.startWorker(workerId)
+      print("Started %d workers at %s on port %s" % (self.count, self.args[0], self.args[1]))
+      self.syslog.info("Started %d workers at %s on port %s" % (self.count, self.args[0], self.args[1]))
+      nextStats = time.time() + STATS_INTERVAL
+      try:
+         while not self.stopping:
+            self.collectStats(timeout=0.5)
+            self.checkWorkers()
+            if time.time() >= nextStats:
+               self.showStats()
+               nextStats = time.time() + STATS_INTERVAL
+      except KeyboardInterrupt:
+         pass
+      self.stopWorkers()
+      self.syslog.info("Workers stopped")
+      print("Server terminated.")
+      return None
+# CLASS Supervisor
+
+def runWorkers(count, ws_host, ws_port, tcp_host, tcp_port, initLogging, newMetrics, **options):
+   # Run count worker processes (0: one per cpu) until interrupted (Ctrl-C, SIGTERM)
+   count = count or multiprocessing.cpu_count()
+   Supervisor(count, ws_host, ws_port, tcp_host, tcp_port, initLogging, newMetrics, **options).run()
+   return None
+# def runWorkers()
+
+#=====================================================================================